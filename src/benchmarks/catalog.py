@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+""" Synthetic service catalogs and host facts for benchmarking the
+configuration generation without environment_tools, ZooKeeper or
+soa-configs """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+
+from synapse_tools import configure_synapse
+
+
+LOCATION_TYPES = ['ecosystem', 'superregion', 'region', 'habitat']
+
+# advertise, discover
+LOCATION_SETTINGS = [
+    (['region'], 'region'),
+    (['habitat'], 'habitat'),
+    (['region', 'superregion'], 'region'),
+    (['habitat', 'region', 'superregion'], 'habitat'),
+    (['superregion'], 'superregion'),
+]
+
+ZOOKEEPER_TOPOLOGY = ['10.0.0.1:2181', '10.0.0.2:2181', '10.0.0.3:2181']
+
+
+def make_host_facts(hostname='benchmark-host'):
+    """ HostFacts with every location and grouping already known """
+    return configure_synapse.HostFacts(
+        hostname=hostname,
+        location_types=LOCATION_TYPES,
+        locations={
+            'ecosystem': 'bench',
+            'superregion': 'bench-superregion',
+            'region': 'bench-region',
+            'habitat': 'bench-habitat',
+        },
+        groupings={'ecosystem': 'bench'},
+    )
+
+
+def make_synapse_tools_config(**overrides):
+    config = {
+        'bind_addr': '0.0.0.0',
+        'config_file': '/dev/null',
+        'logging': {'enabled': True},
+        'listen_with_nginx': True,
+    }
+    config.update(overrides)
+    return configure_synapse.set_defaults(config)
+
+
+def make_service_info(rng, name, proxy_port, proxies):
+    advertise, discover = rng.choice(LOCATION_SETTINGS)
+    service_info = {
+        'proxy_port': proxy_port,
+        'advertise': advertise,
+        'discover': discover,
+        'mode': 'tcp' if rng.random() < 0.2 else 'http',
+        'timeout_client_ms': rng.choice([None, 1000, 5000]),
+        'timeout_server_ms': rng.choice([None, 1000, 10000]),
+        'timeout_connect_ms': rng.choice([None, 200]),
+        'retries': rng.choice([None, 1, 2]),
+        'allredisp': rng.random() < 0.1,
+        'keepalive': rng.random() < 0.3,
+        'balance': rng.choice([None, 'leastconn', 'roundrobin']),
+        'healthcheck_uri': rng.choice(['/status', '/health']),
+    }
+    if rng.random() < 0.2:
+        service_info['extra_headers'] = {'X-Mode': 'ro', 'X-Service': name}
+    if rng.random() < 0.1:
+        service_info['extra_healthcheck_headers'] = {'X-Check': 'deep'}
+    if rng.random() < 0.05:
+        service_info['chaos'] = {'ecosystem': {'bench': {'fail': 'drop'}}}
+
+    plugins = {}
+    if rng.random() < 0.5:
+        plugins['logging'] = {'enabled': True, 'sample_rate': rng.choice([0.1, 1])}
+    if rng.random() < 0.1:
+        plugins['path_based_routing'] = {'enabled': True}
+    if plugins:
+        service_info['plugins'] = plugins
+
+    if proxies and rng.random() < 0.05:
+        service_info['proxied_through'] = rng.choice(proxies)
+    return service_info
+
+
+def build_catalog(size, seed=0):
+    """ Return a list of (service_name, service_info) like get_all_namespaces,
+    the same one for the same size and seed """
+    rng = random.Random(seed)
+    proxies = ['proxy_%d.main' % i for i in range(max(1, size // 1000))]
+    services = []
+    for name in proxies:
+        service_info = make_service_info(rng, name, 10000 + len(services), [])
+        service_info['is_proxy'] = True
+        services.append((name, service_info))
+
+    i = 0
+    while len(services) < size:
+        name = 'service_%d.%s' % (i // 2, 'main' if i % 2 == 0 else 'canary')
+        # Some services only want discovery or are not in SmartStack at all
+        proxy_port = rng.choice([None, -1] + [10000 + len(services)] * 18)
+        services.append((name, make_service_info(rng, name, proxy_port, proxies)))
+        i += 1
+    return services
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+""" Benchmark generate_configuration on synthetic catalogs and compare the
+results against the stored baselines:
+
+    python -m benchmarks.generate_configuration [--sizes 100,1000]
+
+Each catalog size runs in a fresh process, so that peak memory (the growth
+of the max RSS while generating and serializing the config) is not skewed
+by the previous runs. Baselines depend on the machine, regenerate them with
+--update-baseline on the machine you compare against.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import argparse
+
+from benchmarks import catalog
+from synapse_tools import configure_synapse
+
+
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# How much worse than the baseline a metric may get before it counts as a
+# regression
+DEFAULT_TOLERANCE = 0.25
+
+# Metric -> differences below which we assume noise, whatever the tolerance
+COMPARED_METRICS = {
+    'generate_time_s': 0.05,
+    'cached_generate_time_s': 0.05,
+    'serialize_time_s': 0.05,
+    'peak_memory_kb': 4096,
+}
+
+# How many times faster a run where nothing changed has to be with a warm
+# render cache than without one
+MIN_RENDER_CACHE_SPEEDUP = 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=lambda s: [int(size) for size in s.split(',')],
+                        default=DEFAULT_SIZES,
+                        help='Comma separated catalog sizes (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per size, the fastest one counts (default: %(default)s).')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='render_processes to generate with (default: %(default)s).')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH,
+                        help='Baseline file (default: %(default)s).')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative regression (default: %(default)s).')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Store the results as the new baselines.')
+    return parser.parse_args(argv)
+
+
+def _maxrss_kb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark(size, repeat=1, processes=1):
+    """ Generate and serialize the configuration of a catalog of the given
+    size in this process and measure it """
+    services = catalog.build_catalog(size)
+    synapse_tools_config = catalog.make_synapse_tools_config()
+    host_facts = catalog.make_host_facts()
+    maxrss_before_kb = _maxrss_kb()
+
+    generate_times = []
+    serialize_times = []
+    for _ in range(repeat):
+        start = time.time()
+        synapse_config = configure_synapse.generate_configuration(
+            synapse_tools_config,
+            catalog.ZOOKEEPER_TOPOLOGY,
+            services,
+            host_facts=host_facts,
+            processes=processes,
+        )
+        generate_times.append(time.time() - start)
+
+        start = time.time()
+        output = configure_synapse.serialize_synapse_config(synapse_config)
+        serialize_times.append(time.time() - start)
+
+    peak_memory_kb = _maxrss_kb() - maxrss_before_kb
+
+    # Runs where nothing changed since the previous one, which reuse all of
+    # its rendered watchers
+    render_cache = {}
+    cached_generate_times = []
+    for _ in range(repeat + 1):
+        start = time.time()
+        configure_synapse.generate_configuration(
+            synapse_tools_config,
+            catalog.ZOOKEEPER_TOPOLOGY,
+            services,
+            render_cache=render_cache,
+            host_facts=host_facts,
+            processes=processes,
+        )
+        cached_generate_times.append(time.time() - start)
+
+    return {
+        'size': size,
+        'watchers': len(synapse_config['services']),
+        'generate_time_s': min(generate_times),
+        # The first run filled the cache
+        'cached_generate_time_s': min(cached_generate_times[1:]),
+        'serialize_time_s': min(serialize_times),
+        'peak_memory_kb': peak_memory_kb,
+        'output_bytes': len(output),
+    }
+
+
+def run_benchmark_in_child(size, repeat=1, processes=1):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_benchmark, (size, repeat, processes))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def compare_to_baseline(results, baselines, tolerance=DEFAULT_TOLERANCE):
+    """ :returns: a list of (size, message) for every regression """
+    regressions = []
+    for result in results:
+        baseline = baselines.get(str(result['size']))
+        if baseline is None:
+            continue
+        for metric, noise in sorted(COMPARED_METRICS.items()):
+            if metric not in baseline:
+                # Recorded before the metric was added
+                continue
+            if result[metric] > max(baseline[metric] * (1 + tolerance), baseline[metric] + noise):
+                regressions.append((result['size'], '{0} {1:.3f} > baseline {2:.3f}'.format(
+                    metric, result[metric], baseline[metric],
+                )))
+        if result['output_bytes'] != baseline['output_bytes']:
+            # The output of the same catalog should only change along with
+            # the generation code, in which case the baseline is outdated
+            regressions.append((result['size'], 'output_bytes {0} != baseline {1}'.format(
+                result['output_bytes'], baseline['output_bytes'],
+            )))
+    return regressions
+
+
+def check_render_cache(results):
+    """ :returns: a list of (size, message) for every size at which the
+    render cache does not save enough time """
+    regressions = []
+    for result in results:
+        noise = COMPARED_METRICS['generate_time_s']
+        if result['cached_generate_time_s'] * MIN_RENDER_CACHE_SPEEDUP > result['generate_time_s'] + noise:
+            regressions.append((result['size'], 'cached_generate_time_s {0:.3f} is not {1}x faster than {2:.3f}'.format(
+                result['cached_generate_time_s'], MIN_RENDER_CACHE_SPEEDUP, result['generate_time_s'],
+            )))
+    return regressions
+
+
+def load_baselines(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except IOError:
+        return {}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        result = run_benchmark_in_child(size, repeat=args.repeat, processes=args.processes)
+        print('{size:>6} services {watchers:>7} watchers: generate {generate_time_s:.3f}s '
+              '(cached {cached_generate_time_s:.3f}s) serialize {serialize_time_s:.3f}s '
+              'peak memory {peak_memory_kb}KB output {output_bytes}B'.format(**result))
+        results.append(result)
+
+    baselines = load_baselines(args.baseline)
+    if args.update_baseline:
+        baselines.update((str(result['size']), result) for result in results)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baselines, fp, sort_keys=True, indent=4, separators=(',', ': '))
+            fp.write('\n')
+        return 0
+
+    regressions = compare_to_baseline(results, baselines, tolerance=args.tolerance)
+    regressions.extend(check_render_cache(results))
+    for size, message in regressions:
+        print('REGRESSION {0:>6} services: {1}'.format(size, message))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
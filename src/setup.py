@@ -10,7 +10,7 @@ setup(
     author='John Billings',
     author_email='billings@yelp.com',
     description='Synapse-related tools for use on Yelp machines',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     setup_requires=['setuptools'],
     include_package_data=True,
     install_requires=[
@@ -30,6 +30,7 @@ setup(
         'console_scripts': [
             'configure_synapse=synapse_tools.configure_synapse:main',
             'haproxy_synapse_reaper=synapse_tools.haproxy_synapse_reaper:main',
+            'synapse_batch_render=synapse_tools.batch_render:main',
             'synapse_qdisc_tool=synapse_tools.haproxy.qdisc_tool:main',
         ],
     },
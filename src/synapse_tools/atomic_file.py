@@ -0,0 +1,43 @@
+# -*- coding: utf8 -*-
+""" Writing files which other processes read while they are replaced """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+
+
+def is_temporary_file(path, target_path):
+    """ Whether path is one of the temporary files write_atomically creates
+    while replacing target_path """
+    return path.startswith(_get_temporary_prefix(target_path))
+
+
+def _get_temporary_prefix(path):
+    return os.path.join(os.path.dirname(path), '.{0}.'.format(os.path.basename(path)))
+
+
+def write_atomically(path, data, mode=None):
+    """ Replace the file at path with data, readers see either the old or
+    the new file but never a partially written one.
+
+    The temporary file has to live in the same directory for the rename to
+    be atomic. It gets a unique name, so concurrent writers do not clobber
+    each other's, and is removed if writing it fails.
+
+    :param mode: permissions of the file, 0600 if None
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix=os.path.basename(_get_temporary_prefix(path)),
+    )
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
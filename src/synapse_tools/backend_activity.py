@@ -0,0 +1,90 @@
+# -*- coding: utf8 -*-
+""" Track which HAProxy backends see traffic, from the session counters of
+its stats socket, so that the ones nobody uses can be demoted.
+
+Demoted backends have the health checks of their servers stopped through
+the stats socket rather than dropped from the config synapse generates, so
+that demoting and promoting a backend never restarts synapse. HAProxy
+checks every server again after synapse reloads it, until the next run
+demotes them again.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+
+class BackendActivity(object):
+    """ Remembers, for each backend, its session counter when it was last
+    observed and when that counter last went up.
+
+    The state is a JSON-serializable dict which has to be persisted between
+    runs, see state().
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        # backend name -> [sessions, last_active]
+        self.backends = {
+            backend: list(entry) for backend, entry in state.get('backends', {}).items()
+        }
+
+    def state(self):
+        return {'backends': self.backends}
+
+    def observe(self, sessions_by_backend, now=None):
+        """ Record the current session counters of the backends.
+
+        A backend counts as active when it is first observed, so that it is
+        only idle after a whole window without traffic. HAProxy resets the
+        counters when it is reloaded, a counter which went down is only
+        active if it went up again since.
+        """
+        now = time.time() if now is None else now
+        backends = {}
+        for backend, sessions in sessions_by_backend.items():
+            entry = self.backends.get(backend)
+            if entry is None:
+                last_active = now
+            else:
+                previous_sessions, last_active = entry
+                if sessions > previous_sessions or (sessions < previous_sessions and sessions > 0):
+                    last_active = now
+            backends[backend] = [sessions, last_active]
+        self.backends = backends
+
+    def idle_backends(self, idle_s, now=None):
+        """ The backends which did not get a session for idle_s """
+        now = time.time() if now is None else now
+        return {
+            backend for backend, (_, last_active) in self.backends.items()
+            if now - last_active >= idle_s
+        }
+
+
+def get_health_commands(stats, cold_backends, checked_backends):
+    """ The runtime API commands which stop the health checks of the servers
+    of the cold backends, and start them again on the servers of the other
+    checked_backends, which are health checked in the config synapse
+    generates.
+
+    Drained servers and the ones in maintenance are left alone: the subsets
+    take care of the health checks of the drained ones (see backend_subset),
+    and the ones in maintenance are either empty slots or out of discovery.
+    """
+    commands = []
+    for row in stats:
+        backend = row['pxname']
+        if backend not in checked_backends or row['svname'] in ('FRONTEND', 'BACKEND'):
+            continue
+        if row['status'].startswith(('DRAIN', 'MAINT')):
+            continue
+        server = '{0}/{1}'.format(backend, row['svname'])
+        # The status HAProxy reports for a server whose checks are stopped
+        checked = row['status'] != 'no check'
+        if backend in cold_backends and checked:
+            commands.append('disable health {0}'.format(server))
+        elif backend not in cold_backends and not checked:
+            commands.append('enable health {0}'.format(server))
+    return commands
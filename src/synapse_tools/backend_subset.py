@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+""" Have each host only use a subset of the servers of a backend, the same
+one on every run and spread evenly across the hosts.
+
+Synapse generates the backends with every server and has no way to filter
+them per host, so the servers outside of the subset are taken out through
+the HAProxy runtime API (or never assigned a slot, see server_slots). They
+are drained rather than put in maintenance, since synapse takes every server
+it discovers out of maintenance whenever it updates HAProxy through its
+stats socket. It leaves drained servers and their health checks alone, but
+reloads HAProxy with every server in use, so the subsets have to be applied
+again after each reload.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+
+
+def _get_score(hostname, server):
+    return hashlib.md5('{0}/{1}'.format(hostname, server).encode('utf8')).hexdigest()
+
+
+def get_subset(hostname, servers, subset_size):
+    """ The subset_size servers ranked highest for hostname.
+
+    This is rendezvous hashing: every host ranks the servers in its own
+    order, so each server is in the subset of about subset_size / len(servers)
+    of the hosts. A server joining or leaving only changes the subsets it
+    is or was in.
+    """
+    ranked = sorted(servers, key=lambda server: _get_score(hostname, server), reverse=True)
+    return set(ranked[:subset_size])
+
+
+def get_address_subset(hostname, servers, subset_size):
+    """ get_subset of a set of (host, port), which are ranked the same way
+    as the servers of the backends whose subsets are drained """
+    addresses = {'{0}:{1}'.format(host, port): (host, port) for host, port in servers}
+    return {addresses[address] for address in get_subset(hostname, addresses, subset_size)}
+
+
+def _get_server_address(server_name):
+    # Synapse names the servers host:port, followed by _name if they have one
+    return server_name.split('_', 1)[0]
+
+
+def get_subset_commands(hostname, stats, subset_sizes, discovered_servers):
+    """ The runtime API commands which drain the servers outside of the
+    subset of their backend and stop their health checks, and put the ones
+    in it back in use.
+
+    The subset is picked among the servers which are in discovery: synapse
+    puts the ones which left it in maintenance until it next reloads
+    HAProxy, and they must stay there.
+
+    :param stats: the rows of 'show stat'
+    :param subset_sizes: backend name -> subset size
+    :param discovered_servers: backend name -> set of 'host:port' of the
+                               servers in discovery, the backends which are
+                               missing are left alone
+    """
+    commands = []
+    subsets = {}
+    for row in stats:
+        backend = row['pxname']
+        if backend not in subset_sizes or backend not in discovered_servers \
+                or row['svname'] in ('FRONTEND', 'BACKEND'):
+            continue
+        if backend not in subsets:
+            subsets[backend] = get_subset(hostname, discovered_servers[backend], subset_sizes[backend])
+
+        server = '{0}/{1}'.format(backend, row['svname'])
+        in_subset = _get_server_address(row['svname']) in subsets[backend]
+        # Servers put in maintenance by earlier versions are taken out of it
+        out_of_use = row['status'].startswith(('DRAIN', 'MAINT'))
+        if in_subset and out_of_use:
+            commands.append('set server {0} state ready'.format(server))
+            commands.append('enable health {0}'.format(server))
+        elif not in_subset and not out_of_use:
+            commands.append('set server {0} state drain'.format(server))
+            commands.append('disable health {0}'.format(server))
+    return commands
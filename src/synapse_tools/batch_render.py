@@ -0,0 +1,187 @@
+"""Render the synapse configs of many hosts at once into an artifact
+directory, from which configure_synapse on each host picks up its own config
+(see the rendered_config_dir option).
+
+The catalog is read once, and the watchers of each service are rendered once
+per distinct set of locations and groupings they depend on rather than once
+per host. Hosts in the same locations share the same services artifact.
+"""
+
+import json
+import logging
+import os
+import time
+
+import argparse
+from synapse_tools import config_artifacts
+from synapse_tools.catalog_cache import CatalogCache
+from synapse_tools.configure_synapse import available_location_types
+from synapse_tools.configure_synapse import generate_configuration
+from synapse_tools.configure_synapse import get_all_namespaces
+from synapse_tools.configure_synapse import get_config
+from synapse_tools.configure_synapse import get_server_order_seed
+from synapse_tools.configure_synapse import get_zookeeper_topology
+from synapse_tools.configure_synapse import HostFacts
+from synapse_tools.configure_synapse import LOG_FORMAT
+
+
+log = logging.getLogger(__name__)
+
+
+class StaticHostFacts(HostFacts):
+    """The facts of another host, all given up front. A host without a
+    grouping for some grouping type is not in any of its groupings."""
+
+    def location(self, location_type):
+        return self._locations[location_type]
+
+    def grouping(self, grouping_type):
+        return self._groupings.get(grouping_type)
+
+    def facts_key(self):
+        """Equal for hosts whose configs only differ by hostname"""
+        return json.dumps([self._locations, self._groupings], sort_keys=True)
+
+
+def load_hosts(hosts_path):
+    """Read the facts of the hosts to render configs for, from a JSON file
+    of the form:
+
+        {
+            "location_types": ["ecosystem", "superregion", "region", "habitat"],
+            "hosts": [
+                {
+                    "hostname": "host1",
+                    "locations": {"ecosystem": "prod", ...},
+                    "groupings": {"ecosystem": "prod", ...}
+                },
+                ...
+            ]
+        }
+
+    location_types defaults to the ones of this host. Every host needs a
+    location for each location type.
+    """
+    with open(hosts_path) as fp:
+        hosts = json.load(fp)
+    location_types = hosts.get('location_types') or available_location_types()
+
+    all_host_facts = []
+    for host in hosts['hosts']:
+        missing_types = set(location_types) - set(host['locations'])
+        if missing_types:
+            raise ValueError('{0} has no location for {1}'.format(
+                host['hostname'], ', '.join(sorted(missing_types)),
+            ))
+        all_host_facts.append(StaticHostFacts(
+            hostname=host['hostname'],
+            location_types=location_types,
+            locations=host['locations'],
+            groupings=host.get('groupings'),
+        ))
+    return all_host_facts
+
+
+def render_hosts(synapse_tools_config, zookeeper_topology, services, all_host_facts, processes=1):
+    """Generate (host_facts, synapse_config) for each host.
+
+    The configs of hosts in the same locations and groupings only differ by
+    their server order seed, so they are only generated once. Those hosts
+    share a render cache, so a service is only rendered again for locations
+    or groupings which differ in a way that matters to it.
+    """
+    services = list(services)
+    render_cache = {}
+    synapse_configs = {}
+    for host_facts in all_host_facts:
+        facts_key = host_facts.facts_key()
+        if facts_key not in synapse_configs:
+            synapse_configs[facts_key] = generate_configuration(
+                synapse_tools_config,
+                zookeeper_topology,
+                services,
+                render_cache=render_cache,
+                host_facts=host_facts,
+                processes=processes,
+                prune_render_cache=False,
+            )
+        synapse_config = synapse_configs[facts_key]
+        yield host_facts, dict(synapse_config, haproxy=dict(
+            synapse_config['haproxy'], server_order_seed=get_server_order_seed(host_facts.hostname),
+        ))
+
+
+def write_artifacts(
+    artifact_dir, synapse_tools_config, zookeeper_topology, services, all_host_facts, rendered_at, processes=1,
+):
+    """Render and write the configs of all hosts, from the services read
+    from the catalog at rendered_at. Returns the digests of the services
+    artifacts which were written."""
+    inputs_digest = config_artifacts.get_inputs_digest(synapse_tools_config, zookeeper_topology)
+    # The services section of a config only depends on the host's locations
+    # and groupings, so it is only serialized once for each of them
+    services_digests = {}
+    for host_facts, synapse_config in render_hosts(
+        synapse_tools_config, zookeeper_topology, services, all_host_facts, processes=processes,
+    ):
+        facts_key = host_facts.facts_key()
+        if facts_key not in services_digests:
+            services_digests[facts_key] = config_artifacts.write_services(
+                artifact_dir, synapse_config['services'],
+            )
+        config_artifacts.write_host_config(
+            artifact_dir, host_facts.hostname, synapse_config,
+            services_digests[facts_key], inputs_digest, rendered_at,
+        )
+    return set(services_digests.values())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--hosts', required=True, metavar='PATH',
+        help='JSON file with the facts of the hosts to render configs for, '
+             'see load_hosts.')
+    parser.add_argument(
+        '--output-dir', required=True, metavar='PATH',
+        help='Artifact directory to write the configs to.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    # The same config as the hosts, otherwise they ignore what is rendered
+    synapse_tools_config_path = os.environ.get(
+        'SYNAPSE_TOOLS_CONFIG_PATH', '/etc/synapse/synapse-tools.conf.json'
+    )
+    my_config = get_config(synapse_tools_config_path)
+    rendered_at = time.time()
+    zookeeper_topology = get_zookeeper_topology(my_config['zookeeper_topology_path'])
+    all_host_facts = load_hosts(args.hosts)
+
+    catalog_cache = None
+    if my_config['catalog_cache_path']:
+        catalog_cache = CatalogCache.load(my_config['catalog_cache_path'])
+    services = get_all_namespaces(soa_dir=my_config['soa_dir'], catalog_cache=catalog_cache)
+    if catalog_cache is not None and catalog_cache.dirty:
+        catalog_cache.save(my_config['catalog_cache_path'])
+
+    services_digests = write_artifacts(
+        args.output_dir, my_config, zookeeper_topology, services, all_host_facts, rendered_at,
+        processes=my_config['render_processes'],
+    )
+    log.info(
+        'Rendered the configs of %d hosts, with %d distinct services sections',
+        len(all_host_facts), len(services_digests),
+    )
+    # The artifacts of the previous catalogs and hosts are never used again
+    removed = config_artifacts.prune(
+        args.output_dir, [host_facts.hostname for host_facts in all_host_facts], services_digests,
+    )
+    if removed:
+        log.info('Removed %d outdated artifacts', removed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf8 -*-
+""" Cache of the smartstack namespaces of every service in the soa-configs,
+so that only the services whose smartstack.yaml or service.yaml changed get
+parsed again """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cPickle as pickle
+import io
+import os
+
+from synapse_tools.atomic_file import write_atomically
+
+
+# Bump this whenever the format of the entries changes
+CATALOG_CACHE_VERSION = 2
+
+# Number of files each worker of a pool parses at a time
+PARSE_CHUNK_SIZE = 16
+
+
+def _stat_key(path):
+    """ Identify the current version of a file, None if it does not exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _service_key(service_dir):
+    """ Identify the current version of the files the namespaces of a service
+    are read from, None if there are none """
+    key = tuple(_stat_key(os.path.join(service_dir, name)) for name in ('smartstack.yaml', 'service.yaml'))
+    return key if any(key) else None
+
+
+def _read_yaml_file(path):
+    """ The same as service_configuration_lib's, without its cache of the
+    contents of every file it ever read, which would give the daemon the
+    outdated contents of the files which changed """
+    from service_configuration_lib import load_yaml
+
+    try:
+        with io.open(path, 'r', encoding='UTF-8') as fp:
+            return load_yaml(fp.read()) or {}
+    except IOError:
+        return {}
+
+
+def _read_namespaces(service, soa_dir):
+    # The same as paasta_tools.marathon_tools.get_all_namespaces_for_service,
+    # which also parses all the other yaml files of the service although the
+    # namespaces only come from smartstack.yaml, unless service.yaml
+    # overrides it with a smartstack key
+    from paasta_tools.utils import compose_job_id
+
+    service_dir = os.path.join(soa_dir, service)
+    service_information = _read_yaml_file(os.path.join(service_dir, 'service.yaml'))
+    if 'smartstack' in service_information:
+        smartstack = service_information['smartstack']
+    else:
+        smartstack = _read_yaml_file(os.path.join(service_dir, 'smartstack.yaml'))
+    return [
+        (compose_job_id(service, namespace), namespace_config)
+        for namespace, namespace_config in smartstack.items()
+    ]
+
+
+def _read_namespaces_star(args):
+    return _read_namespaces(*args)
+
+
+class CatalogCache(object):
+    """ Maps the path of the smartstack.yaml of each service to the identity
+    (inode, size and mtime) of that file and of its service.yaml, and the
+    namespaces read from them """
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else {}
+        # Whether entries changed since the cache was loaded
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        """ A missing, unreadable or outdated cache file results in an empty
+        cache, which just means that every file gets parsed again """
+        try:
+            with open(path, 'rb') as fp:
+                version, entries = pickle.load(fp)
+        except (
+            IOError, EOFError, AttributeError, ImportError, IndexError, KeyError,
+            TypeError, ValueError, pickle.UnpicklingError,
+        ):
+            return cls()
+        if version != CATALOG_CACHE_VERSION:
+            return cls()
+        return cls(entries)
+
+    def save(self, path):
+        # A concurrent or interrupted run never sees a partially written cache
+        write_atomically(path, pickle.dumps(
+            (CATALOG_CACHE_VERSION, self.entries), pickle.HIGHEST_PROTOCOL,
+        ))
+        self.dirty = False
+
+    def get_all_namespaces(self, soa_dir, pool=None):
+        """ The same as paasta_tools.marathon_tools.get_all_namespaces.
+
+        :returns: A list of tuples of the form (service.namespace, namespace_config)
+        """
+        return list(self.iter_namespaces(soa_dir, pool=pool))
+
+    def iter_namespaces(self, soa_dir, pool=None):
+        """ Generate the namespaces of all services, in the same order as
+        get_all_namespaces.
+
+        With a multiprocessing pool, the changed files are parsed by its
+        workers and the namespaces of each service are generated as soon as
+        it has been parsed. The cache is updated once all namespaces have
+        been generated, entries of services which are gone are dropped.
+        """
+        rootdir = os.path.abspath(soa_dir)
+        files = []
+        stale_services = []
+        for service in os.listdir(rootdir):
+            path = os.path.join(rootdir, service, 'smartstack.yaml')
+            key = _service_key(os.path.dirname(path))
+            entry = self.entries.get(path)
+            stale = entry is None or entry[0] != key
+            files.append((path, key, stale))
+            if stale and key is not None:
+                stale_services.append(service)
+
+        if pool is None:
+            parsed = (_read_namespaces(service, rootdir) for service in stale_services)
+        else:
+            parsed = pool.imap(
+                _read_namespaces_star, [(service, rootdir) for service in stale_services],
+                chunksize=PARSE_CHUNK_SIZE,
+            )
+
+        entries = {}
+        for path, key, stale in files:
+            if stale:
+                entry = (key, next(parsed) if key is not None else [])
+                self.dirty = True
+            else:
+                entry = self.entries[path]
+            entries[path] = entry
+            for namespace in entry[1]:
+                yield namespace
+
+        if set(entries) != set(self.entries):
+            self.dirty = True
+        self.entries = entries
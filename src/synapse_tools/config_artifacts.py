@@ -0,0 +1,177 @@
+# -*- coding: utf8 -*-
+""" Synapse configs rendered for other hosts, see synapse_batch_render.
+
+An artifact directory holds:
+
+* services/<sha256>.json: the services section of a config, named after the
+  digest of its content so that every host in the same locations shares it
+* hosts/<hostname>.json: the rest of a host's config, which references its
+  services section by digest
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from synapse_tools.atomic_file import write_atomically
+
+
+log = logging.getLogger(__name__)
+
+# Bump this whenever the format of the artifacts changes
+ARTIFACTS_VERSION = 2
+
+# The synapse-tools config options which only change how a host runs
+# configure_synapse, including the post-processing it does to a rendered
+# config, and not what is rendered for it
+HOST_LOCAL_OPTIONS = frozenset([
+    'always_rendered_services',
+    'backend_activity_path',
+    'catalog_cache_path',
+    'cold_backend_idle_s',
+    'collapse_identical_backends',
+    'compact_config_file',
+    'config_digest_path',
+    'config_file',
+    'haproxy_runtime_updates',
+    'haproxy_server_slots',
+    'namespace_loader_processes',
+    'render_cache_path',
+    'render_processes',
+    'rendered_config_dir',
+    'rendered_config_max_age_s',
+    'restart_coalesce_window_s',
+    'restart_jitter_window_s',
+    'restart_min_interval_s',
+    'restart_state_path',
+    'service_dependencies_path',
+    'soa_dir',
+    'synapse_command',
+    'timing_statsd_address',
+    'timing_statsd_prefix',
+    'timing_summary_path',
+    'zookeeper_topology_path',
+])
+
+
+def get_inputs_digest(synapse_tools_config, zookeeper_topology):
+    """ Digest of the run-wide inputs of a config, a host only uses a config
+    which was rendered from the same ones it has """
+    render_options = {
+        key: value for key, value in synapse_tools_config.items()
+        if key not in HOST_LOCAL_OPTIONS
+    }
+    return hashlib.sha256(json.dumps(
+        [render_options, zookeeper_topology], sort_keys=True,
+    )).hexdigest()
+
+
+def _services_path(artifact_dir, digest):
+    return os.path.join(artifact_dir, 'services', '{0}.json'.format(digest))
+
+
+def _host_path(artifact_dir, hostname):
+    return os.path.join(artifact_dir, 'hosts', '{0}.json'.format(hostname))
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def write_services(artifact_dir, services):
+    """ Write a services section unless it already exists, returns its
+    digest """
+    data = json.dumps(services, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(data).hexdigest()
+    path = _services_path(artifact_dir, digest)
+    if not os.path.exists(path):
+        _makedirs(os.path.dirname(path))
+        write_atomically(path, data, mode=0o644)
+    return digest
+
+
+def write_host_config(artifact_dir, hostname, synapse_config, services_digest, inputs_digest, rendered_at):
+    """ Write the config of a host, whose services section was written with
+    write_services, from the catalog read at rendered_at """
+    host_config = dict(synapse_config)
+    del host_config['services']
+    path = _host_path(artifact_dir, hostname)
+    _makedirs(os.path.dirname(path))
+    # Hosts must never read a partially written artifact
+    write_atomically(path, json.dumps(
+        {
+            'version': ARTIFACTS_VERSION,
+            'inputs': inputs_digest,
+            'rendered_at': rendered_at,
+            'services': services_digest,
+            'config': host_config,
+        },
+        sort_keys=True, separators=(',', ':'),
+    ), mode=0o644)
+
+
+def _remove_other_files(directory, names):
+    try:
+        existing_names = os.listdir(directory)
+    except OSError:
+        return 0
+    removed = 0
+    for name in existing_names:
+        if name not in names and name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+
+def prune(artifact_dir, hostnames, services_digests):
+    """ Remove the configs of the hosts other than hostnames and the
+    services sections other than services_digests, which the remaining
+    configs reference. Returns how many files were removed.
+
+    Only call this once the remaining configs were written: a host loading
+    its previous config while it runs falls back to rendering its own. """
+    removed = _remove_other_files(
+        os.path.join(artifact_dir, 'hosts'),
+        {os.path.basename(_host_path(artifact_dir, hostname)) for hostname in hostnames},
+    )
+    removed += _remove_other_files(
+        os.path.join(artifact_dir, 'services'),
+        {os.path.basename(_services_path(artifact_dir, digest)) for digest in services_digests},
+    )
+    return removed
+
+
+def load_host_config(artifact_dir, hostname, inputs_digest, max_age_s):
+    """ The synapse config rendered for hostname, None if there is none, it
+    was rendered from other inputs or more than max_age_s ago. The catalog
+    is not part of the inputs, so the age bounds how stale its services are
+    when the rendering stopped. """
+    try:
+        with open(_host_path(artifact_dir, hostname)) as fp:
+            host = json.load(fp)
+        if host.get('version') != ARTIFACTS_VERSION:
+            log.warning('Ignoring a rendered config of another version')
+            return None
+        if host['inputs'] != inputs_digest:
+            log.warning('Ignoring the config rendered from other inputs')
+            return None
+        if time.time() - host['rendered_at'] > max_age_s:
+            log.warning('Ignoring the config rendered at %s, it is too old', host['rendered_at'])
+            return None
+        with open(_services_path(artifact_dir, host['services'])) as fp:
+            data = fp.read()
+        if hashlib.sha256(data).hexdigest() != host['services']:
+            log.warning('Ignoring the rendered config, its services do not match their digest')
+            return None
+        synapse_config = host['config']
+        synapse_config['services'] = json.loads(data)
+    except (IOError, KeyError, TypeError, ValueError) as e:
+        log.warning('Could not load the rendered config: %s', e)
+        return None
+    return synapse_config
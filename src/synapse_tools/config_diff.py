@@ -0,0 +1,195 @@
+# -*- coding: utf8 -*-
+""" Work out the cheapest way for synapse to pick up a new configuration.
+
+Synapse only reads its configuration when it starts, and a restart tears
+down every ZooKeeper watch and starts HAProxy with empty backends. Many
+changes do not need that:
+
+* NO_ACTION: the configurations only differ in their encoding (indentation,
+  key order), synapse would end up with exactly the same state.
+* RUNTIME_UPDATE: only settings that HAProxy can change at runtime differ,
+  the new values are applied through the stats socket. Synapse still has
+  the old values, with which it reloads HAProxy and adds new servers, so
+  they have to be applied again until it is restarted, see
+  get_outdated_runtime_commands.
+* RESTART: anything else.
+
+There is no class of changes which only need an HAProxy reload: synapse
+writes the HAProxy config from the config it was started with whenever it
+reloads HAProxy, so HAProxy only keeps settings synapse does not know about
+if they are applied at runtime.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+
+NO_ACTION = 'none'
+RUNTIME_UPDATE = 'runtime'
+RESTART = 'restart'
+
+ConfigChange = collections.namedtuple('ConfigChange', ['action', 'reasons', 'runtime_updates'])
+
+# backend is None for process wide settings
+RuntimeUpdate = collections.namedtuple('RuntimeUpdate', ['backend', 'setting', 'value'])
+
+
+def classify_change(old_config, new_config):
+    """ Compare the configuration synapse is running with (None if unknown)
+    against a new one.
+
+    :returns: a ConfigChange whose reasons explain why a restart is needed
+    """
+    if old_config == new_config:
+        return ConfigChange(NO_ACTION, [], [])
+    if old_config is None:
+        return ConfigChange(RESTART, ['current config is unknown'], [])
+
+    reasons = []
+    runtime_updates = []
+    for key in sorted(set(old_config) | set(new_config)):
+        old_value = old_config.get(key)
+        new_value = new_config.get(key)
+        if old_value == new_value:
+            continue
+        if key == 'haproxy' and old_value is not None and new_value is not None:
+            _diff_haproxy(old_value, new_value, reasons, runtime_updates)
+        elif key == 'services' and old_value is not None and new_value is not None:
+            _diff_services(old_value, new_value, reasons, runtime_updates)
+        else:
+            reasons.append('{0} changed'.format(key))
+
+    if reasons:
+        return ConfigChange(RESTART, reasons, [])
+    return ConfigChange(RUNTIME_UPDATE, [], runtime_updates)
+
+
+def _pop_setting(tokens, setting):
+    """ Remove '<setting> <value>' from a list of tokens and return the
+    remaining tokens and the value, which is None if the setting is not
+    there """
+    if setting not in tokens[:-1]:
+        return tokens, None
+    i = tokens.index(setting)
+    return tokens[:i] + tokens[i + 2:], tokens[i + 1]
+
+
+def _split_global_maxconn(lines):
+    others = []
+    maxconn = None
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 2 and tokens[0] == 'maxconn':
+            maxconn = tokens[1]
+        else:
+            others.append(line)
+    return others, maxconn
+
+
+def _diff_haproxy(old_haproxy, new_haproxy, reasons, runtime_updates):
+    for key in sorted(set(old_haproxy) | set(new_haproxy)):
+        old_value = old_haproxy.get(key)
+        new_value = new_haproxy.get(key)
+        if old_value == new_value:
+            continue
+
+        if key == 'global' and old_value is not None and new_value is not None:
+            old_lines, old_maxconn = _split_global_maxconn(old_value)
+            new_lines, new_maxconn = _split_global_maxconn(new_value)
+            if old_lines == new_lines and new_maxconn is not None and new_maxconn.isdigit():
+                runtime_updates.append(RuntimeUpdate(None, 'maxconn', int(new_maxconn)))
+                continue
+
+        reasons.append('haproxy.{0} changed'.format(key))
+
+
+def _diff_services(old_services, new_services, reasons, runtime_updates):
+    for name in sorted(set(old_services) | set(new_services)):
+        old_watcher = old_services.get(name)
+        new_watcher = new_services.get(name)
+        if old_watcher == new_watcher:
+            continue
+        if old_watcher is None:
+            reasons.append('{0} added'.format(name))
+            continue
+        if new_watcher is None:
+            reasons.append('{0} removed'.format(name))
+            continue
+
+        update = _diff_watcher(name, old_watcher, new_watcher)
+        if update is None:
+            reasons.append('{0} changed'.format(name))
+        else:
+            runtime_updates.append(update)
+
+
+def _diff_watcher(name, old_watcher, new_watcher):
+    """ Return the RuntimeUpdate which turns the old watcher into the new
+    one, or None if there is none """
+    old_haproxy = dict(old_watcher.get('haproxy', {}))
+    new_haproxy = dict(new_watcher.get('haproxy', {}))
+    old_options = old_haproxy.pop('server_options', '').split()
+    new_options = new_haproxy.pop('server_options', '').split()
+
+    # Everything but the server options must be the same
+    if dict(old_watcher, haproxy=old_haproxy) != dict(new_watcher, haproxy=new_haproxy):
+        return None
+
+    old_options, _ = _pop_setting(old_options, 'maxconn')
+    new_options, new_maxconn = _pop_setting(new_options, 'maxconn')
+    if old_options != new_options or new_maxconn is None or not new_maxconn.isdigit():
+        return None
+
+    backend = new_haproxy.get('backend_name', name)
+    return RuntimeUpdate(backend, 'maxconn', int(new_maxconn))
+
+
+# The 'show stat' column with the current value of each server setting
+_STAT_COLUMNS = {'maxconn': 'slim'}
+
+
+def get_runtime_commands(runtime_updates, servers_by_backend):
+    """ Turn RuntimeUpdates into HAProxy runtime API commands.
+
+    :param servers_by_backend: dict of backend name -> list of server names
+        for the backends HAProxy is currently running with
+    """
+    commands = []
+    for update in runtime_updates:
+        if update.backend is None:
+            commands.append('set {0} global {1}'.format(update.setting, update.value))
+            continue
+        for server in servers_by_backend.get(update.backend, []):
+            commands.append('set {0} server {1}/{2} {3}'.format(
+                update.setting, update.backend, server, update.value,
+            ))
+    return commands
+
+
+def get_outdated_runtime_commands(runtime_updates, stats):
+    """ Turn RuntimeUpdates into the HAProxy runtime API commands for the
+    servers which do not have the new value (anymore), after HAProxy was
+    reloaded or got new servers. Process wide settings are not in the
+    stats, their commands are always returned.
+
+    :param stats: the rows of 'show stat', see runtime_api.show_stat
+    """
+    rows_by_backend = {}
+    for row in stats:
+        if row['svname'] not in ('FRONTEND', 'BACKEND'):
+            rows_by_backend.setdefault(row['pxname'], []).append(row)
+
+    commands = []
+    for update in runtime_updates:
+        if update.backend is None:
+            commands.extend(get_runtime_commands([update], {}))
+            continue
+        column = _STAT_COLUMNS[update.setting]
+        outdated_servers = [
+            row['svname'] for row in rows_by_backend.get(update.backend, [])
+            if row.get(column) != str(update.value)
+        ]
+        commands.extend(get_runtime_commands([update], {update.backend: outdated_servers}))
+    return commands
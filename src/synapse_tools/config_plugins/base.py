@@ -8,14 +8,43 @@ class HAProxyConfigPlugin(object):
         """
         Initializes plugin base class
         :param str service_name: name of service
-        :param dict service_info: dictionary of service config info
+        :param ServiceConfig service_info: config of the service
         :param dict synapse_tools_config: dictionary of synapse tools
                  config options
         """
         self.service_name = service_name
         self.service_info = service_info
         self.synapse_tools_config = synapse_tools_config
-        self.plugins = service_info.get('plugins', {})
+        self.plugins = service_info.plugins
+
+    @classmethod
+    def run_global_options(cls, synapse_tools_config):
+        """
+        Options for HAProxy configuration global section which only
+        depend on the synapse tools config. Computed once per run,
+        unlike global_options which is called for every service, and
+        added in place of the global_options of the first service for
+        which those are empty.
+        :param dict synapse_tools_config: dictionary of synapse tools
+                 config options
+        :return: list of strings corresponding to distinct
+                 lines in HAProxy config global
+        """
+        return []
+
+    @classmethod
+    def service_options_key(cls, service_name, service_info):
+        """
+        Key which fully determines the per-service options of this plugin
+        (global, frontend and backend) for a run. Services with equal keys
+        share the options computed for the first of them, without the
+        plugin being instantiated again.
+        :param str service_name: name of service
+        :param ServiceConfig service_info: config of the service
+        :return: hashable key, or None if the options have to be computed
+                 for this service
+        """
+        return None
 
     @abc.abstractmethod
     def global_options(self):
@@ -1,7 +1,23 @@
+import json
 import os
 from base import HAProxyConfigPlugin
 
 
+def _global_options(synapse_tools_config, plugin_opts):
+    lua_dir = synapse_tools_config['lua_dir']
+    lua_file = os.path.join(lua_dir, 'log_requests.lua')
+    map_dir = synapse_tools_config['map_dir']
+    map_file = os.path.join(map_dir, 'ip_to_service.map')
+    opts = [
+        'lua-load %s' % lua_file,
+        'setenv map_file %s' % map_file
+    ]
+    if 'sample_rate' in plugin_opts:
+        sample_rate = str(plugin_opts['sample_rate'])
+        opts.append('setenv sample_rate {0}'.format(sample_rate))
+    return opts
+
+
 class Logging(HAProxyConfigPlugin):
     def __init__(self, service_name, service_info, synapse_tools_config):
         super(Logging, self).__init__(
@@ -9,31 +25,35 @@ class Logging(HAProxyConfigPlugin):
         )
 
         global_enabled = self.synapse_tools_config.get('logging', {}).get('enabled', False)
-        svc_enabled = self.plugins.get('logging', {}).get('enabled', False)
-        self.enabled = svc_enabled or global_enabled
+        self.svc_enabled = self.plugins.get('logging', {}).get('enabled', False)
+        self.enabled = self.svc_enabled or global_enabled
 
         self.plugin_opts = (
-            self.plugins.get('logging', {}) if svc_enabled
+            self.plugins.get('logging', {}) if self.svc_enabled
             else self.synapse_tools_config.get('logging', {}) if global_enabled
             else {}
         )
 
-    def global_options(self):
-        if not self.enabled:
+    @classmethod
+    def run_global_options(cls, synapse_tools_config):
+        logging_opts = synapse_tools_config.get('logging', {})
+        if not logging_opts.get('enabled', False):
             return []
+        return _global_options(synapse_tools_config, logging_opts)
 
-        lua_dir = self.synapse_tools_config['lua_dir']
-        lua_file = os.path.join(lua_dir, 'log_requests.lua')
-        map_dir = self.synapse_tools_config['map_dir']
-        map_file = os.path.join(map_dir, 'ip_to_service.map')
-        opts = [
-            'lua-load %s' % lua_file,
-            'setenv map_file %s' % map_file
-        ]
-        if 'sample_rate' in self.plugin_opts:
-            sample_rate = str(self.plugin_opts['sample_rate'])
-            opts.append('setenv sample_rate {0}'.format(sample_rate))
-        return opts
+    @classmethod
+    def service_options_key(cls, service_name, service_info):
+        # Only the service's own logging options matter, the global ones
+        # are the same for the whole run
+        return json.dumps(
+            service_info.plugins.get('logging'), sort_keys=True,
+        )
+
+    def global_options(self):
+        # Enabling logging globally is handled by run_global_options
+        if not self.svc_enabled:
+            return []
+        return _global_options(self.synapse_tools_config, self.plugin_opts)
 
     def frontend_options(self):
         return []
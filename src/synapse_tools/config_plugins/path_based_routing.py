@@ -2,6 +2,12 @@ import os
 from base import HAProxyConfigPlugin
 
 
+def _global_options(synapse_tools_config):
+    lua_dir = synapse_tools_config['lua_dir']
+    file_path = os.path.join(lua_dir, 'path_based_routing.lua')
+    return ['lua-load %s' % file_path]
+
+
 class PathBasedRouting(HAProxyConfigPlugin):
     def __init__(self, service_name, service_info, synapse_tools_config):
         super(PathBasedRouting, self).__init__(
@@ -9,16 +15,24 @@ class PathBasedRouting(HAProxyConfigPlugin):
         )
 
         global_enabled = self.synapse_tools_config.get('path_based_routing', {}).get('enabled', False)
-        svc_enabled = self.plugins.get('path_based_routing', {}).get('enabled', False)
-        self.enabled = svc_enabled or global_enabled
+        self.svc_enabled = self.plugins.get('path_based_routing', {}).get('enabled', False)
+        self.enabled = self.svc_enabled or global_enabled
 
-    def global_options(self):
-        if not self.enabled:
+    @classmethod
+    def run_global_options(cls, synapse_tools_config):
+        if not synapse_tools_config.get('path_based_routing', {}).get('enabled', False):
             return []
+        return _global_options(synapse_tools_config)
 
-        lua_dir = self.synapse_tools_config['lua_dir']
-        file_path = os.path.join(lua_dir, 'path_based_routing.lua')
-        return ['lua-load %s' % file_path]
+    @classmethod
+    def service_options_key(cls, service_name, service_info):
+        return service_info.plugins.get('path_based_routing', {}).get('enabled', False)
+
+    def global_options(self):
+        # Enabling routing globally is handled by run_global_options
+        if not self.svc_enabled:
+            return []
+        return _global_options(self.synapse_tools_config)
 
     def frontend_options(self):
         if not self.enabled:
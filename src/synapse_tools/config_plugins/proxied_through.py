@@ -2,15 +2,23 @@ from synapse_tools.config_plugins.base import HAProxyConfigPlugin
 
 
 class ProxiedThrough(HAProxyConfigPlugin):
+    @classmethod
+    def service_options_key(cls, service_name, service_info):
+        # The options of services which are neither proxied nor a proxy
+        # are all empty, the others depend on the service name
+        if service_info.proxied_through is None and not service_info.is_proxy:
+            return ()
+        return None
+
     def global_options(self):
         return []
 
     def frontend_options(self):
-        if self.service_info.get('proxied_through') is None:
+        proxied_through = self.service_info.proxied_through
+        if proxied_through is None:
             return []
 
-        proxied_through = self.service_info.get('proxied_through')
-        healthcheck_uri = self.service_info.get('healthcheck_uri', '/status')
+        healthcheck_uri = self.service_info.healthcheck_uri
 
         return [
             'acl is_status_request path {healthcheck_uri}'.format(
@@ -32,10 +40,10 @@ class ProxiedThrough(HAProxyConfigPlugin):
 
     def backend_options(self):
         # We are not a proxy for someone else
-        if not self.service_info.get('is_proxy', False):
+        if not self.service_info.is_proxy:
             return []
 
-        healthcheck_uri = self.service_info.get('healthcheck_uri', '/status')
+        healthcheck_uri = self.service_info.healthcheck_uri
         service_name = self.service_name
 
         return [
@@ -1,29 +1,141 @@
 """Update the synapse configuration file and restart synapse if anything has
 changed."""
 
-import copy
-import filecmp
+import contextlib
+import hashlib
 import json
+import logging
 import os
-import shutil
+import re
 import socket
 import subprocess
-import tempfile
+import time
 
-import yaml
+import argparse
 import synapse_tools
-from environment_tools.type_utils import available_location_types
-from environment_tools.type_utils import compare_types
-from environment_tools.type_utils import get_current_location
-from paasta_tools.marathon_tools import get_all_namespaces
+from synapse_tools import config_artifacts
+from synapse_tools import config_diff
+from synapse_tools import server_slots
+from synapse_tools import timing
+from synapse_tools.atomic_file import is_temporary_file
+from synapse_tools.atomic_file import write_atomically
+from synapse_tools.backend_activity import BackendActivity
+from synapse_tools.backend_activity import get_health_commands
+from synapse_tools.backend_subset import get_address_subset
+from synapse_tools.backend_subset import get_subset_commands
+from synapse_tools.catalog_cache import CatalogCache
 from synapse_tools.config_plugins.registry import PLUGIN_REGISTRY
-from synapse_tools.haproxy_synapse_reaper import DEFAULT_REAP_AGE_S
-from yaml import CLoader
+from synapse_tools.inotify import Inotify
+from synapse_tools.restart_scheduler import get_host_jitter_s
+from synapse_tools.restart_scheduler import RestartScheduler
+from synapse_tools.service_config import ServiceConfig
+
+# environment_tools, paasta_tools and yaml are only imported when they are
+# first used: importing them takes longer than generating the configuration
+# when nothing has changed. See tests/entry_points_test.py.
+
+
+# Bump this whenever a change to this module or to the plugins changes the
+# watchers rendered for an unchanged service, so that entries written to the
+# render cache by an older version are not reused.
+RENDER_CACHE_VERSION = 2
+
+# How long the daemon waits for a burst of changes to settle
+DEFAULT_DEBOUNCE_S = 5
+
+# How often the daemon updates the synapse config when nothing changed, as
+# often as configure_synapse used to run from cron: our monitoring checks the
+# age of the config file
+DAEMON_REFRESH_INTERVAL_S = 60
+
+# How soon the daemon tries again after failing to update the synapse config
+DAEMON_RETRY_INTERVAL_S = 10
+
+# How often the daemon puts the servers outside of the backend subsets back
+# in maintenance, after synapse reloaded HAProxy
+BACKEND_SUBSET_INTERVAL_S = 60
+
+# HAProxy only has the server slots once synapse restarted it with them. A
+# run which restarted synapse waits this long for them, checking every
+# SERVER_SLOTS_RETRY_INTERVAL_S, and the daemon checks as often until then.
+SERVER_SLOTS_TIMEOUT_S = 30
+SERVER_SLOTS_RETRY_INTERVAL_S = 2
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+log = logging.getLogger(__name__)
+
+
+def available_location_types():
+    from environment_tools.type_utils import available_location_types
+    return available_location_types()
+
+
+def get_current_location(location_type):
+    from environment_tools.type_utils import get_current_location
+    return get_current_location(location_type)
+
+
+def get_all_namespaces(soa_dir, catalog_cache=None, pool=None):
+    if pool is not None:
+        catalog_cache = catalog_cache or CatalogCache()
+    if catalog_cache is not None:
+        return catalog_cache.get_all_namespaces(soa_dir, pool=pool)
+    from paasta_tools.marathon_tools import get_all_namespaces
+    return get_all_namespaces(soa_dir=soa_dir)
+
+
+class HostFacts(object):
+    """Everything about this host that the generated configuration depends
+    on: its hostname, the location type hierarchy, and its location and
+    grouping for each type.
+
+    Locations and groupings are looked up the first time they are asked for
+    and never change afterwards, so a single HostFacts is meant to be built
+    once per run and shared by everything that needs them. They can also be
+    passed in up front to describe a host other than this one.
+    """
+
+    def __init__(self, hostname, location_types, locations=None, groupings=None):
+        self.hostname = hostname
+        # From the most general type to the most specific one
+        self.location_types = tuple(location_types)
+        self.location_depth = {
+            typ: depth for depth, typ in enumerate(self.location_types)
+        }
+        self._locations = dict(locations or {})
+        self._groupings = dict(groupings or {})
+
+    @classmethod
+    def from_host(cls):
+        return cls(
+            hostname=socket.gethostname(),
+            location_types=available_location_types(),
+        )
+
+    def compare_types(self, typ_1, typ_2):
+        """Same as environment_tools.type_utils.compare_types: negative, zero
+        or positive if typ_1 is more, equally or less general than typ_2."""
+        return self.location_depth[typ_1] - self.location_depth[typ_2]
+
+    def location(self, location_type):
+        if location_type not in self._locations:
+            self._locations[location_type] = get_current_location(location_type)
+        return self._locations[location_type]
+
+    def grouping(self, grouping_type):
+        if grouping_type not in self._groupings:
+            self._groupings[grouping_type] = get_my_grouping(grouping_type)
+        return self._groupings[grouping_type]
 
 
 def get_config(synapse_tools_config_path):
     with open(synapse_tools_config_path) as synapse_config:
-        return set_defaults(json.load(synapse_config))
+        config = set_defaults(json.load(synapse_config))
+    if config['rendered_config_dir'] and config['service_dependencies_path']:
+        # The rendered configs have the watchers of every service
+        raise ValueError('rendered_config_dir cannot be used with service_dependencies_path')
+    return config
 
 
 def set_defaults(config):
@@ -57,11 +169,93 @@ def set_defaults(config):
         ('synapse_command', ['service', 'synapse']),
         ('zookeeper_topology_path',
             '/nail/etc/zookeeper_discovery/infrastructure/local.yaml'),
+        ('soa_dir', '/nail/etc/services'),
         ('hacheck_port', 6666),
         ('stats_port', 3212),
         ('lua_dir', os.path.join(os.path.dirname(synapse_tools.__file__), 'lua_scripts')),
         ('map_dir', '/var/run/synapse/maps/'),
         ('logging', {'enabled': False}),
+        # Set to a file path to keep the rendered watchers of each service
+        # between runs and only re-render the services that have changed
+        ('render_cache_path', None),
+        # Number of processes rendering the services, only worth it for very
+        # large numbers of services
+        ('render_processes', 1),
+        # Set to a file path to keep the namespaces read from each service's
+        # smartstack.yaml (or service.yaml) between runs and only parse the
+        # changed files
+        ('catalog_cache_path', None),
+        # Number of processes parsing the smartstack.yaml files, while the
+        # services parsed so far are already being rendered
+        ('namespace_loader_processes', 0),
+        # Where to record the digest of the synapse config file, defaults to
+        # the config file path with a .sha256 suffix
+        ('config_digest_path', None),
+        # Write the synapse config file without indentation
+        ('compact_config_file', False),
+        # Apply changes which only touch settings HAProxy can change at
+        # runtime (maxconn) through its stats socket instead of restarting
+        # synapse. Synapse keeps using the values it was started with
+        # whenever it reloads HAProxy, so they are applied again by the
+        # following runs until synapse is next restarted.
+        ('haproxy_runtime_updates', False),
+        # Restart synapse at most once every restart_min_interval_s, and
+        # only restart_coalesce_window_s after the first change that needs
+        # it, so that the changes in the meantime are picked up as well. The
+        # pending restart is kept at restart_state_path, which defaults to
+        # the config file path with a .restart suffix.
+        ('restart_min_interval_s', 0),
+        ('restart_coalesce_window_s', 0),
+        # Delay restarts by a further [0, restart_jitter_window_s), which is
+        # fixed for each host, so that a change rolled out to every host at
+        # once does not reconnect all of them to ZooKeeper at once
+        ('restart_jitter_window_s', 0),
+        ('restart_state_path', None),
+        # Stop the health checks of the servers of the backends which did
+        # not get a session for cold_backend_idle_s, through the HAProxy stats
+        # socket, which does not restart synapse. They are started again
+        # once the backend gets traffic. The session counters are kept at
+        # backend_activity_path, which defaults to the config file path with
+        # a .activity suffix.
+        ('cold_backend_idle_s', 0),
+        ('backend_activity_path', None),
+        # Do not generate the watchers of the backends more specific than
+        # where a service is discovered, which its frontend never routes to.
+        # Each watcher is a separate ZooKeeper watch of the service.
+        ('skip_unrouted_backends', False),
+        # Disable the HAProxy backend of a location tier of a service when
+        # synapse last saw the same servers in it as in the more specific
+        # tier its frontend routes to before it. The watcher is kept, so
+        # that synapse keeps writing the tier's servers to file_output_path
+        # and the backend is enabled again once they differ. That takes a
+        # synapse restart, so it is delayed by the restart_* options.
+        ('collapse_identical_backends', False),
+        # Generate the backends of the location tiers other than the one a
+        # service is discovered in as HAProxy server-template slots, and
+        # assign the servers synapse writes to file_output_path to them
+        # through the stats socket, so that their membership changes do not
+        # reload HAProxy. Needs HAProxy 1.8, and haproxy_state_file_path
+        # with a reload command which saves the server state to it, for the
+        # slots to keep their servers across reloads.
+        ('haproxy_server_slots', False),
+        # Where to write a JSON summary of how long each phase of a run took,
+        # and/or a host:port to send it to as statsd timers
+        ('timing_summary_path', None),
+        ('timing_statsd_address', None),
+        ('timing_statsd_prefix', 'synapse_tools.configure_synapse'),
+        # Use the config rendered for this host by synapse_batch_render in
+        # this directory, as long as it was rendered from the same config
+        # and ZooKeeper topology, at most rendered_config_max_age_s ago.
+        # The config is rendered locally otherwise. It cannot be used with
+        # service_dependencies_path.
+        ('rendered_config_dir', None),
+        ('rendered_config_max_age_s', 3600),
+        # Only render the services listed in the JSON file at
+        # service_dependencies_path (as service or service.namespace), the
+        # ones this host's workloads talk to, plus always_rendered_services.
+        # Every service is rendered if the file cannot be read.
+        ('service_dependencies_path', None),
+        ('always_rendered_services', []),
         # NGINX related options
         ('listen_with_nginx', False),
         ('nginx_path', '/usr/sbin/nginx'),
@@ -93,6 +287,9 @@ def set_defaults(config):
 
 
 def get_zookeeper_topology(zookeeper_topology_path):
+    import yaml
+    from yaml import CLoader
+
     with open(zookeeper_topology_path) as fp:
         zookeeper_topology = yaml.load(fp, Loader=CLoader)
     zookeeper_topology = [
@@ -140,7 +337,14 @@ def _generate_nginx_top_level(synapse_tools_config):
     }
 
 
-def _generate_haproxy_top_level(synapse_tools_config):
+def get_server_order_seed(hostname):
+    """Seeds the order of the servers of each backend, so that every host
+    orders them differently"""
+    return hash(hostname)
+
+
+def _generate_haproxy_top_level(synapse_tools_config, host_facts=None):
+    hostname = host_facts.hostname if host_facts else socket.gethostname()
     haproxy_inter = synapse_tools_config['haproxy.defaults.inter']
     top_level = {
         'bind_address': synapse_tools_config['bind_addr'],
@@ -154,7 +358,7 @@ def _generate_haproxy_top_level(synapse_tools_config):
         'do_writes': True,
         'do_reloads': True,
         'do_socket': True,
-        'server_order_seed': hash(socket.gethostname()),
+        'server_order_seed': get_server_order_seed(hostname),
 
         'global': [
             'daemon',
@@ -261,13 +465,12 @@ def _generate_haproxy_top_level(synapse_tools_config):
     return top_level
 
 
-def generate_base_config(synapse_tools_config):
-    synapse_tools_config = synapse_tools_config
+def generate_base_config(synapse_tools_config, host_facts=None):
     base_config = {
         # We'll fill this section in
         'services': {},
         'file_output': {'output_directory': synapse_tools_config['file_output_path']},
-        'haproxy': _generate_haproxy_top_level(synapse_tools_config)
+        'haproxy': _generate_haproxy_top_level(synapse_tools_config, host_facts),
     }
 
     if synapse_tools_config['listen_with_nginx']:
@@ -296,6 +499,31 @@ def generate_base_config(synapse_tools_config):
     return base_config
 
 
+class SectionBuilder(object):
+    """Appends options to the list of lines of an HAProxy config section,
+    skipping the ones it already contains.
+
+    The list is modified in place and stays a plain list, so it can be
+    dumped as is; the builder only adds a set of the lines for constant time
+    membership checks.
+    """
+
+    __slots__ = ('lines', '_seen')
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._seen = set(lines)
+
+    def __contains__(self, line):
+        return line in self._seen
+
+    def extend(self, lines):
+        for line in lines:
+            if line not in self._seen:
+                self._seen.add(line)
+                self.lines.append(line)
+
+
 def get_backend_name(service_name, discover_type, advertise_type):
     if advertise_type == discover_type:
         return service_name
@@ -315,11 +543,11 @@ def _get_socket_path(synapse_tools_config, service_name, proxy_proto=False):
     return socket_path
 
 
-def generate_acls_for_service(service_name, discover_type, advertise_types):
+def generate_acls_for_service(service_name, discover_type, advertise_types, host_facts):
     frontend_acl_configs = []
 
     for advertise_type in advertise_types:
-        if compare_types(discover_type, advertise_type) < 0:
+        if host_facts.compare_types(discover_type, advertise_type) < 0:
             # don't create acls that downcast requests
             continue
 
@@ -343,147 +571,491 @@ def generate_acls_for_service(service_name, discover_type, advertise_types):
     return frontend_acl_configs
 
 
-def generate_configuration(synapse_tools_config, zookeeper_topology, services):
-    synapse_config = generate_base_config(synapse_tools_config)
-    available_locations = available_location_types()
-    location_depth_mapping = {
-        loc: depth
-        for depth, loc in enumerate(available_locations)
-    }
-    available_locations = set(available_locations)
+def _get_service_fingerprint(run_hash, service_name, service_info, labels, groupings):
+    """Return a stable digest of everything that the watchers rendered for
+    a service depend on, given the hash of the run-wide inputs.
 
-    for (service_name, service_info) in services:
-        proxy_port = service_info.get('proxy_port', -1)
-        # If we end up with the default value or a negative number in general,
-        # then we know that the service does not want to be in SmartStack
-        if proxy_port is not None and proxy_port < 0:
-            continue
-        # Note that at this point proxy_port can be:
-        # * valid number: Wants Load balancing (HAProxy/Nginx)
-        # * None: Wants discovery, but no load balancing (files)
+    This runs for every service, so the service is dumped without sorting
+    its keys, which only the much slower pure Python encoder can do. Dicts
+    with the same items iterate in the same order unless they were built in
+    a different order, which at worst costs a cache miss.
+    """
+    fingerprint = run_hash.copy()
+    fingerprint.update(json.dumps([service_name, service_info, labels, groupings]))
+    return fingerprint.hexdigest()
 
-        discover_type = service_info.get('discover', 'region')
-        advertise_types = sorted(
-            [
-                advertise_typ
-                for advertise_typ in service_info.get('advertise', ['region'])
-                # don't consider invalid advertise types
-                if advertise_typ in available_locations
-            ],
-            key=lambda typ: location_depth_mapping[typ],
-            reverse=True,  # consider the most specific types first
-        )
-        if discover_type not in advertise_types:
-            return {}
 
-        base_watcher_cfg = base_watcher_cfg_for_service(
-            service_name=service_name,
-            service_info=service_info,
-            zookeeper_topology=zookeeper_topology,
-            synapse_tools_config=synapse_tools_config,
-        )
+def _copy_watcher_cfg(base_watcher_cfg):
+    """Copy a watcher config down to its per-section dicts.
+
+    Everything below that (ZooKeeper hosts, server options, frontend and
+    backend option lists) is shared with base_watcher_cfg, so callers must
+    replace those values instead of modifying them in place.
+    """
+    config = dict(base_watcher_cfg)
+    for section in ('discovery', 'haproxy', 'nginx'):
+        if section in config:
+            config[section] = dict(config[section])
+    return config
+
+
+def _get_plugin_options(plugin_name, service_name, service_info, synapse_tools_config, plugin_options_cache):
+    """Return the (global, frontend, backend) options of a plugin for a
+    service, reusing the ones of an earlier service if the plugin says that
+    they are the same."""
+    plugin_class = PLUGIN_REGISTRY[plugin_name]
+    key = plugin_class.service_options_key(service_name, service_info)
+    if key is not None and (plugin_name, key) in plugin_options_cache:
+        return plugin_options_cache[(plugin_name, key)]
+
+    plugin_instance = plugin_class(
+        service_name,
+        service_info,
+        synapse_tools_config
+    )
+    plugin_options = (
+        plugin_instance.global_options(),
+        plugin_instance.frontend_options(),
+        plugin_instance.backend_options(),
+    )
+    if key is not None:
+        plugin_options_cache[(plugin_name, key)] = plugin_options
+    return plugin_options
 
-        socket_path = _get_socket_path(
-            synapse_tools_config, service_name
-        )
 
-        socket_proxy_path = _get_socket_path(
-            synapse_tools_config, service_name, proxy_proto=True
+def _generate_watchers_for_service(
+    service_name, service_info, discover_type, advertise_types, labels,
+    zookeeper_topology, synapse_tools_config, host_facts, plugin_options_cache,
+):
+    """Render every synapse watcher belonging to a single service, whose
+    config is given as a ServiceConfig.
+
+    Returns a dict with the watchers keyed by name under 'watchers', and the
+    HAProxy global section options of each plugin (in registry order) under
+    'global', so that they can be merged into the run-wide global section.
+
+    plugin_options_cache is shared by all services of a run, see
+    HAProxyConfigPlugin.service_options_key.
+    """
+    proxy_port = service_info.proxy_port
+    watchers = {}
+    global_options = []
+
+    base_watcher_cfg = base_watcher_cfg_for_service(
+        service_name=service_name,
+        service_info=service_info,
+        zookeeper_topology=zookeeper_topology,
+        synapse_tools_config=synapse_tools_config,
+        host_facts=host_facts,
+    )
+
+    socket_path = _get_socket_path(
+        synapse_tools_config, service_name
+    )
+
+    socket_proxy_path = _get_socket_path(
+        synapse_tools_config, service_name, proxy_proto=True
+    )
+
+    if synapse_tools_config['skip_unrouted_backends']:
+        # The same backends as the ACLs route to
+        watched_types = [
+            advertise_type for advertise_type in advertise_types
+            if host_facts.compare_types(discover_type, advertise_type) >= 0
+        ]
+    else:
+        watched_types = advertise_types
+
+    for advertise_type in watched_types:
+        backend_identifier = get_backend_name(
+            service_name, discover_type, advertise_type
         )
+        config = _copy_watcher_cfg(base_watcher_cfg)
+
+        config['discovery']['label_filters'] = [
+            {
+                'label': labels[advertise_type],
+                'value': '',
+                'condition': 'equals',
+            },
+        ]
+
+        if proxy_port is None:
+            config['haproxy'] = {'disabled': True}
+            if synapse_tools_config['listen_with_nginx']:
+                config['nginx'] = {'disabled': True}
+        else:
+            if advertise_type == discover_type:
+                # Specify a proxy port to create a frontend for this service
+                if synapse_tools_config['listen_with_haproxy']:
+                    config['haproxy']['port'] = str(proxy_port)
+                    config['haproxy']['frontend'] = config['haproxy']['frontend'] + [
+                        'bind {0}'.format(socket_path),
+                        'bind {0} accept-proxy'.format(socket_proxy_path),
+                    ]
+                # If listen_with_haproxy is False, then have
+                # HAProxy bind only to the socket. Nginx may or may not
+                # be listening on ports based on listen_with_nginx values
+                # at this stage.
+                else:
+                    config['haproxy']['port'] = None
+                    config['haproxy']['bind_address'] = socket_path
+                    config['haproxy']['frontend'] = config['haproxy']['frontend'] + [
+                        'bind {0} accept-proxy'.format(socket_proxy_path),
+                    ]
+                # The plugins and the ACLs below extend the frontend and
+                # backend of this watcher, so it must not share them
+                config['haproxy']['backend'] = list(config['haproxy']['backend'])
+            else:
+                # The backend only watchers don't need frontend
+                # because they have no listen port, so Synapse doens't
+                # generate a frontend section for them at all
+                del config['haproxy']['frontend']
+            config['haproxy']['backend_name'] = backend_identifier
+
+        watchers[backend_identifier] = config
+
+    if proxy_port is not None:
+        # If nginx is supported, include a single additional static
+        # service watcher per service that listens on the right port and
+        # proxies back to the unix socket exposed by HAProxy
+        if synapse_tools_config['listen_with_nginx']:
+            listener_name = '{0}.nginx_listener'.format(service_name)
+            watchers[listener_name] = _generate_nginx_for_watcher(
+                service_name, service_info, synapse_tools_config
+            )
 
-        for advertise_type in advertise_types:
-            backend_identifier = get_backend_name(
-                service_name, discover_type, advertise_type
+        # Add HAProxy options for plugins
+        frontend = SectionBuilder(watchers[service_name]['haproxy']['frontend'])
+        backend = SectionBuilder(watchers[service_name]['haproxy']['backend'])
+        for plugin_name in PLUGIN_REGISTRY:
+            plugin_global, plugin_frontend, plugin_backend = _get_plugin_options(
+                plugin_name, service_name, service_info, synapse_tools_config,
+                plugin_options_cache,
             )
-            config = copy.deepcopy(base_watcher_cfg)
-
-            config['discovery']['label_filters'] = [
-                {
-                    'label': '%s:%s' % (advertise_type, get_current_location(advertise_type)),
-                    'value': '',
-                    'condition': 'equals',
-                },
-            ]
+            frontend.extend(plugin_frontend)
+            backend.extend(plugin_backend)
+            global_options.append(plugin_global)
+
+        # TODO(jlynch|2017-08-15): move this to a plugin!
+        # populate the ACLs to route to the service backends, this must
+        # happen last because ordering of use_backend ACLs matters.
+        watchers[service_name]['haproxy']['frontend'].extend(
+            generate_acls_for_service(
+                service_name=service_name,
+                discover_type=discover_type,
+                advertise_types=advertise_types,
+                host_facts=host_facts,
+            )
+        )
 
-            if proxy_port is None:
-                config['haproxy'] = {'disabled': True}
-                if synapse_tools_config['listen_with_nginx']:
-                    config['nginx'] = {'disabled': True}
-            else:
-                if advertise_type == discover_type:
-                    # Specify a proxy port to create a frontend for this service
-                    if synapse_tools_config['listen_with_haproxy']:
-                        config['haproxy']['port'] = str(proxy_port)
-                        config['haproxy']['frontend'].extend(
-                            [
-                                'bind {0}'.format(socket_path),
-                                'bind {0} accept-proxy'.format(socket_proxy_path),
-                            ]
-                        )
-                    # If listen_with_haproxy is False, then have
-                    # HAProxy bind only to the socket. Nginx may or may not
-                    # be listening on ports based on listen_with_nginx values
-                    # at this stage.
-                    else:
-                        config['haproxy']['port'] = None
-                        config['haproxy']['bind_address'] = socket_path
-                        config['haproxy']['frontend'].append(
-                            'bind {0} accept-proxy'.format(socket_proxy_path)
-                        )
-                else:
-                    # The backend only watchers don't need frontend
-                    # because they have no listen port, so Synapse doens't
-                    # generate a frontend section for them at all
-                    del config['haproxy']['frontend']
-                config['haproxy']['backend_name'] = backend_identifier
-
-            synapse_config['services'][backend_identifier] = config
-
-        if proxy_port is not None:
-            # If nginx is supported, include a single additional static
-            # service watcher per service that listens on the right port and
-            # proxies back to the unix socket exposed by HAProxy
-            if synapse_tools_config['listen_with_nginx']:
-                listener_name = '{0}.nginx_listener'.format(service_name)
-                synapse_config['services'][listener_name] = (
-                    _generate_nginx_for_watcher(
-                        service_name, service_info, synapse_tools_config
-                    )
-                )
+    return {'watchers': watchers, 'global': global_options}
 
-            # Add HAProxy options for plugins
-            for plugin_name in PLUGIN_REGISTRY:
-                plugin_instance = PLUGIN_REGISTRY[plugin_name](
-                    service_name,
-                    service_info,
-                    synapse_tools_config
-                )
-                config_to_opts = [
-                    (synapse_config['services'][service_name]['haproxy']['frontend'],
-                     plugin_instance.frontend_options()),
-                    (synapse_config['services'][service_name]['haproxy']['backend'],
-                     plugin_instance.backend_options()),
-                    (synapse_config['haproxy']['global'],
-                     plugin_instance.global_options())
-                ]
-                for (config, opts) in config_to_opts:
-                    config.extend([x for x in opts if x not in config])
-
-            # TODO(jlynch|2017-08-15): move this to a plugin!
-            # populate the ACLs to route to the service backends, this must
-            # happen last because ordering of use_backend ACLs matters.
-            synapse_config['services'][service_name]['haproxy']['frontend'].extend(
-                generate_acls_for_service(
-                    service_name=service_name,
-                    discover_type=discover_type,
-                    advertise_types=advertise_types,
-                )
+
+# The arguments shared by all the services rendered by a worker process
+_worker_render_args = None
+
+
+def _init_render_worker(zookeeper_topology, synapse_tools_config, host_facts):
+    global _worker_render_args
+    _worker_render_args = {
+        'zookeeper_topology': zookeeper_topology,
+        'synapse_tools_config': synapse_tools_config,
+        'host_facts': host_facts,
+        'plugin_options_cache': {},
+    }
+
+
+def _render_services_in_worker(jobs):
+    return [
+        _generate_watchers_for_service(**dict(job, **_worker_render_args))
+        for job in jobs
+    ]
+
+
+class ServiceRenderer(object):
+    """Renders the watchers of services as they are submitted, either right
+    away or in a pool of processes.
+
+    :param render_args: the kwargs for _generate_watchers_for_service which
+        are the same for every service
+    :param processes: number of processes to render in, the pool is only
+        started once there is something to render
+    """
+
+    # Services are sent to the pool in chunks of this many, so that the
+    # workers can start while services are still being submitted
+    CHUNK_SIZE = 64
+
+    def __init__(self, render_args, processes=1):
+        self.render_args = render_args
+        self.processes = processes
+        self._pool = None
+        self._chunk = []
+        # Lists of rendered services, or AsyncResults of them
+        self._rendered = []
+
+    def submit(self, job):
+        """:param job: the per-service kwargs for _generate_watchers_for_service"""
+        if self.processes <= 1:
+            self._rendered.append([
+                _generate_watchers_for_service(**dict(job, **self.render_args))
+            ])
+            return
+        self._chunk.append(job)
+        if len(self._chunk) >= self.CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._chunk:
+            return
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(
+                self.processes,
+                initializer=_init_render_worker,
+                initargs=(
+                    self.render_args['zookeeper_topology'],
+                    self.render_args['synapse_tools_config'],
+                    self.render_args['host_facts'],
+                ),
             )
+        self._rendered.append(self._pool.apply_async(_render_services_in_worker, (self._chunk,)))
+        self._chunk = []
+
+    def results(self):
+        """Wait for and return the rendered services, in submission order"""
+        self._flush()
+        all_rendered = []
+        for rendered in self._rendered:
+            all_rendered.extend(rendered if isinstance(rendered, list) else rendered.get())
+        return all_rendered
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def generate_configuration(
+    synapse_tools_config, zookeeper_topology, services, render_cache=None,
+    host_facts=None, processes=1, prune_render_cache=True, subset_sizes=None,
+):
+    """Generate the synapse configuration for the given services.
+
+    The configuration is generated for the host described by host_facts, by
+    default the current host.
+
+    If a render_cache dict is passed (see load_render_cache), services whose
+    fingerprint is found in it reuse their previously rendered watchers
+    instead of being rendered again. The cache is updated in place: entries
+    for services rendered in this run are added and, unless
+    prune_render_cache is False, all other entries are dropped.
+
+    services can be an iterator, services are rendered while it produces the
+    following ones. With processes > 1 they are rendered by a pool of that
+    many processes. The result is the same as when rendering them serially.
+
+    If a subset_sizes dict is passed, the subset_size of the backends of the
+    services which have one is added to it, see apply_backend_subsets.
+    """
+    if host_facts is None:
+        host_facts = HostFacts.from_host()
+    synapse_config = generate_base_config(synapse_tools_config, host_facts)
+    location_depth_mapping = host_facts.location_depth
+    global_section = SectionBuilder(synapse_config['haproxy']['global'])
+    # Added in place of the options of the first service which does not have
+    # its own for the plugin, None once they were
+    run_global_options = [
+        plugin_class.run_global_options(synapse_tools_config)
+        for plugin_class in PLUGIN_REGISTRY.values()
+    ]
+
+    if render_cache is not None:
+        run_hash = hashlib.sha1(json.dumps(
+            [RENDER_CACHE_VERSION, synapse_tools_config, zookeeper_topology],
+            sort_keys=True,
+        ))
+        used_fingerprints = set()
+
+    # [proxy_port, rendered] of each service, in order
+    service_results = []
+    # (index in service_results, fingerprint) of the services which are
+    # rendered in this run
+    render_jobs = []
+
+    # Services are rendered while the following ones are still being read
+    renderer = ServiceRenderer(
+        render_args={
+            'zookeeper_topology': zookeeper_topology,
+            'synapse_tools_config': synapse_tools_config,
+            'host_facts': host_facts,
+            'plugin_options_cache': {},
+        },
+        processes=processes,
+    )
+    try:
+        for (service_name, service_info) in services:
+            proxy_port = service_info.get('proxy_port', -1)
+            # If we end up with the default value or a negative number in general,
+            # then we know that the service does not want to be in SmartStack
+            if proxy_port is not None and proxy_port < 0:
+                continue
+            # Only validated once we know that it is in SmartStack
+            service = ServiceConfig(service_name, service_info)
+
+            discover_type = service.discover
+            advertise_types = sorted(
+                [
+                    advertise_typ
+                    for advertise_typ in service.advertise
+                    # don't consider invalid advertise types
+                    if advertise_typ in location_depth_mapping
+                ],
+                key=lambda typ: location_depth_mapping[typ],
+                reverse=True,  # consider the most specific types first
+            )
+            if discover_type not in advertise_types:
+                return {}
+
+            labels = {
+                advertise_type: '%s:%s' % (advertise_type, host_facts.location(advertise_type))
+                for advertise_type in advertise_types
+            }
+
+            if subset_sizes is not None and service.subset_size:
+                for advertise_type in advertise_types:
+                    backend_identifier = get_backend_name(service_name, discover_type, advertise_type)
+                    subset_sizes[backend_identifier] = service.subset_size
+
+            rendered = None
+            fingerprint = None
+            if render_cache is not None:
+                groupings = {
+                    grouping_type: host_facts.grouping(grouping_type)
+                    for grouping_type in service.chaos
+                }
+                fingerprint = _get_service_fingerprint(
+                    run_hash, service_name, service_info, labels, groupings,
+                )
+                used_fingerprints.add(fingerprint)
+                rendered = render_cache.get(fingerprint)
+
+            if rendered is None:
+                renderer.submit({
+                    'service_name': service_name,
+                    'service_info': service,
+                    'discover_type': discover_type,
+                    'advertise_types': advertise_types,
+                    'labels': labels,
+                })
+                render_jobs.append((len(service_results), fingerprint))
+            service_results.append([proxy_port, rendered])
+
+        all_rendered = renderer.results()
+    finally:
+        renderer.close()
+
+    for (i, fingerprint), rendered in zip(render_jobs, all_rendered):
+        service_results[i][1] = rendered
+        if render_cache is not None:
+            render_cache[fingerprint] = rendered
+
+    for proxy_port, rendered in service_results:
+        synapse_config['services'].update(rendered['watchers'])
+        # In plugin registry order, so that the global section is the same
+        # as when each service added all of its plugin options
+        for i, opts in enumerate(rendered['global']):
+            if opts:
+                global_section.extend(opts)
+            elif run_global_options[i] is not None:
+                global_section.extend(run_global_options[i])
+                run_global_options[i] = None
+
+    if render_cache is not None and prune_render_cache:
+        for fingerprint in set(render_cache) - used_fingerprints:
+            del render_cache[fingerprint]
 
     return synapse_config
 
 
-def base_watcher_cfg_for_service(service_name, service_info, zookeeper_topology, synapse_tools_config):
+def load_wanted_services(my_config):
+    """The names of the services to render, see service_dependencies_path.
+    None means every service."""
+    service_dependencies_path = my_config['service_dependencies_path']
+    if not service_dependencies_path:
+        return None
+    try:
+        with open(service_dependencies_path) as fp:
+            service_dependencies = json.load(fp)
+    except (IOError, ValueError) as e:
+        log.warning('Rendering every service, could not read the service dependencies: %s', e)
+        return None
+    return set(service_dependencies) | set(my_config['always_rendered_services'])
+
+
+def select_services(services, wanted_services):
+    """Generate the namespaces whose service.namespace or service name is in
+    wanted_services, and those the generated ones are proxied through since
+    their frontends route to them.
+
+    The namespaces are filtered as they are read, and keep their order but
+    for proxies read before the first namespace proxied through them, which
+    come right after it. Until then the namespaces which were not selected
+    are kept aside.
+    """
+    selected = set()
+    wanted_proxies = set()
+    skipped = {}
+    for service_name, service_info in services:
+        if not (
+            service_name in wanted_services or
+            service_name.split('.', 1)[0] in wanted_services or
+            service_name in wanted_proxies
+        ):
+            skipped[service_name] = service_info
+            continue
+
+        # Follow the chain of proxies as far as it was read
+        while True:
+            selected.add(service_name)
+            yield service_name, service_info
+            proxied_through = service_info.get('proxied_through')
+            if proxied_through is None or proxied_through in selected:
+                break
+            if proxied_through not in skipped:
+                wanted_proxies.add(proxied_through)
+                break
+            service_name, service_info = proxied_through, skipped.pop(proxied_through)
+
+
+def load_render_cache(render_cache_path):
+    """Load the per-service render cache written by a previous run.
+
+    A missing, unreadable or outdated cache file results in an empty cache,
+    which just means that every service gets rendered again.
+    """
+    try:
+        with open(render_cache_path) as fp:
+            render_cache = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+    if render_cache.get('version') != RENDER_CACHE_VERSION:
+        return {}
+    return render_cache['services']
+
+
+def save_render_cache(render_cache_path, render_cache):
+    # A concurrent or interrupted run must never see a partially written cache
+    write_atomically(render_cache_path, json.dumps(
+        {'version': RENDER_CACHE_VERSION, 'services': render_cache},
+        sort_keys=True, separators=(',', ':'),
+    ))
+
+
+def base_watcher_cfg_for_service(service_name, service_info, zookeeper_topology, synapse_tools_config, host_facts):
     discovery = {
         'method': 'zookeeper',
         'path': '/smartstack/global/%s' % service_name,
@@ -494,9 +1066,9 @@ def base_watcher_cfg_for_service(service_name, service_info, zookeeper_topology,
         service_name, service_info, synapse_tools_config
     )
 
-    chaos = service_info.get('chaos')
+    chaos = service_info.chaos
     if chaos:
-        frontend_chaos, discovery = chaos_options(chaos, discovery)
+        frontend_chaos, discovery = chaos_options(chaos, discovery, host_facts)
         haproxy['frontend'].extend(frontend_chaos)
 
     # Now write the actual synapse service entry
@@ -529,19 +1101,9 @@ def _generate_captured_request_headers(synapse_tools_config):
 
 
 def _generate_haproxy_for_watcher(service_name, service_info, synapse_tools_config):
-    # Note that validations of all the following config options are done in
-    # config post-receive so invalid config should never get here
-
-    # If the service sets one timeout but not the other, set both
-    # as per haproxy best practices.
-    default_timeout = max(
-        service_info.get('timeout_client_ms'),
-        service_info.get('timeout_server_ms')
-    )
-
     # Server options
     # Things that get appended to each server line in HAProxy
-    mode = service_info.get('mode', 'http')
+    mode = service_info.mode
     if mode == 'http':
         server_options = 'check port %d observe layer7 maxconn %d maxqueue %d'
     else:
@@ -556,9 +1118,7 @@ def _generate_haproxy_for_watcher(service_name, service_info, synapse_tools_conf
     # All things related to the listening sockets on HAProxy
     # These are what clients connect to
     frontend_options = []
-    timeout_client_ms = service_info.get(
-        'timeout_client_ms', default_timeout
-    )
+    timeout_client_ms = service_info.timeout_client_ms
     if timeout_client_ms is not None:
         frontend_options.append('timeout client %dms' % timeout_client_ms)
 
@@ -573,11 +1133,11 @@ def _generate_haproxy_for_watcher(service_name, service_info, synapse_tools_conf
     # All things related to load balancing to backend servers
     backend_options = []
 
-    balance = service_info.get('balance')
+    balance = service_info.balance
     if balance is not None and balance in ('leastconn', 'roundrobin'):
         backend_options.append('balance %s' % balance)
 
-    keepalive = service_info.get('keepalive', False)
+    keepalive = service_info.keepalive
     if keepalive and mode == 'http':
         backend_options.extend([
             'no option forceclose',
@@ -589,52 +1149,32 @@ def _generate_haproxy_for_watcher(service_name, service_info, synapse_tools_conf
         frontend_options.append('mode tcp')
         backend_options.append('mode tcp')
 
-    extra_headers = service_info.get('extra_headers', {})
+    extra_headers = service_info.extra_headers
     for header, value in extra_headers.iteritems():
         backend_options.append('reqidel ^%s:.*' % (header))
     for header, value in extra_headers.iteritems():
         backend_options.append('reqadd %s:\ %s' % (header, value))
 
-    # hacheck healthchecking
-    # Note that we use a dummy port value of '0' here because HAProxy is
-    # passing in the real port using the X-Haproxy-Server-State header.
-    # See SRV-1492 / SRV-1498 for more details.
-    port = 0
-    extra_healthcheck_headers = service_info.get('extra_healthcheck_headers', {})
-
-    if len(extra_healthcheck_headers) > 0:
-        healthcheck_base = 'HTTP/1.1'
-        headers_string = healthcheck_base + ''.join(r'\r\n%s:\ %s' % (k, v) for (k, v) in extra_healthcheck_headers.iteritems())
-    else:
-        headers_string = ""
-
-    healthcheck_uri = service_info.get('healthcheck_uri', '/status')
-    healthcheck_string = r'option httpchk GET /%s/%s/%d/%s %s' % \
-        (mode, service_name, port, healthcheck_uri.lstrip('/'), headers_string)
-
-    healthcheck_string = healthcheck_string.strip()
-    backend_options.append(healthcheck_string)
+    backend_options.append(service_info.healthcheck_option)
 
     backend_options.append('http-check send-state')
 
-    retries = service_info.get('retries')
+    retries = service_info.retries
     if retries is not None:
         backend_options.append('retries %d' % retries)
 
     # Once we are on 1.7, we can remove this entirely
     if synapse_tools_config['haproxy_respect_allredisp']:
-        allredisp = service_info.get('allredisp')
+        allredisp = service_info.allredisp
         if allredisp is not None and allredisp:
             backend_options.append('option allredisp')
 
-    timeout_connect_ms = service_info.get('timeout_connect_ms')
+    timeout_connect_ms = service_info.timeout_connect_ms
 
     if timeout_connect_ms is not None:
         backend_options.append('timeout connect %dms' % timeout_connect_ms)
 
-    timeout_server_ms = service_info.get(
-        'timeout_server_ms', default_timeout
-    )
+    timeout_server_ms = service_info.timeout_server_ms
     if timeout_server_ms is not None:
         backend_options.append('timeout server %dms' % timeout_server_ms)
 
@@ -662,6 +1202,7 @@ def _generate_nginx_for_watcher(service_name, service_info, synapse_tools_config
     # To limit memory usage we set this to the max reap age (so HAProxy will
     # always time out the connection, not NGINX). We add an epsilon of 10
     # just to really really make sure that HAProxy does the error codes
+    from synapse_tools.haproxy_synapse_reaper import DEFAULT_REAP_AGE_S
     timeout = int(DEFAULT_REAP_AGE_S) + 10
     server = ['proxy_timeout {0}s'.format(timeout)]
 
@@ -673,7 +1214,7 @@ def _generate_nginx_for_watcher(service_name, service_info, synapse_tools_config
     # http services. HAProxy is responsible for all layer7 choices
     nginx_config = {
         'mode': 'tcp',
-        'port': service_info['proxy_port'],
+        'port': service_info.proxy_port,
         'server': server,
     }
 
@@ -707,11 +1248,11 @@ def _generate_nginx_for_watcher(service_name, service_info, synapse_tools_config
     return service
 
 
-def chaos_options(chaos_dict, discovery_dict):
+def chaos_options(chaos_dict, discovery_dict, host_facts):
     """ Return a tuple of
     (additional_frontend_options, replacement_discovery_dict) """
 
-    chaos_entries = merge_dict_for_my_grouping(chaos_dict)
+    chaos_entries = merge_dict_for_my_grouping(chaos_dict, host_facts)
     fail = chaos_entries.get('fail')
     delay = chaos_entries.get('delay')
 
@@ -733,7 +1274,7 @@ def chaos_options(chaos_dict, discovery_dict):
     return [], discovery_dict
 
 
-def merge_dict_for_my_grouping(chaos_dict):
+def merge_dict_for_my_grouping(chaos_dict, host_facts):
     """ Given a dictionary where the top-level keys are
     groupings (ecosystem, habitat, etc), merge the subdictionaries
     whose values match the grouping that this host is in.
@@ -753,7 +1294,7 @@ def merge_dict_for_my_grouping(chaos_dict):
     """
     result = {}
     for grouping_type, grouping_dict in chaos_dict.iteritems():
-        my_grouping = get_my_grouping(grouping_type)
+        my_grouping = host_facts.grouping(grouping_type)
         entry = grouping_dict.get(my_grouping, {})
         result.update(entry)
     return result
@@ -764,48 +1305,907 @@ def get_my_grouping(grouping_type):
         return fd.read().strip()
 
 
-def main():
-    my_config = get_config(
-        os.environ.get(
-            'SYNAPSE_TOOLS_CONFIG_PATH', '/etc/synapse/synapse-tools.conf.json'
+def serialize_synapse_config(synapse_config, compact=False):
+    if compact:
+        return json.dumps(synapse_config, sort_keys=True, separators=(',', ':'))
+    return json.dumps(synapse_config, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def _get_config_digest_path(my_config):
+    return my_config['config_digest_path'] or '{0}.sha256'.format(my_config['config_file'])
+
+
+def _stat_key(st):
+    # Anything that rewrites or replaces the file changes at least one of these
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+def _get_current_config_digest(config_path, digest_path):
+    """Return the sha256 of the config file currently in place, or None if
+    there is none.
+
+    The digest we recorded after the last write is trusted as long as the
+    file has not been touched since, otherwise we fall back to hashing it.
+    """
+    try:
+        st = os.stat(config_path)
+    except OSError:
+        return None
+
+    try:
+        with open(digest_path) as fp:
+            recorded = json.load(fp)
+        if recorded['stat'] == _stat_key(st):
+            return recorded['sha256']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(config_path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def _load_current_config(config_path):
+    try:
+        with open(config_path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def _apply_runtime_updates(my_config, runtime_updates):
+    """Apply settings through the HAProxy runtime API.
+
+    :returns: whether all of them could be applied
+    """
+    from synapse_tools.haproxy import runtime_api
+
+    socket_path = my_config['haproxy_socket_file_path']
+    try:
+        servers_by_backend = runtime_api.get_servers_by_backend(socket_path)
+        for command in config_diff.get_runtime_commands(runtime_updates, servers_by_backend):
+            runtime_api.set_command(socket_path, command)
+    except runtime_api.RuntimeApiError as e:
+        log.warning('Could not update HAProxy at runtime: %s', e)
+        return False
+    return True
+
+
+def reapply_runtime_updates(my_config, runtime_updates):
+    """Apply the runtime updates synapse was not restarted for again to the
+    servers which do not have them, since synapse reloads HAProxy and adds
+    new servers with the settings it was started with."""
+    from synapse_tools.haproxy import runtime_api
+
+    socket_path = my_config['haproxy_socket_file_path']
+    try:
+        commands = config_diff.get_outdated_runtime_commands(
+            runtime_updates, runtime_api.show_stat(socket_path),
+        )
+        for command in commands:
+            runtime_api.set_command(socket_path, command)
+    except runtime_api.RuntimeApiError as e:
+        log.warning('Could not apply the runtime updates again: %s', e)
+        return
+    if commands:
+        log.info('Applied %d runtime updates again', len(commands))
+
+
+def _needs_restart(my_config, config_path, new_synapse_config):
+    """Apply the new config in the cheapest way which does not need a
+    restart, if there is one.
+
+    :returns: whether synapse needs to be restarted to pick up the config,
+        and the runtime updates applied instead
+    """
+    change = config_diff.classify_change(
+        _load_current_config(config_path), new_synapse_config,
+    )
+    if change.action == config_diff.NO_ACTION:
+        log.info('Synapse config only changed its encoding, not restarting')
+        return False, []
+
+    if change.action == config_diff.RUNTIME_UPDATE:
+        if my_config['haproxy_runtime_updates'] and \
+                _apply_runtime_updates(my_config, change.runtime_updates):
+            log.info('Applied %d runtime updates, not restarting', len(change.runtime_updates))
+            return False, change.runtime_updates
+        return True, []
+
+    log.info('Restarting synapse: %s', ', '.join(change.reasons))
+    return True, []
+
+
+def restart_synapse(my_config):
+    # backwards compatibility for synapse_restart_command
+    # Note that it's preferable to use synapse_command
+    if 'synapse_restart_command' in my_config:
+        subprocess.check_call(my_config['synapse_restart_command'])
+    else:
+        # Use stop + start so that we re-read the init file
+        # This is useful, for example, to ensure Synapse has good
+        # limits on file descriptors (which means HAProxy will)
+        cmd = my_config['synapse_command']
+        subprocess.check_call(cmd + ['stop'])
+        subprocess.check_call(cmd + ['start'])
+
+
+def update_synapse_config(my_config, new_synapse_config, timer=None):
+    """Write the new synapse config into place and make synapse pick it up if
+    it differs from the current one. Returns whether synapse was restarted."""
+    if timer is None:
+        timer = timing.PhaseTimer()
+    config_path = my_config['config_file']
+    digest_path = _get_config_digest_path(my_config)
+
+    with timer.phase('serialize'):
+        data = serialize_synapse_config(
+            new_synapse_config, compact=my_config['compact_config_file'],
+        )
+        new_digest = hashlib.sha256(data).hexdigest()
+
+    with timer.phase('compare'):
+        changed = new_digest != _get_current_config_digest(config_path, digest_path)
+
+    should_restart = False
+    runtime_updates = []
+    if changed:
+        # Only parse the current config when it has changed
+        with timer.phase('classify'):
+            should_restart, runtime_updates = _needs_restart(my_config, config_path, new_synapse_config)
+
+    with timer.phase('write'):
+        if changed:
+            # Match permissions that puppet expects
+            write_atomically(config_path, data, mode=0o644)
+        else:
+            # Our monitoring system checks the config['config_file'] file age to
+            # ensure that it is continually being updated.
+            os.utime(config_path, None)
+
+        write_atomically(digest_path, json.dumps({
+            'sha256': new_digest,
+            'stat': _stat_key(os.stat(config_path)),
+        }))
+
+    scheduler = load_restart_scheduler(my_config)
+    state = scheduler.state()
+    if (scheduler.pending or scheduler.runtime_updates) and new_digest == scheduler.running_digest:
+        # The changes since the last restart have been reverted
+        scheduler.clear_changes()
+    elif should_restart:
+        scheduler.request_restart(new_digest)
+    elif runtime_updates:
+        scheduler.record_runtime_updates(runtime_updates)
+    if scheduler.state() != state:
+        # Before restarting, so that a failed restart is tried again
+        save_restart_scheduler(my_config, scheduler)
+
+    if scheduler.is_due():
+        with timer.phase('restart'):
+            restart_synapse(my_config)
+        scheduler.record_restart(new_digest)
+        save_restart_scheduler(my_config, scheduler)
+        return True
+    elif scheduler.pending:
+        log.info(
+            'Restarting synapse for %d pending changes in %ds',
+            len(scheduler.pending_digests), scheduler.due_time() - time.time(),
         )
+
+    if scheduler.runtime_updates and not runtime_updates:
+        with timer.phase('runtime_updates'):
+            reapply_runtime_updates(my_config, [
+                config_diff.RuntimeUpdate(*update) for update in scheduler.runtime_updates
+            ])
+    return False
+
+
+def _get_restart_state_path(my_config):
+    return my_config['restart_state_path'] or '{0}.restart'.format(my_config['config_file'])
+
+
+def load_restart_scheduler(my_config):
+    """Load the restart state written by previous runs, a missing or
+    unreadable state file means that no restart is pending."""
+    try:
+        with open(_get_restart_state_path(my_config)) as fp:
+            state = json.load(fp)
+    except (IOError, ValueError):
+        state = None
+    return RestartScheduler(
+        min_interval_s=my_config['restart_min_interval_s'],
+        coalesce_window_s=my_config['restart_coalesce_window_s'],
+        jitter_s=get_host_jitter_s(socket.gethostname(), my_config['restart_jitter_window_s']),
+        state=state,
     )
 
-    new_synapse_config = generate_configuration(
-        my_config,
-        get_zookeeper_topology(
-            my_config['zookeeper_topology_path']
-        ), get_all_namespaces()
+
+def save_restart_scheduler(my_config, scheduler):
+    write_atomically(
+        _get_restart_state_path(my_config),
+        json.dumps(scheduler.state(), sort_keys=True),
     )
 
-    with tempfile.NamedTemporaryFile() as tmp_file:
-        new_synapse_config_path = tmp_file.name
-        with open(new_synapse_config_path, 'w') as fp:
-            json.dump(new_synapse_config, fp, sort_keys=True, indent=4, separators=(',', ': '))
 
-        # Match permissions that puppet expects
-        os.chmod(new_synapse_config_path, 0o644)
+def _get_file_output_servers(file_output_path, watcher_name):
+    """The servers synapse last wrote to the file output of a watcher, None
+    if it has not written any"""
+    try:
+        with open(os.path.join(file_output_path, '{0}.json'.format(watcher_name))) as fp:
+            return {(server['host'], server['port']) for server in json.load(fp)}
+    except (IOError, KeyError, TypeError, ValueError):
+        return None
 
-        # Restart synapse if the config files differ
-        should_restart = not filecmp.cmp(new_synapse_config_path, my_config['config_file'])
 
-        # Always swap new config file into place.  Our monitoring system
-        # checks the config['config_file'] file age to ensure that it is
-        # continually being updated.
-        shutil.copy(new_synapse_config_path, my_config['config_file'])
+_USE_BACKEND_RE = re.compile(r'^use_backend (\S+) if (\S+)_has_connslots$')
+
+
+def collapse_identical_backends(my_config, synapse_config):
+    """Disable the backends of the location tiers of each service which
+    have the same servers as the tier routed to before them, and drop their
+    ACLs. The watchers are replaced, not modified, since they may be shared
+    with the render cache."""
+    services = synapse_config['services']
+    collapsed = []
+    for watcher_name, watcher in sorted(services.items()):
+        haproxy = watcher.get('haproxy', {})
+        if haproxy.get('disabled') or 'frontend' not in haproxy:
+            continue
 
-        if should_restart:
-            # backwards compatibility for synapse_restart_command
-            # Note that it's preferable to use synapse_command
-            if 'synapse_restart_command' in my_config:
-                subprocess.check_call(my_config['synapse_restart_command'])
+        # The tiers, in the order the frontend falls back to them
+        tiers = []
+        for line in haproxy['frontend']:
+            match = _USE_BACKEND_RE.match(line)
+            if match and match.group(1) == match.group(2) and match.group(1) in services:
+                tiers.append(match.group(1))
+
+        collapsed_tiers = set()
+        previous_servers = _get_file_output_servers(my_config['file_output_path'], tiers[0]) if tiers else None
+        for tier in tiers[1:]:
+            servers = _get_file_output_servers(my_config['file_output_path'], tier)
+            if servers and servers == previous_servers:
+                collapsed_tiers.add(tier)
             else:
-                # Use stop + start so that we re-read the init file
-                # This is useful, for example, to ensure Synapse has good
-                # limits on file descriptors (which means HAProxy will)
-                cmd = my_config['synapse_command']
-                subprocess.check_call(cmd + ['stop'])
-                subprocess.check_call(cmd + ['start'])
+                previous_servers = servers
+        if not collapsed_tiers:
+            continue
+
+        dropped_lines = set()
+        for tier in collapsed_tiers:
+            dropped_lines.add('acl {0}_has_connslots connslots({0}) gt 0'.format(tier))
+            dropped_lines.add('use_backend {0} if {0}_has_connslots'.format(tier))
+            services[tier] = dict(services[tier], haproxy={'disabled': True})
+        services[watcher_name] = dict(watcher, haproxy=dict(haproxy, frontend=[
+            line for line in haproxy['frontend'] if line not in dropped_lines
+        ]))
+        collapsed.extend(collapsed_tiers)
+
+    if collapsed:
+        log.info('Collapsed %d backends with the same servers as another one', len(collapsed))
+
+
+def apply_server_slots(my_config, synapse_config):
+    """Move the backends of the backend only watchers whose servers are
+    known from the file output into extra sections made of server-template
+    slots. The watchers keep discovering their servers with HAProxy
+    disabled, see sync_server_slots.
+
+    :returns: the names of the slotted backends
+    """
+    if not my_config['haproxy_state_file_path']:
+        log.warning('Not using server slots without haproxy_state_file_path')
+        return []
+
+    current_config = _load_current_config(my_config['config_file']) or {}
+    current_sections = current_config.get('haproxy', {}).get('extra_sections', {})
+
+    services = synapse_config['services']
+    extra_sections = dict(synapse_config['haproxy']['extra_sections'])
+    slotted = []
+    for watcher_name, watcher in sorted(services.items()):
+        haproxy = watcher.get('haproxy', {})
+        if haproxy.get('disabled') or 'frontend' in haproxy or 'server_options' not in haproxy:
+            continue
+        servers = _get_file_output_servers(my_config['file_output_path'], watcher_name)
+        if servers is None:
+            continue
+
+        section = 'backend {0}'.format(haproxy.get('backend_name', watcher_name))
+        slot_count = server_slots.get_slot_count(
+            len(servers),
+            server_slots.get_slot_count_from_lines(current_sections.get(section, [])),
+        )
+        extra_sections[section] = haproxy['backend'] + [
+            server_slots.get_server_template(slot_count, haproxy['server_options']),
+        ]
+        services[watcher_name] = dict(watcher, haproxy={'disabled': True})
+        slotted.append(watcher_name)
+
+    synapse_config['haproxy'] = dict(synapse_config['haproxy'], extra_sections=extra_sections)
+    return slotted
+
+
+def _assign_server_slots(socket_path, servers_by_backend):
+    """Assign the servers of each backend to its slots, returns the backends
+    HAProxy does not have the slots of"""
+    from synapse_tools.haproxy import runtime_api
+
+    slots_by_backend = {}
+    for row in runtime_api.show_stat(socket_path):
+        if row['pxname'] in servers_by_backend and row['svname'].startswith(server_slots.SLOT_PREFIX):
+            slots_by_backend.setdefault(row['pxname'], {})[row['svname']] = (
+                None if row['status'].startswith('MAINT') else row['addr']
+            )
+
+    for backend, servers in sorted(servers_by_backend.items()):
+        if backend not in slots_by_backend:
+            continue
+        commands, unassigned = server_slots.get_slot_commands(backend, slots_by_backend[backend], servers)
+        for command in commands:
+            runtime_api.set_command(socket_path, command)
+        if unassigned:
+            log.warning('%s is out of server slots for %d servers', backend, len(unassigned))
+    return set(servers_by_backend) - set(slots_by_backend)
+
+
+def sync_server_slots(my_config, synapse_config, subset_sizes=None, timeout_s=0):
+    """Assign the servers synapse last wrote to the file output of each
+    slotted backend to its slots, through the HAProxy runtime API. Only the
+    servers of this host's subset get a slot in the backends which are in
+    subset_sizes.
+
+    HAProxy only has the slots once synapse restarted it with this config,
+    until then they are looked for again every SERVER_SLOTS_RETRY_INTERVAL_S
+    for up to timeout_s.
+
+    :returns: whether HAProxy has the slots of every slotted backend
+    """
+    from synapse_tools.haproxy import runtime_api
+
+    servers_by_backend = {}
+    for section, lines in synapse_config['haproxy']['extra_sections'].items():
+        if section.startswith('backend ') and server_slots.get_slot_count_from_lines(lines):
+            backend = section[len('backend '):]
+            servers = _get_file_output_servers(my_config['file_output_path'], backend)
+            if servers is not None and subset_sizes and backend in subset_sizes:
+                servers = get_address_subset(socket.gethostname(), servers, subset_sizes[backend])
+            if servers is not None:
+                servers_by_backend[backend] = servers
+    if not servers_by_backend:
+        return True
+
+    deadline = time.time() + timeout_s
+    while True:
+        try:
+            missing = _assign_server_slots(my_config['haproxy_socket_file_path'], servers_by_backend)
+            error = None
+        except runtime_api.RuntimeApiError as e:
+            missing = servers_by_backend
+            error = e
+        if not missing:
+            return True
+        if time.time() >= deadline:
+            break
+        time.sleep(SERVER_SLOTS_RETRY_INTERVAL_S)
+        # The ones which were assigned stay assigned
+        servers_by_backend = {backend: servers_by_backend[backend] for backend in missing}
+
+    if error is not None:
+        log.warning('Could not update the server slots: %s', error)
+    else:
+        log.info('HAProxy does not have the server slots of %s yet', ', '.join(sorted(missing)))
+    return False
+
+
+def apply_backend_subsets(my_config, subset_sizes):
+    """Drain the servers outside of this host's subset of each backend with
+    a subset_size and stop their health checks, through the HAProxy runtime
+    API. Synapse generates the HAProxy config with every server, so this has
+    to be done again after it reloads HAProxy, see backend_subset.
+
+    The subsets are picked among the servers synapse last wrote to the file
+    output, the backends it has not written any for are left alone."""
+    from synapse_tools.haproxy import runtime_api
+
+    discovered_servers = {}
+    for backend in subset_sizes:
+        servers = _get_file_output_servers(my_config['file_output_path'], backend)
+        if servers is not None:
+            discovered_servers[backend] = {'{0}:{1}'.format(host, port) for host, port in servers}
+
+    socket_path = my_config['haproxy_socket_file_path']
+    try:
+        commands = get_subset_commands(
+            socket.gethostname(), runtime_api.show_stat(socket_path), subset_sizes, discovered_servers,
+        )
+        for command in commands:
+            runtime_api.set_command(socket_path, command)
+    except runtime_api.RuntimeApiError as e:
+        log.warning('Could not apply the backend subsets: %s', e)
+
+
+def _get_backend_activity_path(my_config):
+    return my_config['backend_activity_path'] or '{0}.activity'.format(my_config['config_file'])
+
+
+def load_backend_activity(my_config):
+    try:
+        with open(_get_backend_activity_path(my_config)) as fp:
+            state = json.load(fp)
+    except (IOError, ValueError):
+        state = None
+    return BackendActivity(state=state)
+
+
+def save_backend_activity(my_config, activity):
+    write_atomically(
+        _get_backend_activity_path(my_config),
+        json.dumps(activity.state(), sort_keys=True),
+    )
+
+
+_HEALTH_CHECK_RE = re.compile(r'(^|\s)check(\s|$)')
+
+
+def _get_checked_backends(synapse_config):
+    """The backends whose servers HAProxy health checks, including the
+    slotted ones"""
+    checked_backends = set()
+    for watcher_name, watcher in synapse_config['services'].items():
+        haproxy = watcher.get('haproxy', {})
+        if _HEALTH_CHECK_RE.search(haproxy.get('server_options', '')):
+            checked_backends.add(haproxy.get('backend_name', watcher_name))
+    for section, lines in synapse_config['haproxy'].get('extra_sections', {}).items():
+        if section.startswith('backend ') and any(
+            line.startswith('server-template ') and _HEALTH_CHECK_RE.search(line) for line in lines
+        ):
+            checked_backends.add(section[len('backend '):])
+    return checked_backends
+
+
+def demote_cold_backends(my_config, synapse_config):
+    """Record the session counters of the HAProxy backends, and stop the
+    health checks of the servers of the ones which have been idle for
+    cold_backend_idle_s through the HAProxy runtime API. The other backends
+    get theirs started again. The config synapse is given is left alone, see
+    backend_activity."""
+    from synapse_tools.haproxy import runtime_api
+
+    socket_path = my_config['haproxy_socket_file_path']
+    activity = load_backend_activity(my_config)
+    try:
+        activity.observe(runtime_api.get_sessions_by_backend(socket_path))
+        save_backend_activity(my_config, activity)
+        commands = get_health_commands(
+            runtime_api.show_stat(socket_path),
+            activity.idle_backends(my_config['cold_backend_idle_s']),
+            _get_checked_backends(synapse_config),
+        )
+        for command in commands:
+            runtime_api.set_command(socket_path, command)
+    except runtime_api.RuntimeApiError as e:
+        log.warning('Could not demote the cold backends: %s', e)
+        return
+    if commands:
+        demoted = sum(1 for command in commands if command.startswith('disable '))
+        log.info('Stopped the health checks of %d servers, started %d', demoted, len(commands) - demoted)
+
+
+def emit_timing_summary(my_config, timer):
+    timing.emit_summary(
+        timer,
+        summary_path=my_config['timing_summary_path'],
+        statsd_address=my_config['timing_statsd_address'],
+        statsd_prefix=my_config['timing_statsd_prefix'],
+    )
+
+
+@contextlib.contextmanager
+def process_pool(processes):
+    """Yield a multiprocessing pool with that many processes, or None if
+    processes is 0"""
+    if processes <= 0:
+        yield None
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _is_under(path, directory):
+    return path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
+def _get_output_paths(my_config):
+    """The files configure_synapse writes itself"""
+    paths = [
+        my_config['config_file'],
+        _get_config_digest_path(my_config),
+        _get_restart_state_path(my_config),
+        _get_backend_activity_path(my_config),
+        my_config['render_cache_path'],
+        my_config['catalog_cache_path'],
+        my_config['timing_summary_path'],
+    ]
+    return {os.path.abspath(path) for path in paths if path}
+
+
+class ConfigureSynapseDaemon(object):
+    """Keeps the synapse-tools config, the ZooKeeper topology, the service
+    namespaces and the rendered watchers in memory, and updates the synapse
+    config whenever one of the files they are read from changes.
+    """
+
+    def __init__(self, synapse_tools_config_path, debounce_s):
+        self.synapse_tools_config_path = os.path.abspath(synapse_tools_config_path)
+        self.debounce_s = debounce_s
+        self.inotify = Inotify()
+        self.inotify.add_watch(os.path.dirname(self.synapse_tools_config_path))
+        self.my_config = None
+        self.zookeeper_topology = None
+        self.namespaces = None
+        self.wanted_services = None
+        self.subset_sizes = {}
+        # Until when to keep looking for the server slots in HAProxy
+        self.server_slots_deadline = None
+        self.render_cache = {}
+        self.catalog_cache = CatalogCache()
+
+    def _watch(self, path, recursive=False):
+        if path not in self.inotify.watched_paths():
+            self.inotify.add_watch(path, recursive=recursive)
+
+    def _watch_file_output(self):
+        """Watch the servers synapse writes, once it created their directory"""
+        file_output_path = os.path.abspath(self.my_config['file_output_path'])
+        if os.path.isdir(file_output_path):
+            self._watch(file_output_path)
+
+    def refresh(self, changed_paths):
+        """Reload whatever changed_paths affect and update the synapse config.
+        Everything is reloaded on the first call."""
+        reload_all = (
+            self.my_config is None or
+            Inotify.OVERFLOW in changed_paths or
+            self.synapse_tools_config_path in changed_paths
+        )
+        timer = timing.PhaseTimer()
+        try:
+            if reload_all:
+                with timer.phase('load_config'):
+                    self.my_config = get_config(self.synapse_tools_config_path)
+
+            zookeeper_topology_path = os.path.abspath(self.my_config['zookeeper_topology_path'])
+            self._watch(os.path.dirname(zookeeper_topology_path))
+            if reload_all or zookeeper_topology_path in changed_paths:
+                with timer.phase('zookeeper_topology'):
+                    self.zookeeper_topology = get_zookeeper_topology(zookeeper_topology_path)
+
+            soa_dir = os.path.abspath(self.my_config['soa_dir'])
+            self._watch(soa_dir, recursive=True)
+            if reload_all or any(
+                _is_under(path, soa_dir) for path in changed_paths
+            ):
+                with timer.phase('namespaces'), process_pool(
+                    self.my_config['namespace_loader_processes'],
+                ) as loader_pool:
+                    self.namespaces = get_all_namespaces(
+                        soa_dir=soa_dir, catalog_cache=self.catalog_cache, pool=loader_pool,
+                    )
+
+            namespaces = self.namespaces
+            service_dependencies_path = self.my_config['service_dependencies_path']
+            if service_dependencies_path:
+                service_dependencies_path = os.path.abspath(service_dependencies_path)
+                self._watch(os.path.dirname(service_dependencies_path))
+                if reload_all or service_dependencies_path in changed_paths:
+                    self.wanted_services = load_wanted_services(self.my_config)
+                if self.wanted_services is not None:
+                    namespaces = select_services(namespaces, self.wanted_services)
+
+            new_synapse_config = None
+            if self.my_config['rendered_config_dir']:
+                # Picked up by the periodic refreshes, like cron runs do
+                with timer.phase('rendered_config'):
+                    new_synapse_config = load_rendered_config(self.my_config, self.zookeeper_topology)
+
+            subset_sizes = {}
+            if new_synapse_config is None:
+                with timer.phase('generate'):
+                    new_synapse_config = generate_configuration(
+                        self.my_config,
+                        self.zookeeper_topology,
+                        namespaces,
+                        render_cache=self.render_cache,
+                        processes=self.my_config['render_processes'],
+                        subset_sizes=subset_sizes,
+                    )
+            # Without the slotted backends, whose subsets are assigned to
+            # their slots
+            self.subset_sizes = dict(subset_sizes)
+            if self.my_config['collapse_identical_backends'] or self.my_config['haproxy_server_slots'] or \
+                    self.subset_sizes or self.my_config['haproxy_runtime_updates'] or \
+                    self.my_config['cold_backend_idle_s']:
+                # Which tiers are collapsed, the slots' servers and the
+                # subsets depend on the servers synapse last wrote, and it
+                # reloads HAProxy without the runtime updates and with the
+                # health checks of every server when they change
+                self._watch_file_output()
+            if self.my_config['collapse_identical_backends']:
+                with timer.phase('collapse'):
+                    collapse_identical_backends(self.my_config, new_synapse_config)
+            if self.my_config['haproxy_server_slots']:
+                with timer.phase('slots'):
+                    for backend in apply_server_slots(self.my_config, new_synapse_config):
+                        self.subset_sizes.pop(backend, None)
+            restarted = update_synapse_config(self.my_config, new_synapse_config, timer=timer)
+            if self.my_config['haproxy_server_slots']:
+                if restarted:
+                    self.server_slots_deadline = time.time() + SERVER_SLOTS_TIMEOUT_S
+                with timer.phase('slots'):
+                    if sync_server_slots(self.my_config, new_synapse_config, subset_sizes):
+                        self.server_slots_deadline = None
+            if self.subset_sizes:
+                with timer.phase('subsets'):
+                    apply_backend_subsets(self.my_config, self.subset_sizes)
+            if self.my_config['cold_backend_idle_s']:
+                with timer.phase('demote'):
+                    demote_cold_backends(self.my_config, new_synapse_config)
+        except Exception:
+            # Start from scratch on the next change, we cannot tell which
+            # parts of the state are still valid
+            self.my_config = None
+            raise
+        emit_timing_summary(self.my_config, timer)
+
+    def _is_own_output(self, path):
+        """Whether path is written by refresh, which may share a directory
+        with the files it reads (the config file usually lives next to the
+        synapse-tools config)"""
+        if self.my_config is None or path is Inotify.OVERFLOW:
+            return False
+        return any(
+            path == output_path or is_temporary_file(path, output_path)
+            for output_path in _get_output_paths(self.my_config)
+        )
+
+    def _read_changes(self, timeout):
+        """Wait up to timeout seconds for changes other than the daemon's own
+        writes, None if the timeout expired"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed_paths = self.inotify.read_changes(timeout=timeout)
+            if not changed_paths:
+                return None
+            changed_paths = {path for path in changed_paths if not self._is_own_output(path)}
+            if changed_paths:
+                return changed_paths
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+
+    def wait_for_changes(self, timeout=None):
+        """Block until something changes, then keep collecting changes until
+        none were seen for debounce_s seconds. The daemon's own writes are
+        not changes.
+
+        :param timeout: return an empty set if nothing changed for this long
+        """
+        changed_paths = self._read_changes(timeout=timeout)
+        if not changed_paths:
+            return set()
+        while True:
+            more_changed_paths = self._read_changes(timeout=self.debounce_s)
+            if not more_changed_paths:
+                return changed_paths
+            changed_paths |= more_changed_paths
+
+    def run(self):
+        changed_paths = set()
+        while True:
+            try:
+                self.refresh(changed_paths)
+            except Exception:
+                log.exception('Failed to update the synapse configuration')
+            changed_paths = self.wait_for_changes(timeout=self.wakeup_timeout())
+            if not changed_paths:
+                log.info('Nothing changed, updating the synapse configuration anyway')
+                continue
+            log.info('Changed: %s', ', '.join(sorted(
+                path or '<inotify queue overflow>' for path in changed_paths
+            )))
+
+    def restart_timeout(self):
+        """How long until a pending restart is due, None if there is none"""
+        if self.my_config is None:
+            return None
+        due_time = load_restart_scheduler(self.my_config).due_time()
+        if due_time is None:
+            return None
+        return max(0, due_time - time.time())
+
+    def wakeup_timeout(self):
+        """How long to wait for changes before refreshing anyway, to retry
+        a failed refresh, for a pending restart, to look for cold backends or
+        for the server slots."""
+        if self.my_config is None:
+            # The last refresh failed
+            return DAEMON_RETRY_INTERVAL_S
+        timeouts = [DAEMON_REFRESH_INTERVAL_S, self.restart_timeout()]
+        if self.my_config['cold_backend_idle_s']:
+            # Backends are demoted at most this late
+            timeouts.append(self.my_config['cold_backend_idle_s'] / 2.0)
+        if self.subset_sizes:
+            timeouts.append(BACKEND_SUBSET_INTERVAL_S)
+        if self.server_slots_deadline is not None and time.time() < self.server_slots_deadline:
+            # Until synapse started HAProxy with the slots
+            timeouts.append(SERVER_SLOTS_RETRY_INTERVAL_S)
+        return min(timeout for timeout in timeouts if timeout is not None)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running and update the synapse config whenever the '
+             'synapse-tools config, the ZooKeeper topology or the soa-configs '
+             'change.')
+    parser.add_argument(
+        '--debounce-s', type=float, default=DEFAULT_DEBOUNCE_S,
+        help='In daemon mode, wait until nothing changed for this long '
+             'before updating (default: %(default)s).')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='Profile the run and write the cProfile stats to PATH. They can '
+             'be read with pstats or turned into a flame graph with e.g. '
+             'flameprof.')
+    args = parser.parse_args()
+    if args.daemon and args.profile:
+        parser.error('--profile cannot be used with --daemon')
+    return args
+
+
+def load_rendered_config(my_config, zookeeper_topology):
+    """The config synapse_batch_render rendered for this host, see
+    rendered_config_dir. None if there is no usable one."""
+    return config_artifacts.load_host_config(
+        my_config['rendered_config_dir'],
+        socket.gethostname(),
+        config_artifacts.get_inputs_digest(my_config, zookeeper_topology),
+        my_config['rendered_config_max_age_s'],
+    )
+
+
+def render_synapse_config(my_config, zookeeper_topology, timer, subset_sizes=None):
+    """Read the catalog and generate the synapse config of this host,
+    using the caches that are configured"""
+    render_cache_path = my_config['render_cache_path']
+    render_cache = None
+    if render_cache_path:
+        with timer.phase('render_cache'):
+            render_cache = load_render_cache(render_cache_path)
+
+    catalog_cache_path = my_config['catalog_cache_path']
+    catalog_cache = None
+    if catalog_cache_path:
+        with timer.phase('catalog_cache'):
+            catalog_cache = CatalogCache.load(catalog_cache_path)
+
+    with process_pool(my_config['namespace_loader_processes']) as loader_pool:
+        if loader_pool is None:
+            with timer.phase('namespaces'):
+                namespaces = get_all_namespaces(
+                    soa_dir=my_config['soa_dir'], catalog_cache=catalog_cache,
+                )
+        else:
+            # Services are parsed while the previous ones are being rendered,
+            # the time spent waiting for them is part of generate as well
+            catalog_cache = catalog_cache or CatalogCache()
+            namespaces = timer.iter_phase('namespaces', catalog_cache.iter_namespaces(
+                my_config['soa_dir'], pool=loader_pool,
+            ))
+
+        wanted_services = load_wanted_services(my_config)
+        if wanted_services is not None:
+            # Filtered while they are rendered
+            namespaces = select_services(namespaces, wanted_services)
+
+        with timer.phase('generate'):
+            new_synapse_config = generate_configuration(
+                my_config,
+                zookeeper_topology,
+                namespaces,
+                render_cache=render_cache,
+                processes=my_config['render_processes'],
+                subset_sizes=subset_sizes,
+            )
+
+    if catalog_cache_path and catalog_cache.dirty:
+        with timer.phase('catalog_cache'):
+            catalog_cache.save(catalog_cache_path)
+
+    if render_cache_path:
+        with timer.phase('render_cache'):
+            save_render_cache(render_cache_path, render_cache)
+
+    return new_synapse_config
+
+
+def run_once(synapse_tools_config_path):
+    timer = timing.PhaseTimer()
+
+    with timer.phase('load_config'):
+        my_config = get_config(synapse_tools_config_path)
+
+    with timer.phase('zookeeper_topology'):
+        zookeeper_topology = get_zookeeper_topology(my_config['zookeeper_topology_path'])
+
+    new_synapse_config = None
+    if my_config['rendered_config_dir']:
+        with timer.phase('rendered_config'):
+            new_synapse_config = load_rendered_config(my_config, zookeeper_topology)
+
+    # The rendered configs do not carry the subset sizes, those are only
+    # applied to a config rendered here
+    subset_sizes = {}
+    if new_synapse_config is None:
+        new_synapse_config = render_synapse_config(
+            my_config, zookeeper_topology, timer, subset_sizes=subset_sizes,
+        )
+
+    if my_config['collapse_identical_backends']:
+        with timer.phase('collapse'):
+            collapse_identical_backends(my_config, new_synapse_config)
+
+    slotted_backends = []
+    if my_config['haproxy_server_slots']:
+        with timer.phase('slots'):
+            slotted_backends = apply_server_slots(my_config, new_synapse_config)
+
+    restarted = update_synapse_config(my_config, new_synapse_config, timer=timer)
+    if my_config['haproxy_server_slots']:
+        with timer.phase('slots'):
+            sync_server_slots(
+                my_config, new_synapse_config, subset_sizes,
+                timeout_s=SERVER_SLOTS_TIMEOUT_S if restarted else 0,
+            )
+    # The subsets of the slotted backends are the servers assigned to their
+    # slots, synapse does not touch those
+    for backend in slotted_backends:
+        subset_sizes.pop(backend, None)
+    if subset_sizes:
+        with timer.phase('subsets'):
+            apply_backend_subsets(my_config, subset_sizes)
+    if my_config['cold_backend_idle_s']:
+        with timer.phase('demote'):
+            demote_cold_backends(my_config, new_synapse_config)
+    emit_timing_summary(my_config, timer)
+
+
+def main():
+    args = parse_args()
+    synapse_tools_config_path = os.environ.get(
+        'SYNAPSE_TOOLS_CONFIG_PATH', '/etc/synapse/synapse-tools.conf.json'
+    )
+
+    if args.daemon:
+        logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+        ConfigureSynapseDaemon(synapse_tools_config_path, args.debounce_s).run()
+        return
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run_once, synapse_tools_config_path)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run_once(synapse_tools_config_path)
 
 
 if __name__ == '__main__':
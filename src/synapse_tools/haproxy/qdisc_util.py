@@ -7,16 +7,9 @@ from __future__ import print_function
 import logging
 import struct
 
-from plumbum.cmd import grep
-from plumbum.cmd import iptables
-from plumbum.cmd import tc
-
-import pyroute2
-from pyroute2 import IPRoute
-from pyroute2.iproute import transform_handle
-from pyroute2.netlink import NLM_F_ACK
-from pyroute2.netlink import NLM_F_REQUEST
-from pyroute2.netlink.rtnl.tcmsg import tcmsg
+# plumbum and pyroute2 are imported by the functions that need them, most
+# commands only use one of the two and importing both is a significant part
+# of the startup time of the qdisc tool.
 
 
 log = logging.getLogger(__name__)
@@ -24,6 +17,9 @@ log = logging.getLogger(__name__)
 
 def stat(interface_name):
     """ Show status of existing qdisc and iptables rules """
+    from plumbum.cmd import iptables
+    from plumbum.cmd import tc
+
     for tc_type in ('qdisc', 'class', 'filter'):
         print('=' * 20 + ' tc {0} '.format(tc_type) + '=' * 20)
         print(tc['-s', tc_type, 'show', 'dev', interface_name]())
@@ -35,6 +31,10 @@ def stat(interface_name):
 
 def check_setup(interface_name):
     """ Checks the existing qdisc and iptables rules """
+    from plumbum.cmd import grep
+    from plumbum.cmd import iptables
+    from plumbum.cmd import tc
+
     tc_cmd = tc['-s', 'qdisc', 'show', 'dev', interface_name]
     tc_grep_cmd = grep['qdisc']
     tc_chain = (tc_cmd | tc_grep_cmd)
@@ -99,6 +99,8 @@ IPTABLES_MARK = '1'
 
 
 def _apply_tc_rules(interface_name):
+    from plumbum.cmd import tc
+
     log.info('Creating prio qdisc with a plug lane for {0}'.format(
         interface_name))
     tc['qdisc', 'add', 'dev', interface_name,
@@ -135,6 +137,8 @@ def _apply_tc_rules(interface_name):
 
 
 def _apply_iptables_rule(source_ip):
+    from plumbum.cmd import iptables
+
     log.info('Creating iptables rule to mark outgoing syns on {0}'.format(
         source_ip))
     iptables[
@@ -163,6 +167,9 @@ def setup(interface_name, source_ip):
 
 
 def clear(interface_name, source_ip):
+    from plumbum.cmd import iptables
+    from plumbum.cmd import tc
+
     try:
         tc['qdisc', 'del', 'dev', interface_name, 'root']()
     except:
@@ -186,6 +193,13 @@ def _manage_plug_via_netlink(interface_name, action='unplug'):
     FIXME: Once we have a modern userpace, replace this with appropriate
     calls to nl-qdisc-add
     """
+    import pyroute2
+    from pyroute2 import IPRoute
+    from pyroute2.iproute import transform_handle
+    from pyroute2.netlink import NLM_F_ACK
+    from pyroute2.netlink import NLM_F_REQUEST
+    from pyroute2.netlink.rtnl.tcmsg import tcmsg
+
     ip = IPRoute()
     index = ip.link_lookup(ifname=interface_name)[0]
     # See the linux source at include/uapi/linux/pkt_sched.h
@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+""" Talk to HAProxy through its stats socket """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+
+
+DEFAULT_TIMEOUT_S = 5
+
+
+class RuntimeApiError(Exception):
+    pass
+
+
+def send_command(socket_path, command, timeout=DEFAULT_TIMEOUT_S):
+    """ Run one command and return its output. HAProxy closes the
+    connection once it has answered a non-interactive session. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((command + '\n').encode('ascii'))
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    except socket.error as e:
+        raise RuntimeApiError('{0}: {1}'.format(command, e))
+    finally:
+        sock.close()
+    return b''.join(chunks).decode('ascii', 'replace')
+
+
+def set_command(socket_path, command, timeout=DEFAULT_TIMEOUT_S):
+    """ Run a command which changes a setting. Those answer with an empty
+    line on success and with an error message otherwise. """
+    output = send_command(socket_path, command, timeout=timeout).strip()
+    if output:
+        raise RuntimeApiError('{0}: {1}'.format(command, output))
+
+
+def show_stat(socket_path, timeout=DEFAULT_TIMEOUT_S):
+    """ Return one dict per line of 'show stat', keyed by the CSV header """
+    lines = send_command(socket_path, 'show stat', timeout=timeout).splitlines()
+    if not lines or not lines[0].startswith('#'):
+        raise RuntimeApiError('show stat: unexpected output {0!r}'.format(lines[:1]))
+
+    # Every line ends with a separator
+    header = lines[0].lstrip('# ').rstrip(',').split(',')
+    return [dict(zip(header, line.rstrip(',').split(','))) for line in lines[1:] if line]
+
+
+def get_servers_by_backend(socket_path, timeout=DEFAULT_TIMEOUT_S):
+    """ Return a dict of backend name -> list of server names """
+    servers = {}
+    for row in show_stat(socket_path, timeout=timeout):
+        if row['svname'] in ('FRONTEND', 'BACKEND'):
+            continue
+        servers.setdefault(row['pxname'], []).append(row['svname'])
+    return servers
+
+
+def get_sessions_by_backend(socket_path, timeout=DEFAULT_TIMEOUT_S):
+    """ Return a dict of backend name -> total number of sessions """
+    return {
+        row['pxname']: int(row['stot'])
+        for row in show_stat(socket_path, timeout=timeout)
+        if row['svname'] == 'BACKEND'
+    }
@@ -0,0 +1,138 @@
+# -*- coding: utf8 -*-
+""" Minimal ctypes bindings for Linux inotify(7), used to find out when the
+files that the synapse configuration is generated from have changed """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+# Constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Files are either rewritten in place (close after write) or atomically
+# moved into place, we do not care about the individual writes in between
+CHANGE_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+_EVENT_HEADER = struct.Struct('iIII')
+
+_READ_SIZE = 64 * 1024
+
+
+class Inotify(object):
+    """ Watches directories for changes.
+
+    read_changes returns the paths that changed, or OVERFLOW if the kernel
+    dropped events and any watched path may have changed.
+    """
+
+    OVERFLOW = None
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+        # watch descriptor -> watched path
+        self._paths = {}
+        # watch descriptors of directories whose new subdirectories are
+        # watched as well
+        self._recursive = set()
+
+    def _raise_errno(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, recursive=False):
+        """ Watch a directory (and optionally all directories below it) """
+        if recursive:
+            for dirpath, _, _ in os.walk(path):
+                self._add_watch(dirpath, recursive=True)
+        else:
+            self._add_watch(path, recursive=False)
+
+    def _add_watch(self, path, recursive):
+        wd = self._libc.inotify_add_watch(self.fd, path, CHANGE_MASK)
+        if wd < 0:
+            self._raise_errno(path)
+        self._paths[wd] = path
+        if recursive:
+            self._recursive.add(wd)
+
+    def watched_paths(self):
+        return set(self._paths.values())
+
+    def read_changes(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for changes.
+
+        :returns: set of changed paths, empty if the timeout expired
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            changes.update(self._parse_events(data))
+        return changes
+
+    def _parse_events(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                yield self.OVERFLOW
+                continue
+
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+
+            if mask & IN_IGNORED:
+                # The watched directory is gone, the kernel removed the watch
+                del self._paths[wd]
+                self._recursive.discard(wd)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self._recursive:
+                try:
+                    self.add_watch(path, recursive=True)
+                except OSError:
+                    # Already removed again
+                    pass
+
+            yield path
+
+    def close(self):
+        os.close(self.fd)
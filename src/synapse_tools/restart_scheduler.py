@@ -0,0 +1,107 @@
+# -*- coding: utf8 -*-
+""" Decide when synapse gets restarted for a config change, so that a burst
+of changes results in a single restart """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import time
+
+
+def get_host_jitter_s(hostname, window_s):
+    """ A delay in [0, window_s) which is the same on every run on a host, and
+    evenly spread across hosts. Unlike hash(), it does not depend on the
+    Python version. """
+    if window_s <= 0:
+        return 0
+    digest = hashlib.md5(hostname.encode('utf8')).hexdigest()
+    return int(digest[:13], 16) / 16 ** 13 * window_s
+
+
+class RestartScheduler(object):
+    """ Restarts are requested for each config change which needs one, and
+    happen once they are due:
+
+    * coalesce_window_s + jitter_s after the first change that is still
+      pending, all changes in the meantime are picked up by the same
+      restart. A change made everywhere at once does not restart every
+      host at once if each host uses its own jitter_s.
+    * but no sooner than min_interval_s after the previous restart
+
+    The changes applied to HAProxy at runtime instead are kept until the
+    next restart as well, since synapse does not know about them.
+
+    The state is a JSON-serializable dict which has to be persisted between
+    runs, see state().
+    """
+
+    def __init__(self, min_interval_s=0, coalesce_window_s=0, jitter_s=0, state=None):
+        self.min_interval_s = min_interval_s
+        self.coalesce_window_s = coalesce_window_s
+        self.jitter_s = jitter_s
+        state = state or {}
+        self.last_restart = state.get('last_restart')
+        # Digest of the config synapse was last restarted with
+        self.running_digest = state.get('running_digest')
+        self.pending_since = state.get('pending_since')
+        self.pending_digests = list(state.get('pending_digests', []))
+        # [backend, setting, value] of each setting changed at runtime
+        self.runtime_updates = [list(update) for update in state.get('runtime_updates', [])]
+
+    def state(self):
+        return {
+            'last_restart': self.last_restart,
+            'running_digest': self.running_digest,
+            'pending_since': self.pending_since,
+            'pending_digests': self.pending_digests,
+            'runtime_updates': self.runtime_updates,
+        }
+
+    @property
+    def pending(self):
+        return self.pending_since is not None
+
+    def request_restart(self, digest, now=None):
+        now = time.time() if now is None else now
+        if self.pending_since is None:
+            self.pending_since = now
+        if digest not in self.pending_digests:
+            self.pending_digests.append(digest)
+
+    def cancel_pending(self):
+        self.pending_since = None
+        self.pending_digests = []
+
+    def record_runtime_updates(self, updates):
+        """ Keep the latest value of each setting changed at runtime """
+        for backend, setting, value in updates:
+            self.runtime_updates = [
+                update for update in self.runtime_updates if update[:2] != [backend, setting]
+            ]
+            self.runtime_updates.append([backend, setting, value])
+
+    def clear_changes(self):
+        """ Synapse runs with the current config, nothing has to be picked
+        up by a restart or kept applied at runtime """
+        self.cancel_pending()
+        self.runtime_updates = []
+
+    def due_time(self):
+        """ When the pending restart is due, None if there is none """
+        if self.pending_since is None:
+            return None
+        due_time = self.pending_since + self.coalesce_window_s + self.jitter_s
+        if self.last_restart is not None:
+            due_time = max(due_time, self.last_restart + self.min_interval_s)
+        return due_time
+
+    def is_due(self, now=None):
+        now = time.time() if now is None else now
+        due_time = self.due_time()
+        return due_time is not None and now >= due_time
+
+    def record_restart(self, digest, now=None):
+        self.last_restart = time.time() if now is None else now
+        self.running_digest = digest
+        self.clear_changes()
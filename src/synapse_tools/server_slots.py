@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+""" Backends made of HAProxy server-template slots, which get the servers of
+a watcher assigned through the runtime API instead of by reloading HAProxy """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+
+SLOT_PREFIX = 'slot'
+
+MIN_SLOTS = 4
+
+_SERVER_TEMPLATE_RE = re.compile(r'^server-template {0} 1-(\d+) '.format(SLOT_PREFIX))
+
+
+def get_slot_count(server_count, previous_slot_count=None):
+    """ Twice as many slots as there are servers, rounded up to a power of
+    two. The previous number of slots is kept as long as the servers fit
+    with some headroom and use at least an eighth of them, so that it only
+    changes when the number of servers changes a lot. """
+    if previous_slot_count and server_count * 8 >= previous_slot_count and \
+            server_count * 4 <= previous_slot_count * 3:
+        return previous_slot_count
+    slot_count = MIN_SLOTS
+    while slot_count < server_count * 2:
+        slot_count *= 2
+    return slot_count
+
+
+def get_server_template(slot_count, server_options):
+    """ The slots start in maintenance, without an address. They health
+    check their servers themselves: a server can only `track` one whose
+    name is known when HAProxy parses its config, and the servers of the
+    narrowest tier are named by synapse and change without a reload, as do
+    the ones assigned to the slots. """
+    return 'server-template {0} 1-{1} 0.0.0.0:0 disabled {2}'.format(
+        SLOT_PREFIX, slot_count, server_options,
+    ).strip()
+
+
+def get_slot_count_from_lines(lines):
+    """ The number of slots of a backend section, None if it has none """
+    for line in lines:
+        match = _SERVER_TEMPLATE_RE.match(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _get_slot_number(slot):
+    return int(slot[len(SLOT_PREFIX):])
+
+
+def get_slot_commands(backend, slots, servers):
+    """ The runtime API commands which assign the servers to the slots of
+    a backend. Servers keep the slot they are in, the slots of the servers
+    which are gone are put in maintenance and reused.
+
+    :param slots: slot name -> 'ip:port' of the server in it, None for the
+                  slots in maintenance
+    :param servers: set of (host, port) of the servers of the backend
+    :returns: the commands, and the servers which did not get a slot
+    """
+    commands = []
+    assigned = set()
+    free_slots = []
+    for slot in sorted(slots, key=_get_slot_number):
+        server = None
+        if slots[slot] is not None:
+            host, _, port = slots[slot].rpartition(':')
+            server = (host, int(port))
+        if server in servers and server not in assigned:
+            assigned.add(server)
+            continue
+        if server is not None:
+            commands.append('set server {0}/{1} state maint'.format(backend, slot))
+        free_slots.append(slot)
+
+    unassigned = sorted(servers - assigned)
+    for (host, port), slot in zip(unassigned, free_slots):
+        commands.append('set server {0}/{1} addr {2} port {3}'.format(backend, slot, host, port))
+        commands.append('set server {0}/{1} state ready'.format(backend, slot))
+    return commands, unassigned[len(free_slots):]
@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+""" The smartstack configuration of a single service """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numbers
+
+
+class InvalidServiceConfigError(ValueError):
+    pass
+
+
+class ServiceConfig(object):
+    """ A service's namespace config from smartstack.yaml, with the defaults
+    applied and the values derived from it computed once.
+
+    The configuration generation and the plugins use the attributes, info
+    is the raw config dict (e.g. to fingerprint the service).
+
+    Note that validations of the config are done in config post-receive, we
+    only check what the HAProxy config is formatted from.
+    """
+
+    __slots__ = (
+        'name',
+        'info',
+        'proxy_port',
+        'discover',
+        'advertise',
+        'mode',
+        'chaos',
+        'plugins',
+        'timeout_client_ms',
+        'timeout_server_ms',
+        'timeout_connect_ms',
+        'retries',
+        'balance',
+        'keepalive',
+        'allredisp',
+        'extra_headers',
+        'healthcheck_uri',
+        'healthcheck_option',
+        'proxied_through',
+        'is_proxy',
+        'subset_size',
+    )
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+        # Note that proxy_port can be:
+        # * negative (the default): not in SmartStack
+        # * valid number: Wants Load balancing (HAProxy/Nginx)
+        # * None: Wants discovery, but no load balancing (files)
+        self.proxy_port = info.get('proxy_port', -1)
+        self.discover = info.get('discover', 'region')
+        self.advertise = info.get('advertise', ['region'])
+        self.mode = info.get('mode', 'http')
+        self.chaos = info.get('chaos') or {}
+        self.plugins = info.get('plugins', {})
+
+        # If the service sets one timeout but not the other, set both
+        # as per haproxy best practices.
+        default_timeout = max(
+            self._get_number('timeout_client_ms'),
+            self._get_number('timeout_server_ms'),
+        )
+        self.timeout_client_ms = info.get('timeout_client_ms', default_timeout)
+        self.timeout_server_ms = info.get('timeout_server_ms', default_timeout)
+        self.timeout_connect_ms = self._get_number('timeout_connect_ms')
+        self.retries = self._get_number('retries')
+
+        self.balance = info.get('balance')
+        self.keepalive = info.get('keepalive', False)
+        self.allredisp = info.get('allredisp')
+        self.extra_headers = info.get('extra_headers', {})
+        self.healthcheck_uri = info.get('healthcheck_uri', '/status')
+        self.healthcheck_option = self._get_healthcheck_option(
+            info.get('extra_healthcheck_headers', {}),
+        )
+        self.proxied_through = info.get('proxied_through')
+        self.is_proxy = info.get('is_proxy', False)
+        # Number of servers of each backend this host uses, all if None
+        self.subset_size = self._get_positive_integer('subset_size')
+
+    def _get_number(self, key):
+        value = self.info.get(key)
+        if value is not None and not isinstance(value, numbers.Number):
+            raise InvalidServiceConfigError(
+                '{0}: {1} must be a number, not {2!r}'.format(self.name, key, value),
+            )
+        return value
+
+    def _get_positive_integer(self, key):
+        value = self.info.get(key)
+        if value is not None and (
+            isinstance(value, bool) or not isinstance(value, numbers.Integral) or value < 1
+        ):
+            raise InvalidServiceConfigError(
+                '{0}: {1} must be a positive integer, not {2!r}'.format(self.name, key, value),
+            )
+        return value
+
+    def _get_healthcheck_option(self, extra_healthcheck_headers):
+        # hacheck healthchecking
+        # Note that we use a dummy port value of '0' here because HAProxy is
+        # passing in the real port using the X-Haproxy-Server-State header.
+        # See SRV-1492 / SRV-1498 for more details.
+        port = 0
+
+        if len(extra_healthcheck_headers) > 0:
+            healthcheck_base = 'HTTP/1.1'
+            headers_string = healthcheck_base + ''.join(
+                r'\r\n%s:\ %s' % (k, v) for (k, v) in extra_healthcheck_headers.iteritems()
+            )
+        else:
+            headers_string = ""
+
+        healthcheck_string = r'option httpchk GET /%s/%s/%d/%s %s' % \
+            (self.mode, self.name, port, self.healthcheck_uri.lstrip('/'), headers_string)
+        return healthcheck_string.strip()
+
+    def get(self, key, default=None):
+        """ Look up a key of the raw config, like in the service_info dicts
+        that plugins used to get """
+        return self.info.get(key, default)
+
+    def __reduce__(self):
+        # Everything else is derived from the raw config
+        return (ServiceConfig, (self.name, self.info))
+
+    def __repr__(self):
+        return 'ServiceConfig({0!r}, {1!r})'.format(self.name, self.info)
@@ -0,0 +1,93 @@
+# -*- coding: utf8 -*-
+""" Phase timers for configure_synapse runs, so that node agents can tell
+which part of a slow run was slow """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import logging
+import socket
+import time
+
+from synapse_tools.atomic_file import write_atomically
+
+
+log = logging.getLogger(__name__)
+
+
+class PhaseTimer(object):
+    """ Accumulates the wall time spent in each phase of a run """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def iter_phase(self, name, iterable):
+        """ Iterate over iterable, counting the time spent waiting for its
+        items as the phase name """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        return {
+            'timestamp': int(self.start_time),
+            'total_s': time.time() - self.start_time,
+            'phases': dict(self.phases),
+        }
+
+
+def write_summary(path, summary):
+    # Scrapers must never read a partially written file
+    write_atomically(path, json.dumps(summary, sort_keys=True), mode=0o644)
+
+
+def format_statsd(prefix, summary):
+    """ One timer per phase plus the total, in milliseconds """
+    timings = sorted(summary['phases'].items()) + [('total', summary['total_s'])]
+    return '\n'.join(
+        '{0}.{1}:{2}|ms'.format(prefix, name, int(round(seconds * 1000)))
+        for name, seconds in timings
+    )
+
+
+def send_statsd(address, prefix, summary):
+    """ Send all timings in a single datagram to a statsd at host:port """
+    host, port = address.rsplit(':', 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(format_statsd(prefix, summary).encode('ascii'), (host, int(port)))
+    finally:
+        sock.close()
+
+
+def emit_summary(timer, summary_path=None, statsd_address=None, statsd_prefix=None):
+    """ Write and/or send the summary of a run. Failing to do so must not
+    fail the run, so errors are only logged. """
+    summary = timer.summary()
+    if summary_path:
+        try:
+            write_summary(summary_path, summary)
+        except (IOError, OSError) as e:
+            log.warning('Could not write the timing summary: %s', e)
+    if statsd_address:
+        try:
+            send_statsd(statsd_address, statsd_prefix, summary)
+        except (socket.error, ValueError) as e:
+            log.warning('Could not send the timing summary: %s', e)
@@ -0,0 +1,43 @@
+import os
+import stat
+
+import mock
+import pytest
+
+from synapse_tools.atomic_file import is_temporary_file
+from synapse_tools.atomic_file import write_atomically
+
+
+def test_write_atomically(tmpdir):
+    path = tmpdir.join('file.json')
+    path.write('old')
+
+    write_atomically(path.strpath, 'new', mode=0o644)
+
+    assert path.read() == 'new'
+    assert stat.S_IMODE(os.stat(path.strpath).st_mode) == 0o644
+    assert tmpdir.listdir() == [path]
+
+
+def test_write_atomically_failure_keeps_old_file(tmpdir):
+    path = tmpdir.join('file.json')
+    path.write('old')
+
+    with mock.patch.object(os, 'rename', side_effect=OSError):
+        with pytest.raises(OSError):
+            write_atomically(path.strpath, 'new')
+
+    assert path.read() == 'old'
+    assert tmpdir.listdir() == [path]
+
+
+def test_is_temporary_file(tmpdir):
+    path = tmpdir.join('file.json').strpath
+
+    with mock.patch.object(os, 'rename', side_effect=OSError) as mock_rename:
+        with pytest.raises(OSError):
+            write_atomically(path, 'new')
+
+    assert is_temporary_file(mock_rename.call_args[0][0], path)
+    assert not is_temporary_file(path, path)
+    assert not is_temporary_file(tmpdir.join('file.json.sha256').strpath, path)
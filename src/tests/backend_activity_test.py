@@ -0,0 +1,67 @@
+import json
+
+from synapse_tools.backend_activity import BackendActivity
+from synapse_tools.backend_activity import get_health_commands
+
+
+def test_new_backends_are_active():
+    activity = BackendActivity()
+    activity.observe({'foo.main': 10, 'bar.main': 0}, now=1000)
+
+    assert activity.idle_backends(60, now=1059) == set()
+    assert activity.idle_backends(60, now=1060) == {'foo.main', 'bar.main'}
+
+
+def test_sessions_make_backends_active():
+    activity = BackendActivity()
+    activity.observe({'foo.main': 10, 'bar.main': 0}, now=1000)
+    activity.observe({'foo.main': 11, 'bar.main': 0}, now=1030)
+
+    assert activity.idle_backends(60, now=1060) == {'bar.main'}
+    assert activity.idle_backends(60, now=1090) == {'foo.main', 'bar.main'}
+
+
+def test_counter_reset():
+    activity = BackendActivity()
+    activity.observe({'foo.main': 10, 'bar.main': 10}, now=1000)
+    # HAProxy was reloaded, only foo.main got sessions since
+    activity.observe({'foo.main': 2, 'bar.main': 0}, now=1030)
+
+    assert activity.idle_backends(60, now=1060) == {'bar.main'}
+
+
+def test_removed_backends_are_forgotten():
+    activity = BackendActivity()
+    activity.observe({'foo.main': 10, 'bar.main': 0}, now=1000)
+    activity.observe({'foo.main': 10}, now=1030)
+
+    assert activity.idle_backends(60, now=1060) == {'foo.main'}
+
+
+def test_state_round_trip():
+    activity = BackendActivity()
+    activity.observe({'foo.main': 10}, now=1000)
+
+    loaded = BackendActivity(state=json.loads(json.dumps(activity.state())))
+    loaded.observe({'foo.main': 10}, now=1030)
+    assert loaded.idle_backends(60, now=1060) == {'foo.main'}
+
+
+def test_get_health_commands():
+    stats = [
+        {'pxname': 'cold.main', 'svname': 'FRONTEND', 'status': 'OPEN'},
+        {'pxname': 'cold.main', 'svname': 'BACKEND', 'status': 'UP'},
+        {'pxname': 'cold.main', 'svname': '10.0.0.1:1234', 'status': 'UP'},
+        {'pxname': 'cold.main', 'svname': '10.0.0.2:1234', 'status': 'no check'},
+        {'pxname': 'cold.main', 'svname': '10.0.0.3:1234', 'status': 'DRAIN'},
+        {'pxname': 'hot.main', 'svname': '10.0.0.1:1234', 'status': 'DOWN'},
+        {'pxname': 'hot.main', 'svname': '10.0.0.2:1234', 'status': 'no check'},
+        {'pxname': 'hot.main', 'svname': '10.0.0.3:1234', 'status': 'MAINT'},
+        # Not health checked in the config, never started
+        {'pxname': 'unchecked.main', 'svname': '10.0.0.1:1234', 'status': 'no check'},
+    ]
+
+    assert get_health_commands(stats, {'cold.main', 'unchecked.main'}, {'cold.main', 'hot.main'}) == [
+        'disable health cold.main/10.0.0.1:1234',
+        'enable health hot.main/10.0.0.2:1234',
+    ]
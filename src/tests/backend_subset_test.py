@@ -0,0 +1,123 @@
+import collections
+
+from synapse_tools.backend_subset import get_address_subset
+from synapse_tools.backend_subset import get_subset
+from synapse_tools.backend_subset import get_subset_commands
+
+
+SERVERS = ['10.0.0.%d:1234' % i for i in range(20)]
+HOSTNAMES = ['host%d' % i for i in range(1000)]
+
+
+def test_get_subset_is_deterministic():
+    subset = get_subset('host1', SERVERS, 5)
+    assert len(subset) == 5
+    assert subset <= set(SERVERS)
+    assert get_subset('host1', list(reversed(SERVERS)), 5) == subset
+    assert get_subset('host2', SERVERS, 5) != subset
+
+
+def test_get_subset_with_fewer_servers():
+    assert get_subset('host1', SERVERS[:3], 5) == set(SERVERS[:3])
+
+
+def test_get_subset_is_spread_evenly():
+    counts = collections.Counter()
+    for hostname in HOSTNAMES:
+        counts.update(get_subset(hostname, SERVERS, 5))
+
+    # Each server is in the subset of a quarter of the hosts
+    assert set(counts) == set(SERVERS)
+    assert all(200 < count < 300 for count in counts.values())
+
+
+def test_get_subset_changes_minimally():
+    for hostname in HOSTNAMES[:100]:
+        subset = get_subset(hostname, SERVERS, 5)
+        # A new server replaces at most one server of a subset
+        assert len(subset - get_subset(hostname, SERVERS + ['10.0.0.100:1234'], 5)) <= 1
+        # A removed server is only replaced in the subsets it was in
+        removed = SERVERS[0]
+        new_subset = get_subset(hostname, SERVERS[1:], 5)
+        if removed in subset:
+            assert len(subset - new_subset) == 1
+        else:
+            assert new_subset == subset
+
+
+def test_get_subset_commands():
+    subset = get_subset('host1', SERVERS[:4], 2)
+    stats = [
+        {'pxname': 'foo.main', 'svname': 'FRONTEND', 'status': 'OPEN'},
+        {'pxname': 'foo.main', 'svname': 'BACKEND', 'status': 'UP'},
+        {'pxname': 'bar.main', 'svname': SERVERS[0], 'status': 'UP'},
+    ] + [
+        {
+            'pxname': 'foo.main',
+            'svname': server,
+            # One server of the subset and one outside of it are drained
+            'status': 'DRAIN' if i % 2 else 'UP',
+        }
+        for i, server in enumerate(SERVERS[:4])
+    ]
+    in_use = {server for i, server in enumerate(SERVERS[:4]) if not i % 2}
+
+    commands = get_subset_commands('host1', stats, {'foo.main': 2}, {'foo.main': set(SERVERS[:4])})
+
+    expected = []
+    for server in subset - in_use:
+        expected.append('set server foo.main/{0} state ready'.format(server))
+        expected.append('enable health foo.main/{0}'.format(server))
+    for server in in_use - subset:
+        expected.append('set server foo.main/{0} state drain'.format(server))
+        expected.append('disable health foo.main/{0}'.format(server))
+    assert expected
+    assert sorted(commands) == sorted(expected)
+
+
+def test_get_subset_commands_only_uses_discovered_servers():
+    discovered = set(SERVERS[:4])
+    subset = get_subset('host1', discovered, 2)
+    stats = [
+        # Named the way synapse names servers with a name
+        {'pxname': 'foo.main', 'svname': '{0}_name'.format(server), 'status': 'MAINT'}
+        for server in SERVERS[:4]
+    ] + [
+        # Put in maintenance by synapse when it left discovery, and ranked
+        # first by every host
+        {'pxname': 'foo.main', 'svname': server, 'status': 'MAINT'}
+        for server in SERVERS[4:]
+    ]
+
+    commands = get_subset_commands('host1', stats, {'foo.main': 2}, {'foo.main': discovered})
+
+    assert sorted(commands) == sorted(
+        ['set server foo.main/{0}_name state ready'.format(server) for server in subset] +
+        ['enable health foo.main/{0}_name'.format(server) for server in subset],
+    )
+
+
+def test_get_subset_commands_keeps_drained_servers_drained():
+    stats = [
+        # Taken out of maintenance by synapse, which leaves draining alone
+        {'pxname': 'foo.main', 'svname': server, 'status': 'DRAIN'}
+        for server in SERVERS[:4]
+    ]
+    subset = get_subset('host1', SERVERS[:4], 2)
+
+    commands = get_subset_commands('host1', stats, {'foo.main': 2}, {'foo.main': set(SERVERS[:4])})
+
+    assert not any('drain' in command for command in commands)
+    assert len(commands) == 2 * len(subset)
+
+
+def test_get_address_subset():
+    servers = {tuple(server.split(':')) for server in SERVERS}
+    assert get_address_subset('host1', servers, 5) == {
+        tuple(server.split(':')) for server in get_subset('host1', SERVERS, 5)
+    }
+
+
+def test_get_subset_commands_without_discovered_servers():
+    stats = [{'pxname': 'foo.main', 'svname': SERVERS[0], 'status': 'UP'}]
+    assert get_subset_commands('host1', stats, {'foo.main': 1}, {}) == []
@@ -0,0 +1,123 @@
+import json
+import time
+
+import mock
+import pytest
+
+from synapse_tools import batch_render
+from synapse_tools import config_artifacts
+from synapse_tools import configure_synapse
+
+
+LOCATION_TYPES = ['ecosystem', 'superregion', 'region', 'habitat']
+
+SERVICES = [
+    ('region_service.main', {'proxy_port': 1234}),
+    (
+        'habitat_service.main',
+        {'proxy_port': 1235, 'discover': 'habitat', 'advertise': ['habitat', 'region']},
+    ),
+]
+
+
+def make_host_facts(hostname, habitat):
+    return batch_render.StaticHostFacts(
+        hostname=hostname,
+        location_types=LOCATION_TYPES,
+        locations={
+            'ecosystem': 'prod', 'superregion': 'norcal', 'region': 'uswest1', 'habitat': habitat,
+        },
+    )
+
+
+def test_load_hosts(tmpdir):
+    hosts_path = tmpdir.join('hosts.json')
+    hosts_path.write(json.dumps({
+        'location_types': ['region', 'habitat'],
+        'hosts': [
+            {'hostname': 'host1', 'locations': {'region': 'uswest1', 'habitat': 'a'}},
+            {
+                'hostname': 'host2',
+                'locations': {'region': 'uswest1', 'habitat': 'b'},
+                'groupings': {'ecosystem': 'prod'},
+            },
+        ],
+    }))
+
+    host1, host2 = batch_render.load_hosts(hosts_path.strpath)
+
+    assert host1.hostname == 'host1'
+    assert host1.location_types == ('region', 'habitat')
+    assert host1.location('habitat') == 'a'
+    assert host1.grouping('ecosystem') is None
+    assert host2.grouping('ecosystem') == 'prod'
+
+
+def test_load_hosts_with_missing_location(tmpdir):
+    hosts_path = tmpdir.join('hosts.json')
+    hosts_path.write(json.dumps({
+        'location_types': ['region', 'habitat'],
+        'hosts': [{'hostname': 'host1', 'locations': {'region': 'uswest1'}}],
+    }))
+
+    with pytest.raises(ValueError):
+        batch_render.load_hosts(hosts_path.strpath)
+
+
+def test_write_artifacts(tmpdir):
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    zookeeper_topology = ['1.2.3.4:2181']
+    all_host_facts = [
+        make_host_facts('host1', 'a'),
+        make_host_facts('host2', 'a'),
+        make_host_facts('host3', 'b'),
+    ]
+
+    with mock.patch(
+        'synapse_tools.configure_synapse._generate_watchers_for_service',
+        wraps=configure_synapse._generate_watchers_for_service,
+    ) as mock_generate_watchers:
+        services_digests = batch_render.write_artifacts(
+            tmpdir.strpath, synapse_tools_config, zookeeper_topology, iter(SERVICES), all_host_facts,
+            time.time(),
+        )
+
+    # The region service is rendered once for all hosts, the habitat
+    # service once for each habitat
+    assert mock_generate_watchers.call_count == 3
+    assert len(services_digests) == 2
+
+    inputs_digest = config_artifacts.get_inputs_digest(synapse_tools_config, zookeeper_topology)
+    for host_facts in all_host_facts:
+        expected = configure_synapse.generate_configuration(
+            synapse_tools_config, zookeeper_topology, SERVICES,
+            host_facts=make_host_facts(host_facts.hostname, host_facts.location('habitat')),
+        )
+        actual = config_artifacts.load_host_config(tmpdir.strpath, host_facts.hostname, inputs_digest, 60)
+        assert configure_synapse.serialize_synapse_config(actual) == \
+            configure_synapse.serialize_synapse_config(expected)
+
+
+def test_render_hosts_generates_once_per_locations():
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    all_host_facts = [
+        make_host_facts('host1', 'a'),
+        make_host_facts('host2', 'a'),
+        make_host_facts('host3', 'b'),
+    ]
+
+    with mock.patch(
+        'synapse_tools.batch_render.generate_configuration',
+        wraps=configure_synapse.generate_configuration,
+    ) as mock_generate_configuration:
+        synapse_configs = dict(
+            (host_facts.hostname, synapse_config)
+            for host_facts, synapse_config in batch_render.render_hosts(
+                synapse_tools_config, ['1.2.3.4:2181'], iter(SERVICES), all_host_facts,
+            )
+        )
+
+    assert mock_generate_configuration.call_count == 2
+    assert synapse_configs['host1']['services'] is synapse_configs['host2']['services']
+    assert synapse_configs['host2']['haproxy']['server_order_seed'] == hash('host2')
+    assert synapse_configs['host1']['haproxy']['server_order_seed'] == hash('host1')
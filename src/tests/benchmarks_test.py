@@ -0,0 +1,65 @@
+import copy
+
+from benchmarks import catalog
+from benchmarks import generate_configuration
+
+
+def test_build_catalog_is_deterministic():
+    assert catalog.build_catalog(200) == catalog.build_catalog(200)
+    assert catalog.build_catalog(200) != catalog.build_catalog(200, seed=1)
+
+
+def test_build_catalog_covers_the_features():
+    services = catalog.build_catalog(1000)
+    service_infos = [service_info for _, service_info in services]
+
+    assert len(services) == len(dict(services)) == 1000
+    assert {info['mode'] for info in service_infos} == {'http', 'tcp'}
+    assert {info['discover'] for info in service_infos} == {'habitat', 'region', 'superregion'}
+    for key in ('chaos', 'plugins', 'extra_headers', 'proxied_through', 'is_proxy'):
+        assert any(key in info for info in service_infos), key
+
+
+def test_run_benchmark():
+    result = generate_configuration.run_benchmark(50)
+
+    assert result['size'] == 50
+    assert result['watchers'] > 0
+    assert result['output_bytes'] > 0
+    assert result['generate_time_s'] > 0
+    assert result['cached_generate_time_s'] > 0
+
+
+def test_compare_to_baseline():
+    baseline = {
+        'size': 1000, 'watchers': 10, 'output_bytes': 1000,
+        'generate_time_s': 1.0, 'serialize_time_s': 0.01, 'peak_memory_kb': 100000,
+    }
+    baselines = {'1000': baseline}
+    assert generate_configuration.compare_to_baseline([baseline], baselines) == []
+
+    result = dict(baseline, generate_time_s=1.1, serialize_time_s=0.03, peak_memory_kb=103000)
+    assert generate_configuration.compare_to_baseline([result], baselines) == []
+
+    result = copy.deepcopy(baseline)
+    result.update(generate_time_s=1.5, output_bytes=1001)
+    assert [size for size, _ in generate_configuration.compare_to_baseline([result], baselines)] == [1000, 1000]
+
+    # Sizes without a baseline are not compared
+    assert generate_configuration.compare_to_baseline([dict(result, size=5)], baselines) == []
+
+    # Nor metrics without one
+    result = dict(baseline, cached_generate_time_s=1.0)
+    assert generate_configuration.compare_to_baseline([result], baselines) == []
+
+
+def test_check_render_cache():
+    result = {'size': 1000, 'generate_time_s': 1.0, 'cached_generate_time_s': 0.2}
+    assert generate_configuration.check_render_cache([result]) == []
+
+    result = dict(result, cached_generate_time_s=0.9)
+    assert [size for size, _ in generate_configuration.check_render_cache([result])] == [1000]
+
+    # Too fast to tell
+    result = {'size': 10, 'generate_time_s': 0.01, 'cached_generate_time_s': 0.01}
+    assert generate_configuration.check_render_cache([result]) == []
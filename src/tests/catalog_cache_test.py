@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+
+import mock
+import pytest
+from paasta_tools.marathon_tools import get_all_namespaces
+
+from synapse_tools import catalog_cache
+
+
+@pytest.fixture
+def soa_dir(tmpdir):
+    tmpdir.join('foo', 'smartstack.yaml').write(
+        'main:\n  proxy_port: 1234\ncanary:\n  proxy_port: 1235\n', ensure=True)
+    tmpdir.join('bar', 'smartstack.yaml').write('main:\n  proxy_port: 2345\n', ensure=True)
+    tmpdir.join('baz', 'service.yaml').write('description: no smartstack\n', ensure=True)
+    return tmpdir
+
+
+def get_namespaces(cache, soa_dir):
+    with mock.patch.object(
+        catalog_cache, '_read_namespaces', side_effect=catalog_cache._read_namespaces,
+    ) as mock_read_namespaces:
+        namespaces = cache.get_all_namespaces(soa_dir.strpath)
+    return namespaces, sorted(c[0][0] for c in mock_read_namespaces.call_args_list)
+
+
+def test_get_all_namespaces_matches_paasta(soa_dir):
+    cache = catalog_cache.CatalogCache()
+    expected = get_all_namespaces(soa_dir=soa_dir.strpath)
+
+    assert get_namespaces(cache, soa_dir) == (expected, ['bar', 'baz', 'foo'])
+    assert cache.dirty
+    # Nothing is parsed again while nothing changed
+    cache.dirty = False
+    assert get_namespaces(cache, soa_dir) == (expected, [])
+    assert not cache.dirty
+
+
+def test_get_all_namespaces_only_parses_changed_files(soa_dir):
+    cache = catalog_cache.CatalogCache()
+    get_namespaces(cache, soa_dir)
+    cache.dirty = False
+
+    soa_dir.join('bar', 'smartstack.yaml').write('main:\n  proxy_port: 2346\n')
+    soa_dir.join('foo').remove()
+    soa_dir.join('new', 'smartstack.yaml').write('main:\n  proxy_port: 3456\n', ensure=True)
+
+    namespaces, parsed = get_namespaces(cache, soa_dir)
+
+    assert parsed == ['bar', 'new']
+    assert sorted(namespaces) == sorted(get_all_namespaces(soa_dir=soa_dir.strpath))
+    assert ('bar.main', {'proxy_port': 2346}) in namespaces
+    assert sorted(os.path.basename(os.path.dirname(path)) for path in cache.entries) == ['bar', 'baz', 'new']
+    assert cache.dirty
+
+
+def test_service_yaml_overrides_smartstack_yaml(soa_dir):
+    cache = catalog_cache.CatalogCache()
+    get_namespaces(cache, soa_dir)
+
+    soa_dir.join('foo', 'service.yaml').write('smartstack:\n  main:\n    proxy_port: 4567\n')
+    soa_dir.join('baz', 'service.yaml').write('smartstack:\n  main:\n    proxy_port: 5678\n')
+
+    namespaces, parsed = get_namespaces(cache, soa_dir)
+
+    assert parsed == ['baz', 'foo']
+    assert sorted(namespaces) == sorted(get_all_namespaces(soa_dir=soa_dir.strpath))
+    assert ('foo.main', {'proxy_port': 4567}) in namespaces
+    assert ('baz.main', {'proxy_port': 5678}) in namespaces
+
+
+def test_iter_namespaces_with_pool(soa_dir):
+    for i in range(40):
+        soa_dir.join('service_%d' % i, 'smartstack.yaml').write('main:\n  proxy_port: %d\n' % i, ensure=True)
+    expected = get_all_namespaces(soa_dir=soa_dir.strpath)
+    cache = catalog_cache.CatalogCache()
+
+    pool = multiprocessing.Pool(2)
+    try:
+        namespaces = cache.iter_namespaces(soa_dir.strpath, pool=pool)
+        assert not isinstance(namespaces, list)
+        assert list(namespaces) == expected
+    finally:
+        pool.terminate()
+        pool.join()
+
+    assert len(cache.entries) == 43
+    assert get_namespaces(cache, soa_dir) == (expected, [])
+
+
+def test_catalog_cache_round_trip(soa_dir, tmpdir):
+    path = tmpdir.join('catalog.cache').strpath
+    cache = catalog_cache.CatalogCache()
+    expected, _ = get_namespaces(cache, soa_dir)
+    cache.save(path)
+    assert not cache.dirty
+
+    loaded = catalog_cache.CatalogCache.load(path)
+    assert loaded.entries == cache.entries
+    assert get_namespaces(loaded, soa_dir) == (expected, [])
+
+
+def test_load_ignores_missing_or_outdated_files(tmpdir):
+    assert catalog_cache.CatalogCache.load(tmpdir.join('missing').strpath).entries == {}
+
+    tmpdir.join('garbage').write('garbage')
+    assert catalog_cache.CatalogCache.load(tmpdir.join('garbage').strpath).entries == {}
+
+    path = tmpdir.join('old').strpath
+    catalog_cache.CatalogCache({'/a/smartstack.yaml': (None, [])}).save(path)
+    with mock.patch.object(catalog_cache, 'CATALOG_CACHE_VERSION', catalog_cache.CATALOG_CACHE_VERSION + 1):
+        assert catalog_cache.CatalogCache.load(path).entries == {}
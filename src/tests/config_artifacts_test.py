@@ -0,0 +1,90 @@
+import os
+import time
+
+import mock
+
+from synapse_tools import config_artifacts
+
+
+def write_host_config(artifact_dir, synapse_config, inputs='inputs', rendered_at=None):
+    digest = config_artifacts.write_services(artifact_dir, synapse_config['services'])
+    config_artifacts.write_host_config(
+        artifact_dir, 'host1', synapse_config, digest, inputs,
+        time.time() if rendered_at is None else rendered_at,
+    )
+    return digest
+
+
+def test_host_config_round_trip(tmpdir):
+    synapse_config = {'haproxy': {'server_order_seed': 42}, 'services': {'foo': {'port': 1}}}
+    write_host_config(tmpdir.strpath, synapse_config)
+
+    assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) == synapse_config
+    # The config passed in is left alone
+    assert 'services' in synapse_config
+
+
+def test_services_are_content_addressed(tmpdir):
+    digest = config_artifacts.write_services(tmpdir.strpath, {'foo': {}})
+    assert config_artifacts.write_services(tmpdir.strpath, {'foo': {}}) == digest
+    other_digest = config_artifacts.write_services(tmpdir.strpath, {'bar': {}})
+    assert other_digest != digest
+    assert sorted(os.listdir(tmpdir.join('services').strpath)) == sorted(
+        ['{0}.json'.format(digest), '{0}.json'.format(other_digest)],
+    )
+
+
+def test_prune(tmpdir):
+    digest = write_host_config(tmpdir.strpath, {'services': {'foo': {}}})
+    old_digest = config_artifacts.write_services(tmpdir.strpath, {'old': {}})
+    config_artifacts.write_host_config(tmpdir.strpath, 'old_host', {'services': {}}, old_digest, 'inputs', 0)
+
+    assert config_artifacts.prune(tmpdir.strpath, ['host1', 'new_host'], {digest}) == 2
+
+    assert os.listdir(tmpdir.join('hosts').strpath) == ['host1.json']
+    assert os.listdir(tmpdir.join('services').strpath) == ['{0}.json'.format(digest)]
+    assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) is not None
+
+
+def test_prune_without_artifacts(tmpdir):
+    assert config_artifacts.prune(tmpdir.strpath, ['host1'], set()) == 0
+
+
+def test_load_host_config_missing(tmpdir):
+    assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) is None
+
+
+def test_load_host_config_from_other_inputs(tmpdir):
+    write_host_config(tmpdir.strpath, {'services': {}})
+
+    assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'other_inputs', 60) is None
+
+
+def test_load_host_config_too_old(tmpdir):
+    write_host_config(tmpdir.strpath, {'services': {}}, rendered_at=1000)
+
+    with mock.patch.object(config_artifacts.time, 'time', return_value=1060):
+        assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) is not None
+    with mock.patch.object(config_artifacts.time, 'time', return_value=1061):
+        assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) is None
+
+
+def test_load_host_config_with_corrupt_services(tmpdir):
+    digest = write_host_config(tmpdir.strpath, {'services': {'foo': {}}})
+    tmpdir.join('services', '{0}.json'.format(digest)).write('{"foo": {"port": 2}}')
+
+    assert config_artifacts.load_host_config(tmpdir.strpath, 'host1', 'inputs', 60) is None
+
+
+def test_inputs_digest():
+    digest = config_artifacts.get_inputs_digest({'a': 1}, ['1.2.3.4:2181'])
+    assert digest == config_artifacts.get_inputs_digest({'a': 1}, ['1.2.3.4:2181'])
+    assert digest != config_artifacts.get_inputs_digest({'a': 2}, ['1.2.3.4:2181'])
+    assert digest != config_artifacts.get_inputs_digest({'a': 1}, ['1.2.3.5:2181'])
+
+
+def test_inputs_digest_ignores_host_local_options():
+    digest = config_artifacts.get_inputs_digest({'a': 1}, ['1.2.3.4:2181'])
+    assert digest == config_artifacts.get_inputs_digest(
+        {'a': 1, 'render_processes': 4, 'restart_jitter_window_s': 60}, ['1.2.3.4:2181'],
+    )
@@ -0,0 +1,125 @@
+import copy
+
+import pytest
+
+from synapse_tools import config_diff
+
+
+@pytest.fixture
+def old_config():
+    return {
+        'haproxy': {
+            'global': ['daemon', 'maxconn 10000'],
+            'defaults': ['timeout connect 200ms'],
+        },
+        'services': {
+            'foo.main': {
+                'discovery': {'method': 'zookeeper', 'path': '/smartstack/global/foo.main'},
+                'haproxy': {
+                    'port': '1234',
+                    'server_options': 'check port 6666 observe layer7 maxconn 50 maxqueue 10',
+                    'frontend': ['timeout client 1000ms'],
+                    'backend': ['timeout server 1000ms'],
+                },
+            },
+            'foo.main.superregion': {
+                'discovery': {'method': 'zookeeper', 'path': '/smartstack/global/foo.main'},
+                'haproxy': {
+                    'backend_name': 'foo.main.superregion',
+                    'server_options': 'check port 6666 observe layer7 maxconn 50 maxqueue 10',
+                    'backend': ['timeout server 1000ms'],
+                },
+            },
+        },
+    }
+
+
+def test_identical_configs_need_nothing(old_config):
+    change = config_diff.classify_change(old_config, copy.deepcopy(old_config))
+    assert change == config_diff.ConfigChange(config_diff.NO_ACTION, [], [])
+
+
+def test_unknown_current_config_needs_restart(old_config):
+    assert config_diff.classify_change(None, old_config).action == config_diff.RESTART
+
+
+def test_server_maxconn_is_a_runtime_update(old_config):
+    new_config = copy.deepcopy(old_config)
+    for watcher in new_config['services'].values():
+        watcher['haproxy']['server_options'] = 'check port 6666 observe layer7 maxconn 80 maxqueue 10'
+
+    change = config_diff.classify_change(old_config, new_config)
+
+    assert change.action == config_diff.RUNTIME_UPDATE
+    assert change.runtime_updates == [
+        config_diff.RuntimeUpdate('foo.main', 'maxconn', 80),
+        config_diff.RuntimeUpdate('foo.main.superregion', 'maxconn', 80),
+    ]
+
+
+def test_global_maxconn_is_a_runtime_update(old_config):
+    new_config = copy.deepcopy(old_config)
+    new_config['haproxy']['global'] = ['daemon', 'maxconn 20000']
+
+    change = config_diff.classify_change(old_config, new_config)
+
+    assert change.action == config_diff.RUNTIME_UPDATE
+    assert change.runtime_updates == [config_diff.RuntimeUpdate(None, 'maxconn', 20000)]
+
+
+@pytest.mark.parametrize('mutate,reason', [
+    (lambda c: c['haproxy']['defaults'].append('retries 1'), 'haproxy.defaults changed'),
+    (lambda c: c['haproxy']['global'].append('nbproc 2'), 'haproxy.global changed'),
+    (lambda c: c['services'].pop('foo.main'), 'foo.main removed'),
+    (lambda c: c['services'].update({'bar.main': {}}), 'bar.main added'),
+    (lambda c: c['services']['foo.main']['haproxy'].update({'port': '4321'}), 'foo.main changed'),
+    (
+        lambda c: c['services']['foo.main']['haproxy'].update({'server_options': 'check maxconn 50'}),
+        'foo.main changed',
+    ),
+    (lambda c: c.update({'file_output': {}}), 'file_output changed'),
+])
+def test_other_changes_need_restart(old_config, mutate, reason):
+    new_config = copy.deepcopy(old_config)
+    # Runtime updates are dropped when a restart is needed anyway
+    new_config['haproxy']['global'] = ['daemon', 'maxconn 20000']
+    mutate(new_config)
+
+    change = config_diff.classify_change(old_config, new_config)
+
+    assert change == config_diff.ConfigChange(config_diff.RESTART, [reason], [])
+
+
+def test_get_runtime_commands():
+    updates = [
+        config_diff.RuntimeUpdate(None, 'maxconn', 20000),
+        config_diff.RuntimeUpdate('foo.main', 'maxconn', 80),
+        config_diff.RuntimeUpdate('bar.main', 'maxconn', 80),
+    ]
+    servers_by_backend = {'foo.main': ['10.0.0.1:1234_a', '10.0.0.2:1234_b']}
+
+    assert config_diff.get_runtime_commands(updates, servers_by_backend) == [
+        'set maxconn global 20000',
+        'set maxconn server foo.main/10.0.0.1:1234_a 80',
+        'set maxconn server foo.main/10.0.0.2:1234_b 80',
+    ]
+
+
+def test_get_outdated_runtime_commands():
+    updates = [
+        config_diff.RuntimeUpdate(None, 'maxconn', 20000),
+        config_diff.RuntimeUpdate('foo.main', 'maxconn', 80),
+        config_diff.RuntimeUpdate('bar.main', 'maxconn', 80),
+    ]
+    stats = [
+        {'pxname': 'foo.main', 'svname': 'FRONTEND', 'slim': '10000'},
+        {'pxname': 'foo.main', 'svname': '10.0.0.1:1234_a', 'slim': '80'},
+        # Reloaded or added by synapse
+        {'pxname': 'foo.main', 'svname': '10.0.0.2:1234_b', 'slim': '50'},
+        {'pxname': 'foo.main', 'svname': 'BACKEND', 'slim': '1000'},
+    ]
+
+    assert config_diff.get_outdated_runtime_commands(updates, stats) == [
+        'set maxconn global 20000',
+        'set maxconn server foo.main/10.0.0.2:1234_b 80',
+    ]
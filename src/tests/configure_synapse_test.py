@@ -1,9 +1,22 @@
 import contextlib
+import copy
+import json
+import pstats
+import subprocess
+import time
 
 import mock
 import pytest
 
+from synapse_tools import config_artifacts
 from synapse_tools import configure_synapse
+from synapse_tools.backend_subset import get_subset
+from synapse_tools.catalog_cache import CatalogCache
+from synapse_tools.config_plugins.logging import Logging
+from synapse_tools.config_plugins.proxied_through import ProxiedThrough
+from synapse_tools.haproxy import runtime_api
+from synapse_tools.restart_scheduler import get_host_jitter_s
+from synapse_tools.service_config import InvalidServiceConfigError
 
 
 @pytest.yield_fixture
@@ -40,6 +53,80 @@ def mock_available_location_types():
         yield
 
 
+def test_host_facts_looks_up_each_fact_once(mock_available_location_types):
+    with contextlib.nested(
+        mock.patch('synapse_tools.configure_synapse.get_current_location', return_value='my_region'),
+        mock.patch('synapse_tools.configure_synapse.get_my_grouping', return_value='my_ecosystem'),
+        mock.patch('socket.gethostname', return_value='my_host'),
+    ) as (mock_get_current_location, mock_get_my_grouping, _):
+        host_facts = configure_synapse.HostFacts.from_host()
+        for _ in range(3):
+            assert host_facts.location('region') == 'my_region'
+            assert host_facts.grouping('ecosystem') == 'my_ecosystem'
+
+    assert host_facts.hostname == 'my_host'
+    mock_get_current_location.assert_called_once_with('region')
+    mock_get_my_grouping.assert_called_once_with('ecosystem')
+
+
+def test_host_facts_compare_types():
+    host_facts = configure_synapse.HostFacts(
+        hostname='my_host',
+        location_types=['superregion', 'region', 'habitat'],
+    )
+    assert host_facts.compare_types('superregion', 'habitat') < 0
+    assert host_facts.compare_types('region', 'region') == 0
+    assert host_facts.compare_types('habitat', 'region') > 0
+
+
+def test_generate_configuration_with_explicit_host_facts():
+    host_facts = configure_synapse.HostFacts(
+        hostname='other_host',
+        location_types=['ecosystem', 'superregion', 'region', 'habitat'],
+        locations={'region': 'other_region', 'superregion': 'other_superregion'},
+        groupings={'ecosystem': 'other_ecosystem'},
+    )
+    with contextlib.nested(
+        mock.patch('synapse_tools.configure_synapse.available_location_types', side_effect=AssertionError),
+        mock.patch('synapse_tools.configure_synapse.get_current_location', side_effect=AssertionError),
+        mock.patch('synapse_tools.configure_synapse.get_my_grouping', side_effect=AssertionError),
+    ):
+        actual_configuration = configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                (
+                    'test_service',
+                    {
+                        'proxy_port': 1234,
+                        'advertise': ['region', 'superregion'],
+                        'chaos': {'ecosystem': {'other_ecosystem': {'fail': 'drop'}}},
+                    },
+                ),
+            ],
+            host_facts=host_facts,
+        )
+
+    assert actual_configuration['haproxy']['server_order_seed'] == hash('other_host')
+    services = actual_configuration['services']
+    assert services['test_service']['discovery']['label_filters'][0]['label'] == 'region:other_region'
+    assert services['test_service.superregion']['discovery']['label_filters'][0]['label'] == \
+        'superregion:other_superregion'
+    assert 'tcp-request content reject' in services['test_service']['haproxy']['frontend']
+
+
+def test_section_builder():
+    lines = ['daemon', 'maxconn 10']
+    section = configure_synapse.SectionBuilder(lines)
+
+    section.extend(['lua-load a.lua', 'daemon', 'lua-load a.lua', 'lua-load b.lua'])
+
+    assert section.lines is lines
+    assert lines == ['daemon', 'maxconn 10', 'lua-load a.lua', 'lua-load b.lua']
+    assert 'lua-load b.lua' in section
+    assert 'lua-load c.lua' not in section
+
+
 def test_get_zookeeper_topology():
     m = mock.mock_open()
     with contextlib.nested(
@@ -1087,44 +1174,381 @@ def test_generate_configuration_with_multiple_plugins(mock_get_current_location,
     assert 'lua-load' and 'path_based_routing' in actual_global[-1]
 
 
+def test_generate_configuration_shares_static_watcher_parts(mock_get_current_location, mock_available_location_types):
+    zookeeper_topology = ['1.2.3.4', '2.3.4.5']
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=zookeeper_topology,
+        services=[
+            (
+                'test_service',
+                {
+                    'proxy_port': 1234,
+                    'advertise': ['region', 'superregion'],
+                    'is_proxy': True,
+                    'plugins': {'logging': {'enabled': True}},
+                },
+            ),
+            ('other_service', {'proxy_port': 5678}),
+        ]
+    )
+    services = actual_configuration['services']
+    main_watcher = services['test_service']
+    superregion_watcher = services['test_service.superregion']
+
+    for watcher in services.values():
+        assert watcher['discovery']['hosts'] is zookeeper_topology
+    assert main_watcher['discovery'] is not superregion_watcher['discovery']
+
+    # Plugin options only go into the backend of the main watcher
+    assert main_watcher['haproxy']['backend'] is not superregion_watcher['haproxy']['backend']
+    assert 'http-request lua.init_logging' in main_watcher['haproxy']['backend']
+    assert 'http-request lua.init_logging' not in superregion_watcher['haproxy']['backend']
+
+
+def test_generate_configuration_render_cache_reuses_unchanged_services(mock_get_current_location, mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    services = [
+        ('test_service', {'proxy_port': 1234, 'advertise': ['region', 'superregion']}),
+        ('other_service', {'proxy_port': 5678}),
+    ]
+    render_cache = {}
+
+    uncached_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=services,
+    )
+    first_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=services,
+        render_cache=render_cache,
+    )
+    assert len(render_cache) == 2
+
+    with mock.patch(
+        'synapse_tools.configure_synapse.base_watcher_cfg_for_service',
+    ) as mock_base_watcher_cfg_for_service:
+        second_configuration = configure_synapse.generate_configuration(
+            synapse_tools_config=synapse_tools_config,
+            zookeeper_topology=['1.2.3.4'],
+            services=services,
+            render_cache=render_cache,
+        )
+    assert not mock_base_watcher_cfg_for_service.called
+
+    assert first_configuration == uncached_configuration
+    assert second_configuration == uncached_configuration
+
+
+def test_generate_configuration_render_cache_rerenders_changed_services(mock_get_current_location, mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    render_cache = {}
+    configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('test_service', {'proxy_port': 1234, 'retries': 1}),
+            ('other_service', {'proxy_port': 5678}),
+        ],
+        render_cache=render_cache,
+    )
+    stale_fingerprints = set(render_cache)
+
+    with mock.patch(
+        'synapse_tools.configure_synapse.base_watcher_cfg_for_service',
+        wraps=configure_synapse.base_watcher_cfg_for_service,
+    ) as mock_base_watcher_cfg_for_service:
+        actual_configuration = configure_synapse.generate_configuration(
+            synapse_tools_config=synapse_tools_config,
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                ('test_service', {'proxy_port': 1234, 'retries': 2}),
+            ],
+            render_cache=render_cache,
+        )
+
+    assert mock_base_watcher_cfg_for_service.call_count == 1
+    assert 'retries 2' in actual_configuration['services']['test_service']['haproxy']['backend']
+    # Neither the old test_service entry nor the removed service are kept
+    assert len(render_cache) == 1
+    assert not stale_fingerprints & set(render_cache)
+
+
+def test_generate_configuration_render_cache_depends_on_location(mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    render_cache = {}
+    for region in ('my_region', 'other_region'):
+        with mock.patch(
+            'synapse_tools.configure_synapse.get_current_location',
+            return_value=region,
+        ):
+            actual_configuration = configure_synapse.generate_configuration(
+                synapse_tools_config=synapse_tools_config,
+                zookeeper_topology=['1.2.3.4'],
+                services=[('test_service', {'proxy_port': 1234})],
+                render_cache=render_cache,
+            )
+        label_filters = actual_configuration['services']['test_service']['discovery']['label_filters']
+        assert label_filters[0]['label'] == 'region:%s' % region
+
+
+def test_generate_configuration_in_parallel_matches_serial():
+    host_facts = configure_synapse.HostFacts(
+        hostname='my_host',
+        location_types=['ecosystem', 'superregion', 'region', 'habitat'],
+        locations={'region': 'my_region', 'superregion': 'my_superregion', 'habitat': 'my_habitat'},
+        groupings={'ecosystem': 'my_ecosystem'},
+    )
+    synapse_tools_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0', 'logging': {'enabled': True},
+    })
+    services = [('no_proxy_port', {'proxy_port': None})]
+    for i in range(20):
+        services.append(('service_%d' % i, {
+            'proxy_port': 1000 + i,
+            'advertise': ['habitat', 'region', 'superregion'][:i % 3 + 1],
+            'discover': 'habitat',
+            'chaos': {'ecosystem': {'my_ecosystem': {'fail': 'drop'}}} if i % 4 == 0 else {},
+            'plugins': {'logging': {'enabled': True, 'sample_rate': i / 20.0}} if i % 2 else {},
+            'proxied_through': 'service_0' if i % 5 == 1 else None,
+        }))
+    render_cache = {}
+
+    def generate(processes, render_cache=None):
+        return configure_synapse.serialize_synapse_config(configure_synapse.generate_configuration(
+            synapse_tools_config=synapse_tools_config,
+            zookeeper_topology=['1.2.3.4'],
+            services=services,
+            render_cache=render_cache,
+            host_facts=host_facts,
+            processes=processes,
+        ))
+
+    with contextlib.nested(
+        mock.patch('synapse_tools.configure_synapse.available_location_types', side_effect=AssertionError),
+        mock.patch('synapse_tools.configure_synapse.get_current_location', side_effect=AssertionError),
+        mock.patch('synapse_tools.configure_synapse.get_my_grouping', side_effect=AssertionError),
+        # Several chunks per worker
+        mock.patch.object(configure_synapse.ServiceRenderer, 'CHUNK_SIZE', 2),
+    ):
+        serial_configuration = generate(processes=1)
+        assert generate(processes=3) == serial_configuration
+
+        # Only some of the services need to be rendered
+        generate(processes=1, render_cache=render_cache)
+        for fingerprint in list(render_cache)[::2]:
+            del render_cache[fingerprint]
+        assert generate(processes=3, render_cache=render_cache) == serial_configuration
+        assert len(render_cache) == len(services)
+
+
+def test_render_cache_round_trip(tmpdir):
+    render_cache_path = str(tmpdir.join('render_cache.json'))
+    render_cache = {'abc': {'watchers': {'test_service': {'default_servers': []}}, 'global': [[]]}}
+
+    configure_synapse.save_render_cache(render_cache_path, render_cache)
+
+    assert configure_synapse.load_render_cache(render_cache_path) == render_cache
+
+
+def test_load_render_cache_ignores_missing_or_outdated_files(tmpdir):
+    render_cache_path = tmpdir.join('render_cache.json')
+    assert configure_synapse.load_render_cache(str(render_cache_path)) == {}
+
+    render_cache_path.write('{"version": -1, "services": {"abc": {}}}')
+    assert configure_synapse.load_render_cache(str(render_cache_path)) == {}
+
+    render_cache_path.write('not json')
+    assert configure_synapse.load_render_cache(str(render_cache_path)) == {}
+
+
+def test_generate_configuration_with_global_plugins(mock_get_current_location, mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0',
+        'logging': {'enabled': True, 'sample_rate': 0.5},
+        'path_based_routing': {'enabled': True},
+    })
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('test_service', {'proxy_port': 1234}),
+            ('other_service', {'proxy_port': 5678}),
+        ]
+    )
+
+    expected_global = configure_synapse.generate_base_config(synapse_tools_config)['haproxy']['global']
+    expected_global.extend([
+        'lua-load %s/log_requests.lua' % synapse_tools_config['lua_dir'],
+        'setenv map_file /var/run/synapse/maps/ip_to_service.map',
+        'setenv sample_rate 0.5',
+        'lua-load %s/path_based_routing.lua' % synapse_tools_config['lua_dir'],
+    ])
+    assert actual_configuration['haproxy']['global'] == expected_global
+    for service_name in ('test_service', 'other_service'):
+        haproxy = actual_configuration['services'][service_name]['haproxy']
+        assert 'http-request lua.init_logging' in haproxy['backend']
+        assert 'use_backend %[var(txn.backend_name)]' in haproxy['frontend']
+
+
+def test_generate_configuration_ignores_config_of_services_not_in_smartstack(
+    mock_get_current_location, mock_available_location_types,
+):
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('not_in_smartstack', {'retries': 'three', 'timeout_server_ms': '1s'}),
+            ('test_service', {'proxy_port': 1234}),
+        ],
+    )
+    assert set(actual_configuration['services']) == {'test_service'}
+
+    with pytest.raises(InvalidServiceConfigError):
+        configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+            zookeeper_topology=['1.2.3.4'],
+            services=[('test_service', {'proxy_port': 1234, 'retries': 'three'})],
+        )
+
+
+@pytest.mark.parametrize('services,expected_plugin_global', [
+    (
+        [
+            ('own_logging', {
+                'proxy_port': 1234,
+                'plugins': {'logging': {'enabled': True, 'sample_rate': 0.1}},
+            }),
+            ('other_service', {'proxy_port': 5678}),
+        ],
+        [
+            'lua-load {lua_dir}/log_requests.lua',
+            'setenv map_file /var/run/synapse/maps/ip_to_service.map',
+            'setenv sample_rate 0.1',
+            'lua-load {lua_dir}/path_based_routing.lua',
+            'setenv sample_rate 0.5',
+        ],
+    ),
+    (
+        [
+            ('not_in_smartstack', {}),
+            ('discovery_only', {'proxy_port': None}),
+            ('other_service', {'proxy_port': 5678}),
+            ('own_logging', {
+                'proxy_port': 1234,
+                'plugins': {'logging': {'enabled': True, 'sample_rate': 0.1}},
+            }),
+        ],
+        [
+            'lua-load {lua_dir}/log_requests.lua',
+            'setenv map_file /var/run/synapse/maps/ip_to_service.map',
+            'setenv sample_rate 0.5',
+            'lua-load {lua_dir}/path_based_routing.lua',
+            'setenv sample_rate 0.1',
+        ],
+    ),
+])
+def test_generate_configuration_global_plugin_options_order(
+    mock_get_current_location, mock_available_location_types, services, expected_plugin_global,
+):
+    # The order in which every service used to add all of its plugins'
+    # global options, the last sample_rate wins
+    synapse_tools_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0',
+        'logging': {'enabled': True, 'sample_rate': 0.5},
+        'path_based_routing': {'enabled': True},
+    })
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=services,
+    )
+
+    expected_global = configure_synapse.generate_base_config(synapse_tools_config)['haproxy']['global']
+    expected_global.extend(
+        line.format(lua_dir=synapse_tools_config['lua_dir']) for line in expected_plugin_global
+    )
+    assert actual_configuration['haproxy']['global'] == expected_global
+
+
+def test_generate_configuration_without_services_has_no_plugin_global_options(mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0',
+        'logging': {'enabled': True},
+    })
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=[],
+    )
+    assert actual_configuration == configure_synapse.generate_base_config(synapse_tools_config)
+
+
+def test_generate_configuration_reuses_plugin_options(mock_get_current_location, mock_available_location_types):
+    with contextlib.nested(
+        mock.patch.object(Logging, 'backend_options', autospec=True, side_effect=Logging.backend_options),
+        mock.patch.object(ProxiedThrough, 'frontend_options', autospec=True, side_effect=ProxiedThrough.frontend_options),
+    ) as (mock_logging_backend_options, mock_proxied_through_frontend_options):
+        actual_configuration = configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                ('service_one', {'proxy_port': 1, 'plugins': {'logging': {'enabled': True}}}),
+                ('service_two', {'proxy_port': 2, 'plugins': {'logging': {'enabled': True}}}),
+                ('service_three', {'proxy_port': 3}),
+                ('service_four', {'proxy_port': 4, 'proxied_through': 'service_three'}),
+                ('service_five', {'proxy_port': 5, 'proxied_through': 'service_three'}),
+            ]
+        )
+
+    # Once per distinct logging options: enabled, and not configured
+    assert mock_logging_backend_options.call_count == 2
+    # Once for all services that are not proxied, once per proxied service
+    assert mock_proxied_through_frontend_options.call_count == 3
+
+    services = actual_configuration['services']
+    assert 'http-request lua.init_logging' in services['service_two']['haproxy']['backend']
+    assert 'http-request lua.init_logging' not in services['service_three']['haproxy']['backend']
+    assert 'reqadd X-Smartstack-Destination:\\ service_five if !is_status_request !request_from_proxy ' \
+        'proxied_through_backend_has_connslots' in services['service_five']['haproxy']['frontend']
+
+
 @contextlib.contextmanager
-def setup_mocks_for_main():
-    mock_tmp_file = mock.MagicMock()
-    mock_file_cmp = mock.Mock()
-    mock_copy = mock.Mock()
+def setup_mocks_for_main(tmpdir, new_synapse_config, **config):
+    config_file = tmpdir.join('synapse.conf.json')
     mock_subprocess_check_call = mock.Mock()
 
     with contextlib.nested(
+            mock.patch('sys.argv', ['configure_synapse']),
             mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology'),
             mock.patch('synapse_tools.configure_synapse.get_all_namespaces'),
-            mock.patch('synapse_tools.configure_synapse.generate_configuration'),
+            mock.patch(
+                'synapse_tools.configure_synapse.generate_configuration',
+                return_value=new_synapse_config,
+            ),
             mock.patch(
                 'synapse_tools.configure_synapse.get_config',
                 return_value=configure_synapse.set_defaults(
-                    {'bind_addr': '0.0.0.0', 'config_file': '/etc/synapse/synapse.conf.json'}
+                    dict({'bind_addr': '0.0.0.0', 'config_file': config_file.strpath}, **config)
                 ),
             ),
-            mock.patch('tempfile.NamedTemporaryFile', return_value=mock_tmp_file),
-            mock.patch('synapse_tools.configure_synapse.open', create=True),
-            mock.patch('json.dump'),
-            mock.patch('os.chmod'),
-            mock.patch('filecmp.cmp', mock_file_cmp),
-            mock.patch('shutil.copy', mock_copy),
             mock.patch('subprocess.check_call', mock_subprocess_check_call)):
-        yield(mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call)
+        yield (config_file, mock_subprocess_check_call)
 
 
-def test_synapse_restarted_when_config_files_differ():
-    with setup_mocks_for_main() as (
-            mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call):
+def test_synapse_restarted_when_config_files_differ(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {'new': {}}}) as (
+            config_file, mock_subprocess_check_call):
 
         # New and existing synapse configs differ
-        mock_file_cmp.return_value = False
+        config_file.write('{"services": {"old": {}}}')
 
         configure_synapse.main()
 
-        mock_copy.assert_called_with(
-            mock_tmp_file.__enter__().name, '/etc/synapse/synapse.conf.json')
+        assert json.loads(config_file.read()) == {'services': {'new': {}}}
+        assert config_file.stat().mode & 0o777 == 0o644
 
         expected_calls = [
             mock.call(['service', 'synapse', 'stop']),
@@ -1132,22 +1556,506 @@ def test_synapse_restarted_when_config_files_differ():
         ]
 
         assert mock_subprocess_check_call.call_args_list == expected_calls
+        # Nothing but the config and its digest is left behind
+        assert sorted(p.basename for p in tmpdir.listdir()) == [
+            'synapse.conf.json', 'synapse.conf.json.restart', 'synapse.conf.json.sha256',
+        ]
+
+
+def test_synapse_restarted_when_config_file_is_missing(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}) as (
+            config_file, mock_subprocess_check_call):
+
+        configure_synapse.main()
 
+        assert json.loads(config_file.read()) == {'services': {}}
+        assert mock_subprocess_check_call.call_count == 2
 
-def test_synapse_not_restarted_when_config_files_are_identical():
-    with setup_mocks_for_main() as (
-            mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call):
+
+def test_synapse_not_restarted_when_config_files_are_identical(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}) as (
+            config_file, mock_subprocess_check_call):
 
         # New and existing synapse configs are identical
-        mock_file_cmp.return_value = True
+        config_file.write(configure_synapse.serialize_synapse_config({'services': {}}))
+        config_file.setmtime(0)
+        inode = config_file.stat().ino
+
+        configure_synapse.main()
+
+        assert not mock_subprocess_check_call.called
+        # The file is not rewritten, but its mtime is updated for monitoring
+        assert config_file.stat().ino == inode
+        assert config_file.mtime() > 0
+
+
+def test_synapse_not_restarted_when_digest_matches(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}) as (
+            config_file, mock_subprocess_check_call):
+
+        configure_synapse.main()
+        assert mock_subprocess_check_call.call_count == 2
+        mock_subprocess_check_call.reset_mock()
+
+        with mock.patch.object(
+            configure_synapse, 'open', create=True, side_effect=open,
+        ) as mock_open:
+            configure_synapse.main()
+
+        assert not mock_subprocess_check_call.called
+        # The current config was not read back, only the recorded digest
+        assert config_file.strpath not in [c[0][0] for c in mock_open.call_args_list]
+
+
+def test_synapse_restarted_when_config_file_changed_behind_our_back(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}) as (
+            config_file, mock_subprocess_check_call):
+
+        configure_synapse.main()
+        config_file.write('{}')
+        mock_subprocess_check_call.reset_mock()
+
+        configure_synapse.main()
+
+        assert mock_subprocess_check_call.call_count == 2
+        assert json.loads(config_file.read()) == {'services': {}}
+
+
+def test_synapse_not_restarted_when_only_encoding_changed(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}, compact_config_file=True) as (
+            config_file, mock_subprocess_check_call):
+
+        config_file.write(configure_synapse.serialize_synapse_config({'services': {}}))
+
+        configure_synapse.main()
+
+        assert not mock_subprocess_check_call.called
+        assert config_file.read() == '{"services":{}}'
+
+
+@contextlib.contextmanager
+def setup_runtime_update(tmpdir, **config):
+    server_options = 'check port 6666 observe layer7 maxconn %d maxqueue 10'
+    old_config = {'services': {'foo.main': {'haproxy': {'server_options': server_options % 50}}}}
+    new_config = {'services': {'foo.main': {'haproxy': {'server_options': server_options % 80}}}}
+
+    with contextlib.nested(
+        setup_mocks_for_main(tmpdir, new_config, **config),
+        mock.patch(
+            'synapse_tools.haproxy.runtime_api.get_servers_by_backend',
+            return_value={'foo.main': ['10.0.0.1:1234']},
+        ),
+        mock.patch('synapse_tools.haproxy.runtime_api.set_command', autospec=True),
+    ) as ((config_file, mock_subprocess_check_call), _, mock_set_command):
+        config_file.write(json.dumps(old_config))
+        yield mock_subprocess_check_call, mock_set_command
+
+
+def test_runtime_update_applied_instead_of_restart(tmpdir):
+    with setup_runtime_update(tmpdir, haproxy_runtime_updates=True) as (
+            mock_subprocess_check_call, mock_set_command):
 
         configure_synapse.main()
 
-        mock_copy.assert_called_with(
-            mock_tmp_file.__enter__().name, '/etc/synapse/synapse.conf.json')
+        mock_set_command.assert_called_once_with(
+            '/var/run/synapse/haproxy.sock', 'set maxconn server foo.main/10.0.0.1:1234 80',
+        )
         assert not mock_subprocess_check_call.called
 
 
+def test_runtime_update_applied_again_until_restart(tmpdir):
+    stats = [{'pxname': 'foo.main', 'svname': '10.0.0.1:1234', 'slim': '80'}]
+    with contextlib.nested(
+        setup_runtime_update(tmpdir, haproxy_runtime_updates=True),
+        mock.patch.object(runtime_api, 'show_stat', autospec=True, return_value=stats),
+    ) as ((mock_subprocess_check_call, mock_set_command), mock_show_stat):
+        configure_synapse.main()
+        mock_set_command.reset_mock()
+
+        # HAProxy still has it
+        configure_synapse.main()
+        assert mock_show_stat.call_count == 1
+        assert not mock_set_command.called
+
+        # Synapse reloaded HAProxy with the maxconn it was started with, and
+        # added a new server with it
+        mock_show_stat.return_value = [
+            {'pxname': 'foo.main', 'svname': '10.0.0.1:1234', 'slim': '50'},
+            {'pxname': 'foo.main', 'svname': '10.0.0.2:1234', 'slim': '50'},
+        ]
+        configure_synapse.main()
+        assert mock_set_command.call_args_list == [
+            mock.call('/var/run/synapse/haproxy.sock', 'set maxconn server foo.main/10.0.0.1:1234 80'),
+            mock.call('/var/run/synapse/haproxy.sock', 'set maxconn server foo.main/10.0.0.2:1234 80'),
+        ]
+
+        # Not after synapse was restarted with them
+        mock_show_stat.reset_mock()
+        with mock.patch(
+            'synapse_tools.configure_synapse.generate_configuration',
+            return_value={'services': {'bar.main': {}}},
+        ):
+            configure_synapse.main()
+        assert mock_subprocess_check_call.call_count == 2
+        configure_synapse.main()
+        assert not mock_show_stat.called
+
+
+def test_runtime_update_failure_restarts(tmpdir):
+    with setup_runtime_update(tmpdir, haproxy_runtime_updates=True) as (
+            mock_subprocess_check_call, mock_set_command):
+        mock_set_command.side_effect = runtime_api.RuntimeApiError('Unknown command.')
+
+        configure_synapse.main()
+
+        assert mock_subprocess_check_call.call_count == 2
+
+
+def test_runtime_updates_disabled_by_default(tmpdir):
+    with setup_runtime_update(tmpdir) as (mock_subprocess_check_call, mock_set_command):
+
+        configure_synapse.main()
+
+        assert not mock_set_command.called
+        assert mock_subprocess_check_call.call_count == 2
+
+
+def test_main_writes_timing_summary(tmpdir):
+    summary_path = tmpdir.join('timing.json')
+    with setup_mocks_for_main(
+        tmpdir, {'services': {}}, timing_summary_path=summary_path.strpath,
+    ):
+        configure_synapse.main()
+
+    summary = json.loads(summary_path.read())
+    assert set(summary['phases']) == {
+        'load_config', 'zookeeper_topology', 'namespaces', 'generate',
+        'serialize', 'compare', 'classify', 'write', 'restart',
+    }
+    assert summary['total_s'] >= sum(summary['phases'].values())
+
+
+def test_main_profile(tmpdir):
+    profile_path = tmpdir.join('configure_synapse.prof')
+    with contextlib.nested(
+        setup_mocks_for_main(tmpdir, {'services': {}}),
+        mock.patch('sys.argv', ['configure_synapse', '--profile', profile_path.strpath]),
+    ):
+        configure_synapse.main()
+
+    stats = pstats.Stats(profile_path.strpath)
+    assert any(func[2] == 'run_once' for func in stats.stats)
+
+
+def test_profile_cannot_be_used_with_daemon():
+    with contextlib.nested(
+        mock.patch('sys.argv', ['configure_synapse', '--daemon', '--profile', '/tmp/x']),
+        mock.patch('synapse_tools.configure_synapse.ConfigureSynapseDaemon'),
+    ) as (_, mock_daemon_class):
+        with pytest.raises(SystemExit):
+            configure_synapse.main()
+    assert not mock_daemon_class.called
+
+
+def test_main_streams_namespaces_from_loader_pool(tmpdir):
+    soa_dir = tmpdir.join('soa')
+    for i in range(40):
+        soa_dir.join('service_%d' % i, 'smartstack.yaml').write('main:\n  proxy_port: %d\n' % i, ensure=True)
+    catalog_cache_path = tmpdir.join('catalog.cache')
+    generated_from = []
+
+    def generate_configuration(my_config, zookeeper_topology, services, **kwargs):
+        assert not isinstance(services, list)
+        generated_from.extend(services)
+        return {'services': {}}
+
+    with contextlib.nested(
+        setup_mocks_for_main(
+            tmpdir, None, soa_dir=soa_dir.strpath, namespace_loader_processes=2,
+            catalog_cache_path=catalog_cache_path.strpath,
+        ),
+        mock.patch(
+            'synapse_tools.configure_synapse.generate_configuration',
+            side_effect=generate_configuration,
+        ),
+    ):
+        configure_synapse.main()
+
+    assert sorted(generated_from) == sorted(
+        ('service_%d.main' % i, {'proxy_port': i}) for i in range(40)
+    )
+    assert len(CatalogCache.load(catalog_cache_path.strpath).entries) == 40
+
+
+def test_synapse_restarts_are_coalesced(tmpdir):
+    with setup_mocks_for_main(
+        tmpdir, {'services': {}}, restart_coalesce_window_s=60, restart_min_interval_s=300,
+    ) as (config_file, mock_subprocess_check_call):
+
+        def run(new_synapse_config, now):
+            mock_subprocess_check_call.reset_mock()
+            with contextlib.nested(
+                mock.patch('synapse_tools.configure_synapse.generate_configuration', return_value=new_synapse_config),
+                mock.patch('time.time', return_value=now),
+            ):
+                configure_synapse.main()
+            return mock_subprocess_check_call.called
+
+        # The first change waits for the coalescing window
+        assert not run({'services': {'a': {}}}, now=1000)
+        assert json.loads(config_file.read()) == {'services': {'a': {}}}
+        assert not run({'services': {'b': {}}}, now=1030)
+        assert run({'services': {'b': {}}}, now=1060)
+        assert not run({'services': {'b': {}}}, now=1070)
+
+        # The next restart happens no sooner than the minimum interval
+        assert not run({'services': {'c': {}}}, now=1200)
+        assert not run({'services': {'c': {}}}, now=1300)
+        assert run({'services': {'c': {}}}, now=1360)
+
+        # Reverting the changes cancels the pending restart
+        assert not run({'services': {'d': {}}}, now=2000)
+        assert not run({'services': {'c': {}}}, now=2010)
+        assert not run({'services': {'c': {}}}, now=3000)
+
+
+def test_synapse_restart_jitter(tmpdir):
+    with contextlib.nested(
+        setup_mocks_for_main(tmpdir, {'services': {}}, restart_jitter_window_s=600),
+        mock.patch('socket.gethostname', return_value='my_host'),
+    ) as ((_, mock_subprocess_check_call), _):
+        jitter_s = get_host_jitter_s('my_host', 600)
+        with mock.patch('time.time', return_value=1000):
+            configure_synapse.main()
+        assert not mock_subprocess_check_call.called
+
+        with mock.patch('time.time', return_value=1000 + jitter_s):
+            configure_synapse.main()
+        assert mock_subprocess_check_call.called
+
+
+def test_failed_synapse_restart_is_tried_again(tmpdir):
+    with setup_mocks_for_main(tmpdir, {'services': {}}) as (_, mock_subprocess_check_call):
+        mock_subprocess_check_call.side_effect = [subprocess.CalledProcessError(1, 'stop'), None, None]
+        with pytest.raises(subprocess.CalledProcessError):
+            configure_synapse.main()
+
+        configure_synapse.main()
+
+        assert mock_subprocess_check_call.call_count == 3
+
+
+def test_compact_config_file(tmpdir):
+    with setup_mocks_for_main(
+        tmpdir, {'services': {'foo': {}}}, compact_config_file=True,
+        config_digest_path=tmpdir.join('digest').strpath,
+    ) as (config_file, _):
+
+        configure_synapse.main()
+
+        assert config_file.read() == '{"services":{"foo":{}}}'
+        assert tmpdir.join('digest').check()
+
+
+@contextlib.contextmanager
+def setup_mocks_for_daemon():
+    my_config = configure_synapse.set_defaults({
+        'config_file': '/etc/synapse/synapse.conf.json',
+        'zookeeper_topology_path': '/nail/etc/zookeeper_discovery/infrastructure/local.yaml',
+        'soa_dir': '/nail/etc/services',
+    })
+    with contextlib.nested(
+            mock.patch('synapse_tools.configure_synapse.Inotify', autospec=True),
+            mock.patch('synapse_tools.configure_synapse.get_config', return_value=my_config),
+            mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology'),
+            mock.patch('synapse_tools.configure_synapse.get_all_namespaces'),
+            mock.patch('synapse_tools.configure_synapse.generate_configuration'),
+            mock.patch('synapse_tools.configure_synapse.update_synapse_config')) as mocks:
+        mock_inotify_class = mocks[0]
+        mock_inotify_class.OVERFLOW = None
+        mock_inotify_class.return_value.watched_paths.return_value = set()
+        daemon = configure_synapse.ConfigureSynapseDaemon(
+            '/etc/synapse/synapse-tools.conf.json', debounce_s=5,
+        )
+        yield (daemon,) + tuple(mocks)
+
+
+def test_daemon_first_refresh_loads_everything():
+    with setup_mocks_for_daemon() as (
+            daemon, mock_inotify_class, mock_get_config, mock_get_zookeeper_topology,
+            mock_get_all_namespaces, mock_generate_configuration, mock_update_synapse_config):
+        daemon.refresh(set())
+
+        mock_get_config.assert_called_once_with('/etc/synapse/synapse-tools.conf.json')
+        mock_get_zookeeper_topology.assert_called_once_with(
+            '/nail/etc/zookeeper_discovery/infrastructure/local.yaml')
+        mock_get_all_namespaces.assert_called_once_with(
+            soa_dir='/nail/etc/services', catalog_cache=daemon.catalog_cache, pool=None)
+        mock_generate_configuration.assert_called_once_with(
+            mock_get_config.return_value,
+            mock_get_zookeeper_topology.return_value,
+            mock_get_all_namespaces.return_value,
+            render_cache=daemon.render_cache,
+            processes=1,
+            subset_sizes={},
+        )
+        mock_update_synapse_config.assert_called_once_with(
+            mock_get_config.return_value, mock_generate_configuration.return_value, timer=mock.ANY)
+        assert mock_inotify_class.return_value.add_watch.call_args_list == [
+            mock.call('/etc/synapse'),
+            mock.call('/nail/etc/zookeeper_discovery/infrastructure', recursive=False),
+            mock.call('/nail/etc/services', recursive=True),
+        ]
+
+
+def test_daemon_refresh_only_reloads_what_changed():
+    with setup_mocks_for_daemon() as (
+            daemon, _, mock_get_config, mock_get_zookeeper_topology,
+            mock_get_all_namespaces, mock_generate_configuration, mock_update_synapse_config):
+        daemon.refresh(set())
+
+        daemon.refresh({'/nail/etc/services/test_service/smartstack.yaml'})
+        assert mock_get_config.call_count == 1
+        assert mock_get_zookeeper_topology.call_count == 1
+        assert mock_get_all_namespaces.call_count == 2
+
+        daemon.refresh({'/nail/etc/zookeeper_discovery/infrastructure/local.yaml'})
+        assert mock_get_config.call_count == 1
+        assert mock_get_zookeeper_topology.call_count == 2
+        assert mock_get_all_namespaces.call_count == 2
+
+        daemon.refresh({'/etc/synapse/synapse-tools.conf.json'})
+        assert mock_get_config.call_count == 2
+        assert mock_get_zookeeper_topology.call_count == 3
+        assert mock_get_all_namespaces.call_count == 3
+
+        assert mock_update_synapse_config.call_count == 4
+
+
+def test_daemon_watches_file_output_when_collapsing(tmpdir):
+    with setup_mocks_for_daemon() as (daemon, mock_inotify_class, mock_get_config, _, _, _, _):
+        mock_get_config.return_value.update({
+            'collapse_identical_backends': True,
+            'file_output_path': tmpdir.join('services').strpath,
+        })
+        with mock.patch(
+            'synapse_tools.configure_synapse.collapse_identical_backends', autospec=True,
+        ) as mock_collapse_identical_backends:
+            # Not until synapse created the directory
+            daemon.refresh(set())
+            assert mock.call(tmpdir.join('services').strpath, recursive=False) not in \
+                mock_inotify_class.return_value.add_watch.call_args_list
+
+            tmpdir.join('services').mkdir()
+            daemon.refresh(set())
+            mock_inotify_class.return_value.add_watch.assert_called_with(
+                tmpdir.join('services').strpath, recursive=False,
+            )
+            assert mock_collapse_identical_backends.call_count == 2
+
+
+def test_daemon_reloads_everything_after_failure():
+    with setup_mocks_for_daemon() as (
+            daemon, _, mock_get_config, _, mock_get_all_namespaces, _, _):
+        daemon.refresh(set())
+
+        mock_get_all_namespaces.side_effect = ValueError
+        with pytest.raises(ValueError):
+            daemon.refresh({'/nail/etc/services/test_service/smartstack.yaml'})
+
+        mock_get_all_namespaces.side_effect = None
+        daemon.refresh({'/nail/etc/services/test_service/smartstack.yaml'})
+        assert mock_get_config.call_count == 2
+
+
+def test_daemon_wait_for_changes_debounces():
+    with setup_mocks_for_daemon() as (daemon, mock_inotify_class, _, _, _, _, _):
+        mock_inotify_class.return_value.read_changes.side_effect = [
+            {'/nail/etc/services/a/smartstack.yaml'},
+            {'/nail/etc/services/b/smartstack.yaml'},
+            set(),
+        ]
+
+        assert daemon.wait_for_changes() == {
+            '/nail/etc/services/a/smartstack.yaml',
+            '/nail/etc/services/b/smartstack.yaml',
+        }
+        assert mock_inotify_class.return_value.read_changes.call_args_list == [
+            mock.call(timeout=None),
+            mock.call(timeout=5),
+            mock.call(timeout=5),
+        ]
+
+
+def test_daemon_wait_for_changes_times_out():
+    with setup_mocks_for_daemon() as (daemon, mock_inotify_class, _, _, _, _, _):
+        mock_inotify_class.return_value.read_changes.return_value = set()
+
+        assert daemon.wait_for_changes(timeout=30) == set()
+        mock_inotify_class.return_value.read_changes.assert_called_once_with(timeout=30)
+
+
+def test_daemon_wait_for_changes_ignores_own_writes():
+    with setup_mocks_for_daemon() as (daemon, mock_inotify_class, _, _, _, _, _):
+        daemon.refresh(set())
+        mock_inotify_class.return_value.read_changes.side_effect = [
+            {'/etc/synapse/synapse.conf.json', '/etc/synapse/.synapse.conf.json.sha256.a1b2c3'},
+            {'/etc/synapse/synapse.conf.json.sha256', '/etc/synapse/synapse-tools.conf.json'},
+            {'/etc/synapse/synapse.conf.json.restart'},
+            set(),
+        ]
+
+        assert daemon.wait_for_changes(timeout=30) == {'/etc/synapse/synapse-tools.conf.json'}
+
+
+def test_daemon_is_not_woken_up_by_its_own_writes(tmpdir):
+    tools_config_path = tmpdir.join('synapse-tools.conf.json')
+    tools_config_path.write(json.dumps({
+        'config_file': tmpdir.join('synapse.conf.json').strpath,
+        'zookeeper_topology_path': tmpdir.join('local.yaml').strpath,
+        'soa_dir': tmpdir.mkdir('services').strpath,
+    }))
+    with contextlib.nested(
+        mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology', autospec=True),
+        mock.patch('synapse_tools.configure_synapse.get_all_namespaces', autospec=True),
+        mock.patch(
+            'synapse_tools.configure_synapse.generate_configuration', autospec=True,
+            return_value={'services': {}},
+        ),
+        mock.patch('synapse_tools.configure_synapse.restart_synapse', autospec=True),
+    ):
+        daemon = configure_synapse.ConfigureSynapseDaemon(tools_config_path.strpath, debounce_s=0.1)
+        try:
+            daemon.refresh(set())
+            # Nothing changed but the config file's age and the digest
+            daemon.refresh(set())
+            assert daemon.wait_for_changes(timeout=0.2) == set()
+
+            tools_config_path.write(tools_config_path.read())
+            assert daemon.wait_for_changes(timeout=1) == {tools_config_path.strpath}
+        finally:
+            daemon.inotify.close()
+
+
+def test_daemon_restart_timeout(tmpdir):
+    with setup_mocks_for_daemon() as (daemon, _, mock_get_config, _, _, _, _):
+        assert daemon.restart_timeout() is None
+
+        daemon.my_config = configure_synapse.set_defaults({
+            'config_file': tmpdir.join('synapse.conf.json').strpath,
+            'restart_coalesce_window_s': 60,
+        })
+        assert daemon.restart_timeout() is None
+
+        scheduler = configure_synapse.load_restart_scheduler(daemon.my_config)
+        scheduler.request_restart('digest', now=1000)
+        configure_synapse.save_restart_scheduler(daemon.my_config, scheduler)
+        with mock.patch.object(configure_synapse.time, 'time', return_value=1020):
+            assert daemon.restart_timeout() == 40
+        with mock.patch.object(configure_synapse.time, 'time', return_value=1070):
+            assert daemon.restart_timeout() == 0
+
+
 def test_chaos_delay(mock_get_current_location, mock_available_location_types):
     with mock.patch.object(configure_synapse, 'get_my_grouping') as grouping_mock:
         grouping_mock.return_value = 'my_ecosystem'
@@ -1341,3 +2249,558 @@ def test_nginx_proxy_proto(mock_get_current_location, mock_available_location_ty
     nginx = actual_configuration['services']['test_service.nginx_listener']
     assert nginx['default_servers'][0]['port'] == '/var/run/synapse/sockets/test_service.prxy'
     assert 'proxy_protocol on' in nginx['nginx']['server']
+
+
+def test_main_uses_rendered_config(tmpdir):
+    artifact_dir = tmpdir.join('artifacts')
+    rendered_config = {'services': {'rendered': {}}}
+    with contextlib.nested(
+        setup_mocks_for_main(tmpdir, {'services': {'local': {}}}, rendered_config_dir=artifact_dir.strpath),
+        mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology', return_value=['1.2.3.4:2181']),
+        mock.patch('socket.gethostname', return_value='my_host'),
+    ) as ((config_file, _), _, _):
+        my_config = configure_synapse.get_config(None)
+        digest = config_artifacts.write_services(artifact_dir.strpath, rendered_config['services'])
+        config_artifacts.write_host_config(
+            artifact_dir.strpath, 'my_host', rendered_config, digest,
+            config_artifacts.get_inputs_digest(my_config, ['1.2.3.4:2181']), time.time(),
+        )
+
+        configure_synapse.main()
+        assert json.loads(config_file.read()) == rendered_config
+
+        # The config is rendered locally if the artifact is from other inputs
+        config_artifacts.write_host_config(
+            artifact_dir.strpath, 'my_host', rendered_config, digest, 'other_inputs', time.time(),
+        )
+        configure_synapse.main()
+        assert json.loads(config_file.read()) == {'services': {'local': {}}}
+
+
+def test_host_local_options_do_not_change_the_rendered_config(
+    mock_get_current_location, mock_available_location_types,
+):
+    def generate(synapse_tools_config):
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults(synapse_tools_config),
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                ('test_service', {'proxy_port': 1234, 'advertise': ['region', 'superregion']}),
+            ],
+        )
+
+    expected = generate({'bind_addr': '0.0.0.0'})
+    for option in config_artifacts.HOST_LOCAL_OPTIONS:
+        assert generate({'bind_addr': '0.0.0.0', option: 'changed'}) == expected, option
+
+
+def test_get_config_rejects_rendered_config_with_service_dependencies(tmpdir):
+    config_path = tmpdir.join('synapse-tools.conf.json')
+    config_path.write(json.dumps({
+        'rendered_config_dir': tmpdir.join('artifacts').strpath,
+        'service_dependencies_path': tmpdir.join('dependencies.json').strpath,
+    }))
+    with pytest.raises(ValueError):
+        configure_synapse.get_config(config_path.strpath)
+
+
+def test_daemon_uses_rendered_config(tmpdir):
+    with setup_mocks_for_daemon() as (
+            daemon, _, mock_get_config, _, _, mock_generate_configuration, mock_update_synapse_config):
+        mock_get_config.return_value['rendered_config_dir'] = tmpdir.strpath
+        with mock.patch(
+            'synapse_tools.configure_synapse.load_rendered_config', autospec=True,
+            return_value={'services': {'rendered': {}}},
+        ) as mock_load_rendered_config:
+            daemon.refresh(set())
+            assert mock_generate_configuration.call_count == 0
+            assert mock_update_synapse_config.call_args[0][1] == {'services': {'rendered': {}}}
+
+            # Rendered locally when there is no usable rendered config
+            mock_load_rendered_config.return_value = None
+            daemon.refresh(set())
+            assert mock_generate_configuration.call_count == 1
+
+
+def test_select_services():
+    services = [
+        ('proxy.main', {'proxy_port': 1, 'is_proxy': True}),
+        ('other.main', {'proxy_port': 2}),
+        ('dep.main', {'proxy_port': 3}),
+        ('dep.canary', {'proxy_port': 4, 'proxied_through': 'proxy.main'}),
+        ('exact.main', {'proxy_port': 5}),
+        ('exact.other', {'proxy_port': 6}),
+    ]
+
+    # The proxy comes once a service proxied through it was read
+    assert list(configure_synapse.select_services(iter(services), {'dep', 'exact.main', 'unknown'})) == [
+        services[2], services[3], services[0], services[4],
+    ]
+
+
+def test_select_services_follows_proxy_chains():
+    services = [
+        ('outer_proxy.main', {'proxy_port': 1, 'is_proxy': True}),
+        ('dep.main', {'proxy_port': 2, 'proxied_through': 'inner_proxy.main'}),
+        ('inner_proxy.main', {'proxy_port': 3, 'is_proxy': True, 'proxied_through': 'outer_proxy.main'}),
+        ('other.main', {'proxy_port': 4}),
+    ]
+
+    assert list(configure_synapse.select_services(iter(services), {'dep'})) == [
+        services[1], services[2], services[0],
+    ]
+
+
+def test_select_services_is_lazy():
+    def services():
+        yield ('dep.main', {'proxy_port': 1})
+        raise AssertionError('read too far')
+
+    assert next(configure_synapse.select_services(services(), {'dep'})) == ('dep.main', {'proxy_port': 1})
+
+
+def test_load_wanted_services(tmpdir):
+    dependencies_path = tmpdir.join('dependencies.json')
+    my_config = configure_synapse.set_defaults({
+        'service_dependencies_path': dependencies_path.strpath,
+        'always_rendered_services': ['always'],
+    })
+
+    # Every service is rendered rather than none
+    assert configure_synapse.load_wanted_services(my_config) is None
+
+    dependencies_path.write('["dep.main", "other"]')
+    assert configure_synapse.load_wanted_services(my_config) == {'dep.main', 'other', 'always'}
+
+    assert configure_synapse.load_wanted_services(configure_synapse.set_defaults({})) is None
+
+
+def test_main_only_renders_wanted_services(tmpdir):
+    dependencies_path = tmpdir.join('dependencies.json')
+    dependencies_path.write('["dep"]')
+    services = [('dep.main', {'proxy_port': 1}), ('other.main', {'proxy_port': 2})]
+
+    with contextlib.nested(
+        setup_mocks_for_main(
+            tmpdir, {'services': {}}, service_dependencies_path=dependencies_path.strpath,
+        ),
+        mock.patch('synapse_tools.configure_synapse.get_all_namespaces', return_value=services),
+    ):
+        configure_synapse.main()
+        assert list(configure_synapse.generate_configuration.call_args[0][2]) == [services[0]]
+
+
+def test_demote_cold_backends(tmpdir):
+    my_config = configure_synapse.set_defaults({
+        'config_file': tmpdir.join('synapse.conf.json').strpath,
+        'cold_backend_idle_s': 60,
+    })
+    server_options = 'check port 6666 observe layer7 maxconn 50 maxqueue 10'
+    synapse_config = {
+        'services': {
+            'hot.main': {'haproxy': {'server_options': server_options}},
+            'cold.main': {'haproxy': {'server_options': server_options}},
+            'cold.main.region': {'haproxy': {'disabled': True}},
+            'unchecked.main': {'haproxy': {'server_options': 'maxconn 50'}},
+        },
+        'haproxy': {
+            'extra_sections': {
+                'backend cold.main.region': ['server-template slot 1-4 0.0.0.0:0 disabled check'],
+            },
+        },
+    }
+    original_config = copy.deepcopy(synapse_config)
+
+    def demote(sessions_by_backend, now, statuses=None):
+        stats = [
+            {'pxname': backend, 'svname': '10.0.0.1:1234', 'status': (statuses or {}).get(backend, 'UP')}
+            for backend in sorted(sessions_by_backend or {})
+        ]
+        with contextlib.nested(
+            mock.patch.object(
+                runtime_api, 'get_sessions_by_backend', autospec=True, return_value=sessions_by_backend,
+            ),
+            mock.patch.object(runtime_api, 'show_stat', autospec=True, return_value=stats),
+            mock.patch.object(runtime_api, 'set_command', autospec=True),
+            mock.patch('time.time', return_value=now),
+        ) as (mock_get_sessions_by_backend, _, mock_set_command, _):
+            if sessions_by_backend is None:
+                mock_get_sessions_by_backend.side_effect = runtime_api.RuntimeApiError
+            configure_synapse.demote_cold_backends(my_config, synapse_config)
+        # Demoting never changes the config, which would restart synapse
+        assert synapse_config == original_config
+        return sorted(c[0][1] for c in mock_set_command.call_args_list)
+
+    sessions = {'hot.main': 1, 'cold.main': 0, 'cold.main.region': 0, 'unchecked.main': 0}
+    assert demote(sessions, now=1000) == []
+    assert demote(dict(sessions, **{'hot.main': 2}), now=1030) == []
+    assert demote(dict(sessions, **{'hot.main': 3}), now=1060) == [
+        'disable health cold.main.region/10.0.0.1:1234',
+        'disable health cold.main/10.0.0.1:1234',
+    ]
+    # Already stopped, or drained with the subsets
+    statuses = {'cold.main': 'no check', 'cold.main.region': 'DRAIN'}
+    assert demote(dict(sessions, **{'hot.main': 3}), now=1065, statuses=statuses) == []
+    # HAProxy not running does not fail the run
+    assert demote(None, now=1070) == []
+
+    # Promoted again as soon as it gets traffic
+    assert demote(dict(sessions, **{'hot.main': 3, 'cold.main': 1}), now=1080, statuses=statuses) == [
+        'enable health cold.main/10.0.0.1:1234',
+    ]
+
+
+def test_daemon_wakeup_timeout(tmpdir):
+    with setup_mocks_for_daemon() as (daemon, _, _, _, _, _, _):
+        # Retry soon after a failed refresh
+        assert daemon.wakeup_timeout() == configure_synapse.DAEMON_RETRY_INTERVAL_S
+
+        daemon.my_config = configure_synapse.set_defaults({
+            'config_file': tmpdir.join('synapse.conf.json').strpath,
+        })
+        assert daemon.wakeup_timeout() == configure_synapse.DAEMON_REFRESH_INTERVAL_S
+
+        daemon.my_config['cold_backend_idle_s'] = 40
+        assert daemon.wakeup_timeout() == 20
+
+
+@pytest.mark.parametrize('skip_unrouted_backends', [False, True])
+def test_generate_configuration_skip_unrouted_backends(skip_unrouted_backends):
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({
+            'bind_addr': '0.0.0.0', 'skip_unrouted_backends': skip_unrouted_backends,
+        }),
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            (
+                'test_service',
+                {
+                    'proxy_port': 1234,
+                    'discover': 'region',
+                    'advertise': ['habitat', 'region', 'superregion'],
+                },
+            ),
+        ],
+        host_facts=configure_synapse.HostFacts(
+            hostname='my_host',
+            location_types=['superregion', 'region', 'habitat'],
+            locations={'superregion': 'my_superregion', 'region': 'my_region', 'habitat': 'my_habitat'},
+        ),
+    )
+
+    expected_watchers = {'test_service', 'test_service.superregion'}
+    if not skip_unrouted_backends:
+        expected_watchers.add('test_service.habitat')
+    assert set(actual_configuration['services']) == expected_watchers
+    # Routing is the same either way
+    assert [
+        line for line in actual_configuration['services']['test_service']['haproxy']['frontend']
+        if line.startswith('use_backend')
+    ] == [
+        'use_backend test_service if test_service_has_connslots',
+        'use_backend test_service.superregion if test_service.superregion_has_connslots',
+    ]
+
+
+def test_collapse_identical_backends(tmpdir, mock_get_current_location, mock_available_location_types):
+    my_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0',
+        'file_output_path': tmpdir.strpath,
+        'collapse_identical_backends': True,
+    })
+    render_cache = {}
+
+    def generate():
+        synapse_config = configure_synapse.generate_configuration(
+            synapse_tools_config=my_config,
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                (
+                    'test_service',
+                    {'proxy_port': 1234, 'advertise': ['region', 'superregion']},
+                ),
+            ],
+            render_cache=render_cache,
+        )
+        configure_synapse.collapse_identical_backends(my_config, synapse_config)
+        return synapse_config['services']
+
+    # Nothing is known about the servers yet
+    services = generate()
+    assert 'use_backend test_service.superregion if test_service.superregion_has_connslots' in \
+        services['test_service']['haproxy']['frontend']
+    assert not services['test_service.superregion']['haproxy'].get('disabled')
+
+    servers = [{'host': '10.0.0.1', 'port': 1234, 'name': 'a'}]
+    tmpdir.join('test_service.json').write(json.dumps(servers))
+    tmpdir.join('test_service.superregion.json').write(json.dumps(servers))
+    services = generate()
+    assert not any(
+        'test_service.superregion' in line for line in services['test_service']['haproxy']['frontend']
+    )
+    assert services['test_service.superregion']['haproxy'] == {'disabled': True}
+    assert services['test_service.superregion']['discovery']['label_filters'][0]['label'] == \
+        'superregion:my_superregion'
+
+    # Enabled again once the servers differ, which also needs the cached
+    # watchers to have been left alone
+    tmpdir.join('test_service.superregion.json').write(json.dumps(
+        servers + [{'host': '10.0.0.2', 'port': 1234, 'name': 'b'}],
+    ))
+    services = generate()
+    assert 'use_backend test_service.superregion if test_service.superregion_has_connslots' in \
+        services['test_service']['haproxy']['frontend']
+    assert not services['test_service.superregion']['haproxy'].get('disabled')
+
+
+def test_generate_configuration_subset_sizes(mock_get_current_location, mock_available_location_types):
+    subset_sizes = {}
+    configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('big_service', {'proxy_port': 1234, 'advertise': ['region', 'superregion'], 'subset_size': 10}),
+            ('small_service', {'proxy_port': 1235}),
+        ],
+        subset_sizes=subset_sizes,
+    )
+
+    assert subset_sizes == {'big_service': 10, 'big_service.superregion': 10}
+
+
+def test_apply_backend_subsets(tmpdir):
+    my_config = configure_synapse.set_defaults({'file_output_path': tmpdir.strpath})
+    tmpdir.join('foo.main.json').write(json.dumps([{'host': '10.0.0.2', 'port': 1234, 'name': 'b'}]))
+    stats = [{'pxname': 'foo.main', 'svname': '10.0.0.1:1234', 'status': 'UP'}]
+    with contextlib.nested(
+        mock.patch.object(runtime_api, 'show_stat', autospec=True, return_value=stats),
+        mock.patch.object(runtime_api, 'set_command', autospec=True),
+        mock.patch(
+            'synapse_tools.configure_synapse.get_subset_commands', autospec=True,
+            return_value=['set server foo.main/10.0.0.1:1234 state drain'],
+        ),
+        mock.patch('socket.gethostname', return_value='my_host'),
+    ) as (_, mock_set_command, mock_get_subset_commands, _):
+        configure_synapse.apply_backend_subsets(my_config, {'foo.main': 1, 'bar.main': 1})
+
+        # Backends synapse did not write the servers of are left alone
+        mock_get_subset_commands.assert_called_once_with(
+            'my_host', stats, {'foo.main': 1, 'bar.main': 1}, {'foo.main': {'10.0.0.2:1234'}},
+        )
+        mock_set_command.assert_called_once_with(
+            '/var/run/synapse/haproxy.sock', 'set server foo.main/10.0.0.1:1234 state drain',
+        )
+
+        # HAProxy not running does not fail the run
+        mock_set_command.side_effect = runtime_api.RuntimeApiError
+        configure_synapse.apply_backend_subsets(my_config, {'foo.main': 1})
+
+
+def test_apply_server_slots(tmpdir, mock_get_current_location, mock_available_location_types):
+    my_config = configure_synapse.set_defaults({
+        'bind_addr': '0.0.0.0',
+        'config_file': tmpdir.join('synapse.conf.json').strpath,
+        'file_output_path': tmpdir.strpath,
+        'haproxy_state_file_path': '/var/run/synapse/state',
+        'haproxy_server_slots': True,
+    })
+    synapse_config = configure_synapse.generate_configuration(
+        synapse_tools_config=my_config,
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('test_service', {'proxy_port': 1234, 'advertise': ['region', 'superregion']}),
+        ],
+    )
+    superregion_watcher = synapse_config['services']['test_service.superregion']
+
+    # Nothing is known about the servers yet
+    assert configure_synapse.apply_server_slots(my_config, synapse_config) == []
+
+    tmpdir.join('test_service.superregion.json').write(json.dumps(
+        [{'host': '10.0.0.1', 'port': 1234, 'name': 'a'}],
+    ))
+    tmpdir.join('test_service.json').write(json.dumps(
+        [{'host': '10.0.0.1', 'port': 1234, 'name': 'a'}],
+    ))
+    assert configure_synapse.apply_server_slots(my_config, synapse_config) == ['test_service.superregion']
+
+    services = synapse_config['services']
+    assert services['test_service.superregion']['haproxy'] == {'disabled': True}
+    assert services['test_service.superregion']['discovery'] == superregion_watcher['discovery']
+    # The discover tier keeps its frontend and servers
+    assert 'frontend' in services['test_service']['haproxy']
+    assert synapse_config['haproxy']['extra_sections']['backend test_service.superregion'] == (
+        superregion_watcher['haproxy']['backend'] + [
+            'server-template slot 1-4 0.0.0.0:0 disabled {0}'.format(
+                superregion_watcher['haproxy']['server_options'],
+            ),
+        ]
+    )
+    assert 'listen stats' in synapse_config['haproxy']['extra_sections']
+
+
+def test_apply_server_slots_needs_state_file(tmpdir):
+    my_config = configure_synapse.set_defaults({
+        'file_output_path': tmpdir.strpath,
+        'haproxy_server_slots': True,
+    })
+    synapse_config = {'services': {}, 'haproxy': {'extra_sections': {}}}
+    assert configure_synapse.apply_server_slots(my_config, synapse_config) == []
+
+
+def test_sync_server_slots(tmpdir):
+    my_config = configure_synapse.set_defaults({
+        'file_output_path': tmpdir.strpath,
+        'haproxy_server_slots': True,
+    })
+    tmpdir.join('foo.superregion.json').write(json.dumps(
+        [{'host': '10.0.0.2', 'port': 1234, 'name': 'b'}],
+    ))
+    synapse_config = {
+        'services': {},
+        'haproxy': {
+            'extra_sections': {
+                'listen stats': ['mode http'],
+                'backend foo.superregion': ['server-template slot 1-4 0.0.0.0:0 disabled check'],
+            },
+        },
+    }
+    stats = [
+        {'pxname': 'foo.superregion', 'svname': 'slot1', 'status': 'UP', 'addr': '10.0.0.1:1234'},
+        {'pxname': 'foo.superregion', 'svname': 'slot2', 'status': 'MAINT', 'addr': '0.0.0.0:0'},
+        {'pxname': 'foo.superregion', 'svname': 'BACKEND', 'status': 'UP', 'addr': ''},
+        {'pxname': 'foo.region', 'svname': '10.0.0.3:1234', 'status': 'UP', 'addr': '10.0.0.3:1234'},
+    ]
+    with contextlib.nested(
+        mock.patch.object(runtime_api, 'show_stat', autospec=True, return_value=stats),
+        mock.patch.object(runtime_api, 'set_command', autospec=True),
+    ) as (_, mock_set_command):
+        assert configure_synapse.sync_server_slots(my_config, synapse_config)
+
+        assert mock_set_command.call_args_list == [
+            mock.call('/var/run/synapse/haproxy.sock', 'set server foo.superregion/slot1 state maint'),
+            mock.call('/var/run/synapse/haproxy.sock', 'set server foo.superregion/slot1 addr 10.0.0.2 port 1234'),
+            mock.call('/var/run/synapse/haproxy.sock', 'set server foo.superregion/slot1 state ready'),
+        ]
+
+        # HAProxy not running does not fail the run
+        mock_set_command.side_effect = runtime_api.RuntimeApiError
+        assert not configure_synapse.sync_server_slots(my_config, synapse_config)
+
+
+def test_sync_server_slots_assigns_the_subset(tmpdir):
+    my_config = configure_synapse.set_defaults({
+        'file_output_path': tmpdir.strpath,
+        'haproxy_server_slots': True,
+    })
+    servers = [{'host': '10.0.0.%d' % i, 'port': 1234, 'name': str(i)} for i in range(4)]
+    tmpdir.join('foo.superregion.json').write(json.dumps(servers))
+    synapse_config = {
+        'services': {},
+        'haproxy': {
+            'extra_sections': {
+                'backend foo.superregion': ['server-template slot 1-4 0.0.0.0:0 disabled check'],
+            },
+        },
+    }
+    subset = get_subset('my_host', ['10.0.0.%d:1234' % i for i in range(4)], 2)
+    stats = [
+        {'pxname': 'foo.superregion', 'svname': 'slot%d' % i, 'status': 'MAINT', 'addr': '0.0.0.0:0'}
+        for i in range(1, 5)
+    ]
+    with contextlib.nested(
+        mock.patch.object(runtime_api, 'show_stat', autospec=True, return_value=stats),
+        mock.patch.object(runtime_api, 'set_command', autospec=True),
+        mock.patch('socket.gethostname', return_value='my_host'),
+    ) as (_, mock_set_command, _):
+        assert configure_synapse.sync_server_slots(my_config, synapse_config, {'foo.superregion': 2})
+
+        assigned = {
+            '{0}:{1}'.format(*c[0][1].split(' addr ')[1].split(' port '))
+            for c in mock_set_command.call_args_list
+            if ' addr ' in c[0][1]
+        }
+        assert assigned == subset
+
+
+def test_sync_server_slots_waits_for_the_slots(tmpdir):
+    my_config = configure_synapse.set_defaults({
+        'file_output_path': tmpdir.strpath,
+        'haproxy_server_slots': True,
+    })
+    tmpdir.join('foo.superregion.json').write(json.dumps(
+        [{'host': '10.0.0.2', 'port': 1234, 'name': 'b'}],
+    ))
+    synapse_config = {
+        'services': {},
+        'haproxy': {
+            'extra_sections': {
+                'backend foo.superregion': ['server-template slot 1-4 0.0.0.0:0 disabled check'],
+            },
+        },
+    }
+    # HAProxy still runs the config without the slots, then synapse
+    # restarts it with them
+    old_stats = [
+        {'pxname': 'foo.superregion', 'svname': '10.0.0.2:1234_b', 'status': 'UP', 'addr': '10.0.0.2:1234'},
+    ]
+    new_stats = [
+        {'pxname': 'foo.superregion', 'svname': 'slot1', 'status': 'MAINT', 'addr': '0.0.0.0:0'},
+    ]
+    with contextlib.nested(
+        mock.patch.object(runtime_api, 'show_stat', autospec=True, side_effect=[old_stats, old_stats, new_stats]),
+        mock.patch.object(runtime_api, 'set_command', autospec=True),
+        mock.patch('time.sleep', autospec=True),
+        mock.patch.object(configure_synapse.log, 'warning', autospec=True),
+    ) as (_, mock_set_command, mock_sleep, mock_log_warning):
+        assert not configure_synapse.sync_server_slots(my_config, synapse_config)
+        assert mock_set_command.call_count == 0
+        # Missing slots are not a lack of slots
+        assert mock_log_warning.call_count == 0
+
+        assert configure_synapse.sync_server_slots(
+            my_config, synapse_config, timeout_s=configure_synapse.SERVER_SLOTS_TIMEOUT_S,
+        )
+        mock_sleep.assert_called_once_with(configure_synapse.SERVER_SLOTS_RETRY_INTERVAL_S)
+        assert mock_set_command.call_args_list == [
+            mock.call('/var/run/synapse/haproxy.sock', 'set server foo.superregion/slot1 addr 10.0.0.2 port 1234'),
+            mock.call('/var/run/synapse/haproxy.sock', 'set server foo.superregion/slot1 state ready'),
+        ]
+
+
+def test_main_waits_for_the_server_slots_after_restarting(tmpdir):
+    with contextlib.nested(
+        setup_mocks_for_main(tmpdir, {'services': {'new': {}}}, haproxy_server_slots=True),
+        mock.patch('synapse_tools.configure_synapse.apply_server_slots', autospec=True, return_value=[]),
+        mock.patch('synapse_tools.configure_synapse.sync_server_slots', autospec=True),
+    ) as ((config_file, mock_subprocess_check_call), _, mock_sync_server_slots):
+        config_file.write('{"services": {"old": {}}}')
+        configure_synapse.main()
+        assert mock_subprocess_check_call.call_count == 2
+        assert mock_sync_server_slots.call_args[1] == {'timeout_s': configure_synapse.SERVER_SLOTS_TIMEOUT_S}
+
+        # Nothing to wait for without a restart
+        configure_synapse.main()
+        assert mock_subprocess_check_call.call_count == 2
+        assert mock_sync_server_slots.call_args[1] == {'timeout_s': 0}
+
+
+def test_daemon_wakes_up_until_the_server_slots_are_synced(tmpdir):
+    with setup_mocks_for_daemon() as (daemon, _, mock_get_config, _, _, _, mock_update_synapse_config):
+        mock_get_config.return_value.update({
+            'config_file': tmpdir.join('synapse.conf.json').strpath,
+            'haproxy_server_slots': True,
+        })
+        mock_update_synapse_config.return_value = True
+        with contextlib.nested(
+            mock.patch('synapse_tools.configure_synapse.apply_server_slots', autospec=True, return_value=[]),
+            mock.patch('synapse_tools.configure_synapse.sync_server_slots', autospec=True, return_value=False),
+        ) as (_, mock_sync_server_slots):
+            daemon.refresh(set())
+            assert daemon.wakeup_timeout() == configure_synapse.SERVER_SLOTS_RETRY_INTERVAL_S
+
+            # Until they are, or for at most SERVER_SLOTS_TIMEOUT_S
+            mock_update_synapse_config.return_value = False
+            mock_sync_server_slots.return_value = True
+            daemon.refresh(set())
+            assert daemon.wakeup_timeout() == configure_synapse.DAEMON_REFRESH_INTERVAL_S
@@ -0,0 +1,67 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Most of our entry points run from cron on every host, so their startup
+# time matters. These are the expensive dependencies which the module of
+# each console_script in setup.py must only import once it actually needs
+# them. Importing paasta_tools at module level alone costs ~0.4s.
+LAZY_IMPORTS = {
+    'synapse_tools.batch_render': ['environment_tools', 'paasta_tools', 'psutil', 'yaml'],
+    'synapse_tools.configure_synapse': ['environment_tools', 'paasta_tools', 'psutil', 'yaml'],
+    'synapse_tools.haproxy_synapse_reaper': [],
+    'synapse_tools.haproxy.qdisc_tool': ['plumbum', 'pyroute2'],
+}
+
+# Budget, in seconds, for importing the module of any console_script in a
+# fresh interpreter. Each takes well under 0.1s, the headroom is there so
+# that a loaded machine does not fail the test, while a regression the size
+# of importing paasta_tools still does.
+IMPORT_TIME_BUDGET_S = 0.4
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import {module}
+print(json.dumps([time.time() - start, sorted(sys.modules)]))
+"""
+
+
+def get_console_script_modules():
+    with open(os.path.join(SRC_DIR, 'setup.py')) as fp:
+        setup_py = fp.read()
+    return set(re.findall(r"'\w+=([\w.]+):\w+'", setup_py))
+
+
+def cold_import(module):
+    """How long importing module in a fresh interpreter took, and the
+    modules it imported"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+        cwd=SRC_DIR,
+    )
+    return json.loads(output)
+
+
+def test_every_console_script_is_checked():
+    assert get_console_script_modules() == set(LAZY_IMPORTS)
+
+
+@pytest.mark.parametrize('module', sorted(LAZY_IMPORTS))
+def test_lazy_imports(module):
+    imported_packages = {name.split('.')[0] for name in cold_import(module)[1]}
+    assert not imported_packages & set(LAZY_IMPORTS[module])
+
+
+@pytest.mark.parametrize('module', sorted(LAZY_IMPORTS))
+def test_import_time_budget(module):
+    # Best of five to not fail because of a few slow runs
+    import_time_s = min(cold_import(module)[0] for _ in range(5))
+    assert import_time_s < IMPORT_TIME_BUDGET_S
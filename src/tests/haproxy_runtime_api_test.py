@@ -0,0 +1,82 @@
+import socket
+
+import mock
+import pytest
+
+from synapse_tools.haproxy import runtime_api
+
+
+SHOW_STAT = (
+    '# pxname,svname,scur,stot,\n'
+    'foo.main,FRONTEND,0,10,\n'
+    'foo.main,10.0.0.1:1234,0,4,\n'
+    'foo.main,10.0.0.2:1234,0,6,\n'
+    'foo.main,BACKEND,0,10,\n'
+    'bar.main,BACKEND,0,0,\n'
+    '\n'
+)
+
+
+@pytest.yield_fixture
+def mock_socket():
+    with mock.patch.object(runtime_api.socket, 'socket', autospec=True) as mock_socket:
+        yield mock_socket.return_value
+
+
+def set_response(mock_socket, response):
+    mock_socket.recv.side_effect = [response.encode('ascii'), b'']
+
+
+def test_send_command(mock_socket):
+    set_response(mock_socket, 'some output\n')
+
+    assert runtime_api.send_command('/haproxy.sock', 'show info') == 'some output\n'
+
+    mock_socket.connect.assert_called_once_with('/haproxy.sock')
+    mock_socket.sendall.assert_called_once_with(b'show info\n')
+    assert mock_socket.close.called
+
+
+def test_send_command_socket_error(mock_socket):
+    mock_socket.connect.side_effect = socket.error('No such file or directory')
+
+    with pytest.raises(runtime_api.RuntimeApiError):
+        runtime_api.send_command('/haproxy.sock', 'show info')
+    assert mock_socket.close.called
+
+
+def test_set_command(mock_socket):
+    set_response(mock_socket, '\n')
+    runtime_api.set_command('/haproxy.sock', 'set maxconn global 10')
+
+
+def test_set_command_error(mock_socket):
+    set_response(mock_socket, 'Unknown command.\n')
+    with pytest.raises(runtime_api.RuntimeApiError):
+        runtime_api.set_command('/haproxy.sock', 'set maxconn server a/b 10')
+
+
+def test_show_stat(mock_socket):
+    set_response(mock_socket, SHOW_STAT)
+
+    stats = runtime_api.show_stat('/haproxy.sock')
+
+    assert len(stats) == 5
+    assert stats[1] == {'pxname': 'foo.main', 'svname': '10.0.0.1:1234', 'scur': '0', 'stot': '4'}
+
+
+def test_get_servers_by_backend(mock_socket):
+    set_response(mock_socket, SHOW_STAT)
+
+    assert runtime_api.get_servers_by_backend('/haproxy.sock') == {
+        'foo.main': ['10.0.0.1:1234', '10.0.0.2:1234'],
+    }
+
+
+def test_get_sessions_by_backend(mock_socket):
+    set_response(mock_socket, SHOW_STAT)
+
+    assert runtime_api.get_sessions_by_backend('/haproxy.sock') == {
+        'foo.main': 10,
+        'bar.main': 0,
+    }
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from synapse_tools.inotify import Inotify
+
+
+@pytest.yield_fixture
+def inotify():
+    watcher = Inotify()
+    yield watcher
+    watcher.close()
+
+
+def test_read_changes_times_out(inotify, tmpdir):
+    inotify.add_watch(str(tmpdir))
+    assert inotify.read_changes(timeout=0) == set()
+
+
+def test_read_changes_reports_written_files(inotify, tmpdir):
+    inotify.add_watch(str(tmpdir))
+    tmpdir.join('smartstack.yaml').write('main: {}')
+
+    assert str(tmpdir.join('smartstack.yaml')) in inotify.read_changes(timeout=1)
+
+
+def test_read_changes_reports_renamed_files(inotify, tmpdir):
+    tmpdir.join('new.json').write('{}')
+    inotify.add_watch(str(tmpdir))
+    os.rename(str(tmpdir.join('new.json')), str(tmpdir.join('config.json')))
+
+    changes = inotify.read_changes(timeout=1)
+    assert str(tmpdir.join('new.json')) in changes
+    assert str(tmpdir.join('config.json')) in changes
+
+
+def test_recursive_watch_follows_new_directories(inotify, tmpdir):
+    tmpdir.mkdir('service_one')
+    inotify.add_watch(str(tmpdir), recursive=True)
+    assert inotify.watched_paths() == {str(tmpdir), str(tmpdir.join('service_one'))}
+
+    tmpdir.join('service_one', 'smartstack.yaml').write('main: {}')
+    assert str(tmpdir.join('service_one', 'smartstack.yaml')) in inotify.read_changes(timeout=1)
+
+    tmpdir.mkdir('service_two')
+    assert str(tmpdir.join('service_two')) in inotify.read_changes(timeout=1)
+    tmpdir.join('service_two', 'smartstack.yaml').write('main: {}')
+    assert str(tmpdir.join('service_two', 'smartstack.yaml')) in inotify.read_changes(timeout=1)
+
+
+def test_non_recursive_watch_ignores_subdirectories(inotify, tmpdir):
+    tmpdir.mkdir('service_one')
+    inotify.add_watch(str(tmpdir))
+    tmpdir.join('service_one', 'smartstack.yaml').write('main: {}')
+
+    assert inotify.read_changes(timeout=0.1) == set()
+
+
+def test_add_watch_missing_directory(inotify, tmpdir):
+    with pytest.raises(OSError):
+        inotify.add_watch(str(tmpdir.join('missing')))
@@ -0,0 +1,90 @@
+import json
+
+from synapse_tools.restart_scheduler import get_host_jitter_s
+from synapse_tools.restart_scheduler import RestartScheduler
+
+
+def test_no_restart_pending():
+    scheduler = RestartScheduler(min_interval_s=60, coalesce_window_s=30)
+    assert not scheduler.pending
+    assert scheduler.due_time() is None
+    assert not scheduler.is_due(now=1000)
+
+
+def test_restart_due_after_coalesce_window():
+    scheduler = RestartScheduler(coalesce_window_s=30)
+    scheduler.request_restart('a', now=1000)
+    scheduler.request_restart('b', now=1020)
+    scheduler.request_restart('b', now=1025)
+
+    assert scheduler.pending_digests == ['a', 'b']
+    assert scheduler.due_time() == 1030
+    assert not scheduler.is_due(now=1029)
+    assert scheduler.is_due(now=1030)
+
+
+def test_restart_due_after_min_interval():
+    scheduler = RestartScheduler(min_interval_s=300, coalesce_window_s=30)
+    scheduler.record_restart('a', now=1000)
+    scheduler.request_restart('b', now=1100)
+
+    assert scheduler.due_time() == 1300
+
+
+def test_immediate_restarts_by_default():
+    scheduler = RestartScheduler()
+    scheduler.record_restart('a', now=1000)
+    scheduler.request_restart('b', now=1000)
+    assert scheduler.is_due(now=1000)
+
+
+def test_record_restart_clears_pending():
+    scheduler = RestartScheduler()
+    scheduler.request_restart('a', now=1000)
+    scheduler.record_restart('a', now=1001)
+
+    assert not scheduler.pending
+    assert scheduler.running_digest == 'a'
+    assert scheduler.last_restart == 1001
+
+
+def test_runtime_updates_are_kept_until_restart():
+    scheduler = RestartScheduler()
+    scheduler.record_restart('a', now=1000)
+    scheduler.record_runtime_updates([('foo.main', 'maxconn', 80), (None, 'maxconn', 20000)])
+    scheduler.record_runtime_updates([('foo.main', 'maxconn', 90)])
+
+    assert not scheduler.pending
+    assert scheduler.runtime_updates == [[None, 'maxconn', 20000], ['foo.main', 'maxconn', 90]]
+
+    scheduler.record_restart('b', now=1001)
+    assert scheduler.runtime_updates == []
+
+
+def test_state_round_trip():
+    scheduler = RestartScheduler(min_interval_s=60)
+    scheduler.record_restart('a', now=1000)
+    scheduler.request_restart('b', now=1010)
+    scheduler.record_runtime_updates([('foo.main', 'maxconn', 80)])
+
+    state = json.loads(json.dumps(scheduler.state()))
+    loaded = RestartScheduler(min_interval_s=60, state=state)
+
+    assert loaded.state() == scheduler.state()
+    assert loaded.due_time() == 1060
+
+
+def test_jitter_delays_restart():
+    scheduler = RestartScheduler(coalesce_window_s=30, jitter_s=12.5)
+    scheduler.request_restart('a', now=1000)
+    assert scheduler.due_time() == 1042.5
+
+
+def test_get_host_jitter_s():
+    jitters = [get_host_jitter_s('host%d' % i, 600) for i in range(1000)]
+
+    assert jitters == [get_host_jitter_s('host%d' % i, 600) for i in range(1000)]
+    assert all(0 <= jitter < 600 for jitter in jitters)
+    # Spread across the whole window
+    assert len({int(jitter // 60) for jitter in jitters}) == 10
+    assert get_host_jitter_s('host0', 0) == 0
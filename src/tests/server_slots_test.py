@@ -0,0 +1,53 @@
+import pytest
+
+from synapse_tools import server_slots
+
+
+@pytest.mark.parametrize('server_count,previous_slot_count,expected', [
+    (0, None, 4),
+    (2, None, 4),
+    (3, None, 8),
+    (10, None, 32),
+    # Kept while the servers fit with some headroom
+    (20, 32, 32),
+    (4, 32, 32),
+    # Changed once they do not
+    (25, 32, 64),
+    (3, 32, 8),
+])
+def test_get_slot_count(server_count, previous_slot_count, expected):
+    assert server_slots.get_slot_count(server_count, previous_slot_count) == expected
+
+
+def test_server_template_round_trip():
+    line = server_slots.get_server_template(8, 'check inter 2s')
+    assert line == 'server-template slot 1-8 0.0.0.0:0 disabled check inter 2s'
+    assert server_slots.get_slot_count_from_lines(['balance roundrobin', line]) == 8
+    assert server_slots.get_slot_count_from_lines(['balance roundrobin']) is None
+
+
+def test_get_slot_commands():
+    slots = {
+        'slot1': '10.0.0.1:1234',
+        'slot2': '10.0.0.2:1234',
+        'slot3': None,
+        'slot10': None,
+    }
+    servers = {('10.0.0.1', 1234), ('10.0.0.3', 1234)}
+    commands, unassigned = server_slots.get_slot_commands('foo.superregion', slots, servers)
+    assert commands == [
+        'set server foo.superregion/slot2 state maint',
+        'set server foo.superregion/slot2 addr 10.0.0.3 port 1234',
+        'set server foo.superregion/slot2 state ready',
+    ]
+    assert unassigned == []
+
+
+def test_get_slot_commands_out_of_slots():
+    servers = {('10.0.0.1', 1234), ('10.0.0.2', 1234)}
+    commands, unassigned = server_slots.get_slot_commands('foo.superregion', {'slot1': None}, servers)
+    assert commands == [
+        'set server foo.superregion/slot1 addr 10.0.0.1 port 1234',
+        'set server foo.superregion/slot1 state ready',
+    ]
+    assert unassigned == [('10.0.0.2', 1234)]
@@ -0,0 +1,80 @@
+import pickle
+
+import pytest
+
+from synapse_tools.service_config import InvalidServiceConfigError
+from synapse_tools.service_config import ServiceConfig
+
+
+def test_defaults():
+    service = ServiceConfig('test_service', {})
+
+    assert service.proxy_port == -1
+    assert service.discover == 'region'
+    assert service.advertise == ['region']
+    assert service.mode == 'http'
+    assert service.chaos == {}
+    assert service.plugins == {}
+    assert service.timeout_client_ms is None
+    assert service.timeout_server_ms is None
+    assert service.healthcheck_uri == '/status'
+    assert service.healthcheck_option == 'option httpchk GET /http/test_service/0/status'
+    assert service.proxied_through is None
+    assert not service.is_proxy
+    assert service.subset_size is None
+
+
+def test_one_timeout_sets_both():
+    service = ServiceConfig('test_service', {'timeout_server_ms': 2000})
+    assert service.timeout_client_ms == 2000
+    assert service.timeout_server_ms == 2000
+
+    service = ServiceConfig('test_service', {'timeout_client_ms': 3000, 'timeout_server_ms': 2000})
+    assert service.timeout_client_ms == 3000
+    assert service.timeout_server_ms == 2000
+
+
+def test_healthcheck_option_with_headers():
+    service = ServiceConfig('test_service', {
+        'mode': 'tcp',
+        'healthcheck_uri': '/health',
+        'extra_healthcheck_headers': {'Host': 'example.com'},
+    })
+    assert service.healthcheck_option == (
+        r'option httpchk GET /tcp/test_service/0/health HTTP/1.1\r\nHost:\ example.com'
+    )
+
+
+def test_invalid_number():
+    with pytest.raises(InvalidServiceConfigError) as excinfo:
+        ServiceConfig('test_service', {'retries': '3'})
+    assert 'test_service' in str(excinfo.value)
+    assert 'retries' in str(excinfo.value)
+
+
+@pytest.mark.parametrize('subset_size', [2.5, True, 0, '3'])
+def test_invalid_subset_size(subset_size):
+    with pytest.raises(InvalidServiceConfigError):
+        ServiceConfig('test_service', {'subset_size': subset_size})
+
+
+def test_get_looks_up_raw_config():
+    service = ServiceConfig('test_service', {'proxy_port': 1234, 'foo': 'bar'})
+    assert service.get('foo') == 'bar'
+    assert service.get('missing') is None
+    assert service.get('missing', 'default') == 'default'
+
+
+def test_no_instance_dict():
+    service = ServiceConfig('test_service', {})
+    with pytest.raises(AttributeError):
+        service.not_a_slot = 1
+
+
+@pytest.mark.parametrize('protocol', [0, pickle.HIGHEST_PROTOCOL])
+def test_pickle(protocol):
+    service = ServiceConfig('test_service', {'proxy_port': 1234, 'timeout_server_ms': 2000})
+    loaded = pickle.loads(pickle.dumps(service, protocol))
+    assert loaded.name == 'test_service'
+    assert loaded.info == service.info
+    assert loaded.timeout_client_ms == 2000
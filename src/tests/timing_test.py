@@ -0,0 +1,77 @@
+import json
+import socket
+
+import mock
+
+from synapse_tools import timing
+
+
+def test_phase_timer_accumulates_phases():
+    with mock.patch.object(timing.time, 'time', side_effect=[100, 101, 103, 104, 104.5, 110]):
+        timer = timing.PhaseTimer()
+        with timer.phase('generate'):
+            pass
+        with timer.phase('write'):
+            pass
+        summary = timer.summary()
+
+    assert list(timer.phases) == ['generate', 'write']
+    assert summary == {
+        'timestamp': 100,
+        'total_s': 10,
+        'phases': {'generate': 2, 'write': 0.5},
+    }
+
+
+def test_phase_timer_times_failed_phases():
+    timer = timing.PhaseTimer()
+    try:
+        with timer.phase('generate'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert 'generate' in timer.phases
+
+
+def test_format_statsd():
+    summary = {'timestamp': 100, 'total_s': 1.5, 'phases': {'write': 0.0004, 'generate': 1.2345}}
+    assert timing.format_statsd('configure_synapse', summary) == (
+        'configure_synapse.generate:1235|ms\n'
+        'configure_synapse.write:0|ms\n'
+        'configure_synapse.total:1500|ms'
+    )
+
+
+def test_emit_summary(tmpdir):
+    summary_path = tmpdir.join('timing.json')
+    timer = timing.PhaseTimer()
+    with mock.patch.object(timing.socket, 'socket', autospec=True) as mock_socket:
+        timing.emit_summary(
+            timer,
+            summary_path=summary_path.strpath,
+            statsd_address='127.0.0.1:8125',
+            statsd_prefix='prefix',
+        )
+
+    assert set(json.loads(summary_path.read())) == {'timestamp', 'total_s', 'phases'}
+    data, address = mock_socket.return_value.sendto.call_args[0]
+    assert data.startswith(b'prefix.total:')
+    assert address == ('127.0.0.1', 8125)
+
+
+def test_emit_summary_only_logs_errors(tmpdir):
+    timer = timing.PhaseTimer()
+    with mock.patch.object(timing.socket, 'socket', autospec=True) as mock_socket:
+        mock_socket.return_value.sendto.side_effect = socket.error()
+        timing.emit_summary(
+            timer,
+            summary_path=tmpdir.join('missing', 'timing.json').strpath,
+            statsd_address='127.0.0.1:8125',
+            statsd_prefix='prefix',
+        )
+
+
+def test_iter_phase():
+    timer = timing.PhaseTimer()
+    assert list(timer.iter_phase('namespaces', iter([1, 2, 3]))) == [1, 2, 3]
+    assert list(timer.phases) == ['namespaces']